@@ -1,341 +1,766 @@
-def get_label_index():
-    try:
-        get_label_index.counter += 1
-    except AttributeError:
-        get_label_index.counter = 1
-    return f'.L{get_label_index.counter}'
+def entry_label(name:str) -> str:
+    # Where a function's own tail calls land: the frame is set up, the arguments not yet stored
+    return f'.L{name}_entry'
+
+def align(size:int, alignment:int = 8) -> int:
+    return (size + alignment - 1) // alignment * alignment
+
+def get_label_index(env:'Environment'):
+    # Labels are numbered per function so a function's code does not depend on what precedes it
+    env.label_count += 1
+    return f'.L{env.label_prefix}{env.label_count}'
+
+def walk(node:'AST'):
+    # Preorder, with an explicit stack so deep trees do not nest generators
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children()))
+
+# The condition testing the opposite of each condition
+INVERSE_CONDITIONS = {'eq': 'ne', 'ne': 'eq', 'lt': 'ge', 'ge': 'lt', 'gt': 'le', 'le': 'gt'}
+
+def branch_lines(condition:str, true_label:str, false_label:str) -> list[str]:
+    # Branches on flags already set: to true_label when condition holds, else to false_label.
+    # A label of None falls through to what follows.
+    if true_label is None:
+        return [f'b{INVERSE_CONDITIONS[condition]} {false_label}']
+    lines = [f'b{condition} {true_label}']
+    if false_label is not None:
+        lines.append(f'b {false_label}')
+    return lines
+
+class InternTable:
+    # Hash consing: one shared node per structure, so interned nodes that are equal are the
+    # same object and comparing them is an identity check
+    def __init__(self):
+        self.nodes = {}
+
+    def intern(self, node:'AST') -> 'AST':
+        return self.nodes.setdefault(node, node)
+
+class Output:
+    def __init__(self):
+        self.lines = []
+
+    def emit(self, content:str):
+        self.lines.append(content)
+
+    def getvalue(self) -> str:
+        return ''.join(f'{line}\n' for line in self.lines)
+
+    def close(self):
+        pass
+
+class FileOutput(Output):
+    def __init__(self, path:str):
+        super().__init__()
+        self.path = path
+
+    def close(self):
+        with open(self.path, 'w') as file:
+            file.write(self.getvalue())
 
 class Environment:
-    def __init__(self, locals:dict[str, int] = dict(), next_local_offset:int = 0):
+    def __init__(self, locals:dict[str, int] = dict(), local_slots:list[int] = [], output:Output = None, saved_registers:list[str] = [], label_prefix:str = '', function_name:str = '', argument_registers:list[str] = [], frame_size:int = 0):
         self.locals = locals.copy()
-        self.next_local_offset = next_local_offset
+        # Offsets of the slots the vars take, one per var in the order they are emitted
+        self.local_slots = iter(local_slots)
+        self.output = output if output is not None else Output()
+        # Registers pushed together with lr below the saved fp, restored on return
+        self.saved_registers = list(saved_registers)
+        self.label_prefix = label_prefix
+        self.label_count = 0
+        self.function_name = function_name
+        # Registers the prologue pushes, the arguments it keeps and fillers, and bytes it reserves below them
+        self.argument_registers = list(argument_registers)
+        self.frame_size = frame_size
 
 class AST:
-    def __eq__(self, other) -> bool:
-        return type(self) is type(other) and self.__dict__ == other.__dict__
-    
-    def emit(self, content):
-        with open('./out.s', 'a') as file:
-            file.write(content)
-            file.write('\n')
-
-# class Main(AST):
-#     def __init__(self, statements:list[AST]):
-#         self.statements = statements
-
-#     def __repr__(self):
-#         return f'{self.__class__.__name__}({[stmt for stmt in self.statements]})'
-
-#     def emit(self, env:Environment):
-#         super().emit('.global main')
-#         super().emit('main:')
-#         super().emit('push {fp, lr}')
-#         for statement in self.statements:
-#             statement.emit(env)
-#         super().emit('mov r0, #0')
-#         super().emit('pop {fp, pc}')
-    
-# class Assert(AST):
-#     def __init__(self, condition:AST):
-#         self.condition = condition
+    # A node's fields are the slots its classes declare, in the order the constructor takes
+    # them. The source span is outside the fields, so it takes no part in equality, hashing,
+    # rebuilding a node from its fields or the cache key. Nodes are not changed once built,
+    # so the structural hash is computed once and kept.
+    __slots__ = ('span', '_hash')
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if '_fields' not in cls.__dict__:
+            cls._fields = cls.__base__._fields + tuple(cls.__dict__.get('__slots__', ()))
+
+    def field_values(self) -> list:
+        return [getattr(self, name) for name in self._fields]
+
+    def children(self) -> list['AST']:
+        children = []
+        for value in self.field_values():
+            if isinstance(value, AST):
+                children.append(value)
+            elif isinstance(value, list):
+                children.extend(item for item in value if isinstance(item, AST))
+        return children
+
+    def located(self, message:str) -> str:
+        span = getattr(self, 'span', None)
+        return f'{span}: {message}' if span is not None else message
+
+    def __hash__(self) -> int:
+        try:
+            return self._hash
+        except AttributeError:
+            pass
+        # Children before parents, walk's order reversed, so deep trees do not recurse
+        for node in reversed(list(walk(self))):
+            if not hasattr(node, '_hash'):
+                node._hash = hash((node.__class__, *(tuple(value) if isinstance(value, list) else value for value in node.field_values())))
+        return self._hash
 
-#     def __repr__(self):
-#         return f'{self.__class__.__name__}({self.condition})'
+    def __eq__(self, other) -> bool:
+        # Fields are compared from an explicit stack of node pairs, so deep trees do not recurse,
+        # and values that are not nodes are compared before descending. Dicts and sets compare
+        # the cached hashes before calling __eq__, so it never computes a hash itself.
+        pending = [(self, other)]
+        push = pending.append
+        while pending:
+            left, right = pending.pop()
+            if left.__class__ is not right.__class__:
+                return False
+            for name in left._fields:
+                a, b = getattr(left, name), getattr(right, name)
+                if a is b:
+                    continue
+                if isinstance(a, AST):
+                    push((a, b))
+                elif isinstance(a, list):
+                    if b.__class__ is not list or len(a) != len(b):
+                        return False
+                    for item, other_item in zip(a, b):
+                        if isinstance(item, AST):
+                            push((item, other_item))
+                        elif item != other_item:
+                            return False
+                elif isinstance(b, AST) or a != b:
+                    return False
+        return True
 
-#     def emit(self, env:Environment):
-#         self.condition.emit(env)
-#         super().emit('cmp r0, #1')
-#         super().emit("moveq r0, #'T'")
-#         super().emit("movne r0, #'F'")
-#         super().emit('bl putchar')
+    def emit(self, env:Environment):
+        # Nodes describe their code as steps: a line of assembly or a child node to expand in
+        # place. Expanding them from an explicit stack keeps deep trees off the Python stack.
+        emit_line = env.output.emit
+        pending = [self.emit_steps(env)]
+        while pending:
+            for step in pending[-1]:
+                if step.__class__ is str:
+                    emit_line(step)
+                elif step.__class__.emit is AST.emit:
+                    pending.append(step.emit_steps(env))
+                    break
+                else:
+                    step.emit(env)
+            else:
+                pending.pop()
+
+    def emit_steps(self, env:Environment):
+        raise NotImplementedError(f'{self.__class__.__name__}.emit_steps')
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        # Steps of a condition: branch to true_label when the value is not zero, else to
+        # false_label. Comparisons branch on the flags of their cmp instead of a 0 or 1.
+        yield self
+        yield 'cmp r0, #0'
+        yield from branch_lines('ne', true_label, false_label)
 
 class Number(AST):
+    __slots__ = ('value',)
+
     def __init__(self, value:int):
         self.value = value
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.value})'
 
-    def emit(self, env:Environment):
-        super().emit(f'ldr r0, ={self.value}')
+    def emit_steps(self, env:Environment):
+        yield f'ldr r0, ={self.value}'
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        label = true_label if self.value & 0xffffffff else false_label
+        if label is not None:
+            yield f'b {label}'
 
 class Id(AST):
+    __slots__ = ('value',)
+
     def __init__(self, value:str):
         self.value = value
 
-    def emit(self, env:Environment):
+    def emit_steps(self, env:Environment):
         try:
             offset = env.locals[self.value]
-            super().emit(f'ldr r0, [fp, #{offset}]')
         except KeyError:
-            raise Exception(f'Undefined variable: {self.value}')
+            raise Exception(self.located(f'Undefined variable: {self.value}'))
+        yield f'ldr r0, [fp, #{offset}]'
         
     def __repr__(self):
         return f'{self.__class__.__name__}({self.value})'    
 
 class Not(AST):
+    __slots__ = ('term',)
+
     def __init__(self, term:AST):
         self.term = term
 
-    def emit(self, env:Environment):
-        self.term.emit(env)
-        super().emit('cmp r0, #0')
-        super().emit('moveq r0, #1')
-        super().emit('movne r0, #0')
+    def emit_steps(self, env:Environment):
+        yield self.term
+        yield 'cmp r0, #0'
+        yield 'moveq r0, #1'
+        yield 'movne r0, #0'
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        # Branches on the term with the labels swapped, nested nots unwrapped in a loop
+        node = self
+        while isinstance(node, Not):
+            node, true_label, false_label = node.term, false_label, true_label
+        yield from node.branch_steps(env, true_label, false_label)
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.term})'
 
 class Equal(AST):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left:AST, right:AST):
         self.left = left
         self.right = right
 
-    def emit(self, env:Environment):
-        self.left.emit(env)
-        super().emit('push {r0, ip}')
-        self.right.emit(env)
-        super().emit('pop {r1, ip}')
-        super().emit('cmp r0, r1')
-        super().emit('moveq r0, #1')
-        super().emit('movne r0, #0')
+    def emit_steps(self, env:Environment):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r0, r1'
+        yield 'moveq r0, #1'
+        yield 'movne r0, #0'
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r0, r1'
+        yield from branch_lines('eq', true_label, false_label)
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.left},{self.right})'
 
 class NotEqual(AST):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left:AST, right:AST):
         self.left = left
         self.right = right
 
-    def emit(self, env:Environment):
-        self.left.emit(env)
-        super().emit('push {r0, ip}')
-        self.right.emit(env)
-        super().emit('pop {r1, ip}')
-        super().emit('cmp r0, r1')
-        super().emit('moveq r0, #0')
-        super().emit('movne r0, #1')
+    def emit_steps(self, env:Environment):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r0, r1'
+        yield 'moveq r0, #0'
+        yield 'movne r0, #1'
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r0, r1'
+        yield from branch_lines('ne', true_label, false_label)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.left},{self.right})'
+
+class Less(AST):
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left:AST, right:AST):
+        self.left = left
+        self.right = right
+
+    def emit_steps(self, env:Environment):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r1, r0'
+        yield 'movlt r0, #1'
+        yield 'movge r0, #0'
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r1, r0'
+        yield from branch_lines('lt', true_label, false_label)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.left},{self.right})'
+
+class Greater(AST):
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left:AST, right:AST):
+        self.left = left
+        self.right = right
+
+    def emit_steps(self, env:Environment):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r1, r0'
+        yield 'movgt r0, #1'
+        yield 'movle r0, #0'
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        yield self.left
+        yield 'push {r0, ip}'
+        yield self.right
+        yield 'pop {r1, ip}'
+        yield 'cmp r1, r0'
+        yield from branch_lines('gt', true_label, false_label)
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.left},{self.right})'
 
 class Add(AST):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left:AST, right:AST):
         self.left = left
         self.right = right
 
-    def emit(self, env:Environment):
-        self.right.emit(env)
-        super().emit('push {r0, ip}')
-        self.left.emit(env)
-        super().emit('pop {r1, ip}')
-        super().emit('add r0, r0, r1')
+    def emit_steps(self, env:Environment):
+        yield self.right
+        yield 'push {r0, ip}'
+        yield self.left
+        yield 'pop {r1, ip}'
+        yield 'add r0, r0, r1'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.left},{self.right})'
 
 class Subtract(AST):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left:AST, right:AST):
         self.left = left
         self.right = right
 
-    def emit(self, env:Environment):
-        self.right.emit(env)
-        super().emit('push {r0, ip}')
-        self.left.emit(env)
-        super().emit('pop {r1, ip}')
-        super().emit('sub r0, r0, r1')
+    def emit_steps(self, env:Environment):
+        yield self.right
+        yield 'push {r0, ip}'
+        yield self.left
+        yield 'pop {r1, ip}'
+        yield 'sub r0, r0, r1'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.left},{self.right})'
 
 class Multiply(AST):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left:AST, right:AST):
         self.left = left
         self.right = right
 
-    def emit(self, env:Environment):
-        self.right.emit(env)
-        super().emit('push {r0, ip}')
-        self.left.emit(env)
-        super().emit('pop {r1, ip}')
-        super().emit('mul r0, r0, r1') 
+    def emit_steps(self, env:Environment):
+        yield self.right
+        yield 'push {r0, ip}'
+        yield self.left
+        yield 'pop {r1, ip}'
+        yield 'mul r0, r0, r1'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.left},{self.right})'
 
 class Divide(AST):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left:AST, right:AST):
         self.left = left
         self.right = right
 
-    def emit(self, env:Environment):
-        self.right.emit(env)
-        super().emit('push {r0, ip}')
-        self.left.emit(env)
-        super().emit('pop {r1, ip}')
-        super().emit('udiv r0, r0, r1') 
+    def emit_steps(self, env:Environment):
+        yield self.right
+        yield 'push {r0, ip}'
+        yield self.left
+        yield 'pop {r1, ip}'
+        yield 'udiv r0, r0, r1'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.left},{self.right})'
 
+def shift_add_sequence(constant:int) -> list[tuple[str, int]] | None:
+    # A multiplication by constant as at most an add or reverse subtract of a shifted copy, a
+    # shift and a negation, or None when it takes a mul
+    constant = (constant & 0xffffffff) - (1 << 32) if constant & 0x80000000 else constant & 0xffffffff
+    magnitude = abs(constant)
+    if magnitude == 0:
+        return None
+    shift = (magnitude & -magnitude).bit_length() - 1
+    odd = magnitude >> shift
+    sequence = []
+    if odd != 1:
+        if (odd - 1) & (odd - 2) == 0:
+            sequence.append(('add', (odd - 1).bit_length() - 1))
+        elif (odd + 1) & odd == 0:
+            sequence.append(('rsb', (odd + 1).bit_length() - 1))
+        else:
+            return None
+    if shift:
+        sequence.append(('lsl', shift))
+    if constant < 0:
+        sequence.append(('neg', 0))
+    return sequence
+
+def shift_add_lines(register:str, constant:int) -> list[str]:
+    lines = []
+    for operation, amount in shift_add_sequence(constant):
+        if operation == 'lsl':
+            lines.append(f'lsl {register}, {register}, #{amount}')
+        elif operation == 'neg':
+            lines.append(f'rsb {register}, {register}, #0')
+        else:
+            lines.append(f'{operation} {register}, {register}, {register}, lsl #{amount}')
+    return lines
+
+def reciprocal(divisor:int) -> tuple[int, int, bool]:
+    # Multiplier, shift and whether the fixup is needed to divide an unsigned 32 bit x by
+    # divisor: (x * multiplier) >> (32 + shift), or with t = (x * multiplier) >> 32 the
+    # multiplier is 33 bits and the quotient (t + ((x - t) >> 1)) >> shift
+    for shift in range(32):
+        multiplier = -(-(1 << (32 + shift)) // divisor)
+        if multiplier >= 1 << 32:
+            break
+        if multiplier * divisor - (1 << (32 + shift)) <= 1 << shift:
+            return multiplier, shift, False
+    bits = (divisor - 1).bit_length()
+    return (1 << 32) * ((1 << bits) - divisor) // divisor + 1, bits - 1, True
+
+def reciprocal_lines(register:str, high:str, low:str, divisor:int) -> list[str]:
+    # Divides register in place, high and low are clobbered
+    if divisor & (divisor - 1) == 0:
+        return [f'lsr {register}, {register}, #{divisor.bit_length() - 1}']
+    multiplier, shift, fixup = reciprocal(divisor)
+    lines = [f'ldr {high}, ={multiplier & 0xffffffff}', f'umull {low}, {high}, {register}, {high}']
+    if fixup:
+        lines += [f'sub {register}, {register}, {high}', f'add {register}, {high}, {register}, lsr #1']
+        high = register
+    if shift:
+        lines.append(f'lsr {register}, {high}, #{shift}')
+    elif high != register:
+        lines.append(f'mov {register}, {high}')
+    return lines
+
+class MultiplyByConstant(AST):
+    __slots__ = ('term', 'constant')
+
+    def __init__(self, term:AST, constant:int):
+        self.term = term
+        self.constant = constant
+
+    def emit_steps(self, env:Environment):
+        yield self.term
+        yield from shift_add_lines('r0', self.constant)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.term},{self.constant})'
+
+class DivideByConstant(AST):
+    # Unsigned like udiv, divisor is above 1
+    __slots__ = ('term', 'divisor')
+
+    def __init__(self, term:AST, divisor:int):
+        self.term = term
+        self.divisor = divisor
+
+    def emit_steps(self, env:Environment):
+        yield self.term
+        yield from reciprocal_lines('r0', 'r1', 'r2', self.divisor)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.term},{self.divisor})'
+
+def stack_arguments_size(count:int) -> int:
+    # Bytes the fifth argument on take on the stack during a call, freed by the caller after it
+    return align(4 * count) - 16 if count > 4 else 0
+
+def emit_arguments(arguments:list[AST]):
+    # Leaves the first four arguments in r0 to r3 and the others on the stack
+    count = len(arguments)
+    if count == 1:
+        yield arguments[0]
+    elif count >= 2:
+        yield f'sub sp, sp, #{max(16, align(4 * count))}'
+        for i, arg in enumerate(arguments):
+            yield arg
+            yield f'str r0, [sp, #{4 * i}]'
+        yield 'pop {r0, r1, r2, r3}'
+
 class Call(AST):
+    __slots__ = ('callee', 'arguments')
+
     def __init__(self, callee:str, arguments:list[AST]):
         self.callee = callee
         self.arguments = arguments
 
-    def emit(self, env:Environment):
-        count = len(self.arguments)
-        if count == 0:
-            super().emit(f'bl {self.callee}')
-        elif count == 1:
-            self.arguments[0].emit(env)
-            super().emit(f'bl {self.callee}')
-        elif count >= 2 and count <= 4:
-            super().emit('sub sp, sp, #16')
-            for i, arg in enumerate(self.arguments):
-                arg.emit(env)
-                super().emit(f'str r0, [sp, #{4 * i}]')
-            super().emit('pop {r0, r1, r2, r3}')
-            super().emit(f'bl {self.callee}')
-        else:
-            raise Exception('More than 4 arguments not supported')
+    def emit_steps(self, env:Environment):
+        yield from emit_arguments(self.arguments)
+        yield f'bl {self.callee}'
+        if len(self.arguments) > 4:
+            yield f'add sp, sp, #{stack_arguments_size(len(self.arguments))}'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.callee},{[arg for arg in self.arguments]})'
 
+# The EABI library routine dividing r0 by r1 unsigned, for cores without udiv
+DIVIDE_FUNCTION = '__aeabi_uidiv'
+
+class DivideCall(Call):
+    # arguments[0] / arguments[1] through DIVIDE_FUNCTION, evaluated in the order of Divide
+    __slots__ = ()
+
+    def emit_steps(self, env:Environment):
+        yield self.arguments[1]
+        yield 'push {r0, ip}'
+        yield self.arguments[0]
+        yield 'pop {r1, ip}'
+        yield f'bl {self.callee}'
+
 class Return(AST):
+    __slots__ = ('term',)
+
     def __init__(self, term:AST):
         self.term = term
 
-    def emit(self, env:Environment):
-        self.term.emit(env)
-        super().emit('mov sp, fp')
-        super().emit('pop {fp, pc}')
+    def emit_steps(self, env:Environment):
+        yield self.term
+        yield 'mov sp, fp'
+        if env.saved_registers:
+            yield 'pop {fp, ip}'
+            yield f'pop {{{", ".join(env.saved_registers)}, pc}}'
+        else:
+            yield 'pop {fp, pc}'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.term})'
 
+class TailCall(AST):
+    # return callee(arguments) without a frame of its own: a call to the function itself
+    # branches back to its entry, any other call leaves through the epilogue and branches
+    # to the callee, which then returns straight to our caller
+    __slots__ = ('callee', 'arguments')
+
+    def __init__(self, callee:str, arguments:list[AST]):
+        self.callee = callee
+        self.arguments = arguments
+
+    def emit_steps(self, env:Environment):
+        yield from emit_arguments(self.arguments)
+        yield 'mov sp, fp'
+        if self.callee == env.function_name:
+            yield f'b {entry_label(self.callee)}'
+            return
+        if env.saved_registers:
+            yield 'pop {fp, ip}'
+            yield f'pop {{{", ".join(env.saved_registers)}, lr}}'
+        else:
+            yield 'pop {fp, lr}'
+        yield f'b {self.callee}'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.callee},{[arg for arg in self.arguments]})'
+
 class Block(AST):
+    __slots__ = ('statements',)
+
     def __init__(self, statements:list[AST]):
         self.statements = statements
 
-    def emit(self, env:Environment):
-        for stmt in self.statements:
-            stmt.emit(env)
+    def emit_steps(self, env:Environment):
+        yield from self.statements
 
     def __repr__(self):
         return f'{self.__class__.__name__}({[stmt for stmt in self.statements]})'
 
 class If(AST):
+    __slots__ = ('conditional', 'consequence', 'alternative')
+
     def __init__(self, conditional:AST, consequence:AST, alternative:AST):
         self.conditional = conditional
         self.consequence = consequence
         self.alternative = alternative
 
-    def emit(self, env:Environment):
-        if_false_label = get_label_index()
-        end_if_label = get_label_index()
-        self.conditional.emit(env)
-        super().emit('cmp r0, #0')
-        super().emit(f'beq {if_false_label}')
-        self.consequence.emit(env)
-        super().emit(f'b {end_if_label}')
-        super().emit(f'{if_false_label}:')
-        self.alternative.emit(env)
-        super().emit(f'{end_if_label}:')
+    def emit_steps(self, env:Environment):
+        if_false_label = get_label_index(env)
+        end_if_label = get_label_index(env)
+        yield from self.conditional.branch_steps(env, None, if_false_label)
+        yield self.consequence
+        yield f'b {end_if_label}'
+        yield f'{if_false_label}:'
+        yield self.alternative
+        yield f'{end_if_label}:'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.conditional},{self.consequence},{self.alternative})'
         
 class Function(AST):
+    __slots__ = ('name', 'paramenters', 'body')
+
     def __init__(self, name:str, paramenters:list[AST], body:AST):
         self.name = name
         self.paramenters = paramenters
         self.body = body
 
-    def emit_prologue(self):
-        super().emit('push {fp, lr}')
-        super().emit('mov fp, sp')
-        super().emit('push {r0, r1, r2, r3}')
-
-    def emit_epilogue(self):
-        super().emit('mov sp, fp')
-        super().emit('mov r0, #0')
-        super().emit('pop {fp, pc}')
-
-    def set_environment(self):
+    def emit_prologue(self, env:Environment):
+        env.output.emit('push {fp, lr}')
+        env.output.emit('mov fp, sp')
+        self.emit_entry(env)
+        self.emit_frame(env)
+
+    def emit_frame(self, env:Environment):
+        if env.argument_registers:
+            env.output.emit(f'push {{{", ".join(env.argument_registers)}}}')
+        if env.frame_size:
+            env.output.emit(f'sub sp, sp, #{env.frame_size}')
+
+    def emit_entry(self, env:Environment):
+        if any(isinstance(node, TailCall) and node.callee == self.name for node in walk(self.body)):
+            env.output.emit(f'{entry_label(self.name)}:')
+
+    def emit_epilogue(self, env:Environment):
+        env.output.emit('mov sp, fp')
+        env.output.emit('mov r0, #0')
+        env.output.emit('pop {fp, pc}')
+
+    def stack_parameter_offset(self, index:int) -> int:
+        # The fifth parameter on are where the caller left them, above the saved fp and lr
+        return 8 + 4 * (index - 4)
+
+    def set_environment(self, output:Output):
+        # The whole frame is laid out up front. Parameters the body refers to are pushed from
+        # their registers right below fp, then every var gets a 4 byte slot of its own, so a var
+        # in a loop or a branch keeps one place however often it runs. An odd push takes one
+        # more register, whose slot is the first var's or keeps sp 8 byte aligned.
+        names = set()
+        var_count = 0
+        for node in walk(self.body):
+            if isinstance(node, Id):
+                names.add(node.value)
+            elif isinstance(node, Assign):
+                names.add(node.name)
+            elif isinstance(node, Var):
+                var_count += 1
+        registers = [f'r{i}' for i, parameter in enumerate(self.paramenters[:4]) if parameter in names]
+        pushed = list(registers)
+        if len(pushed) % 2:
+            pushed = sorted(pushed + [next(register for register in ('r0', 'r1', 'r2', 'r3') if register not in pushed)])
         locals = dict()
         for i, parameter in enumerate(self.paramenters):
-            locals[parameter] = 4 * i - 16
-        next_local_offset = -20
-        return Environment(locals, next_local_offset)
-
-    def emit(self, env:Environment):
-        if len(self.paramenters) > 4:
-            raise Exception('More than 4 parameters not supported')
-        super().emit('')
-        super().emit(f'.global {self.name}')
-        super().emit(f'{self.name}:')
-        self.emit_prologue()
-        env = self.set_environment()
+            if i >= 4:
+                locals[parameter] = self.stack_parameter_offset(i)
+            elif f'r{i}' in registers:
+                locals[parameter] = 4 * (pushed.index(f'r{i}') - len(pushed))
+        local_slots = [4 * (i - len(pushed)) for i, register in enumerate(pushed) if register not in registers]
+        frame_size = align(4 * max(var_count - len(local_slots), 0))
+        local_slots += [-4 * len(pushed) - 4 * (i + 1) for i in range(frame_size // 4)]
+        return Environment(locals, local_slots, output, label_prefix=f'{self.name}_', function_name=self.name,
+                           argument_registers=pushed, frame_size=frame_size)
+
+    def emit_steps(self, env:Environment):
+        yield ''
+        yield f'.global {self.name}'
+        yield f'{self.name}:'
+        # The body has an environment of its own, functions do not nest deep enough to need a step for it
+        env = self.set_environment(env.output)
+        self.emit_prologue(env)
         self.body.emit(env)
-        self.emit_epilogue()
+        self.emit_epilogue(env)
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.name},{[param for param in self.paramenters]},{self.body})'
 
 class Var(AST):
+    __slots__ = ('name', 'value')
+
     def __init__(self, name:str, value:AST):
         self.name = name
         self.value = value
     
-    def emit(self, env:Environment):
-        self.value.emit(env)
-        super().emit('push {r0, ip}')
-        env.locals[self.name] = env.next_local_offset - 4
-        env.next_local_offset -= 8
+    def emit_steps(self, env:Environment):
+        yield self.value
+        # Slots come from the layout of the enclosing function, top-level statements have no frame
+        offset = next(env.local_slots, None)
+        if offset is None:
+            raise Exception(self.located('Variables must be declared inside a function'))
+        yield f'str r0, [fp, #{offset}]'
+        env.locals[self.name] = offset
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.name},{self.value})'
 
 class Assign(AST):
+    __slots__ = ('name', 'value')
+
     def __init__(self, name:str, value:AST):
         self.name = name
         self.value = value
 
-    def emit(self, env:Environment):
-        self.value.emit(env)
+    def emit_steps(self, env:Environment):
+        yield self.value
         try:
             offset = env.locals[self.name]
-            super().emit(f'str r0, [fp, #{offset}]')
         except KeyError:
-            raise Exception(f'Undefined variable: {self.name}')
+            raise Exception(self.located(f'Undefined variable: {self.name}'))
+        yield f'str r0, [fp, #{offset}]'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.name},{self.value})'
 
 class While(AST):
+    __slots__ = ('conditional', 'body')
+
     def __init__(self, conditional:AST, body:AST):
         self.conditional = conditional
         self.body = body
 
-    def emit(self, env:Environment):
-        loop_start = get_label_index()
-        loop_end = get_label_index()
+    def emit_steps(self, env:Environment):
+        loop_start = get_label_index(env)
+        loop_end = get_label_index(env)
 
-        super().emit(f'{loop_start}:')
-        self.conditional.emit(env)
-        super().emit('cmp r0, #0')
-        super().emit(f'beq {loop_end}')
-        self.body.emit(env)
-        super().emit(f'b {loop_start}')
-        super().emit(f'{loop_end}:')
+        yield f'{loop_start}:'
+        yield from self.conditional.branch_steps(env, None, loop_end)
+        yield self.body
+        yield f'b {loop_start}'
+        yield f'{loop_end}:'
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.conditional},{self.body})'
 
-if __name__ == '__main__':
-    main = Main([])
-    main.emit()
\ No newline at end of file
+class RotatedWhile(While):
+    # Tests the condition at the bottom and enters through a branch to the test, so an
+    # iteration takes one branch instead of two
+    __slots__ = ()
+
+    def emit_steps(self, env:Environment):
+        loop_start = get_label_index(env)
+        loop_test = get_label_index(env)
+
+        yield f'b {loop_test}'
+        yield f'{loop_start}:'
+        yield self.body
+        yield f'{loop_test}:'
+        yield from self.conditional.branch_steps(env, loop_start, None)
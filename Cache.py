@@ -0,0 +1,65 @@
+import glob
+import hashlib
+import os
+
+def compiler_version() -> str:
+    # Any change to the compiler sources invalidates every cached fragment
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+class CompilationCache:
+    def __init__(self, directory:str = './.cache', max_size:int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.version = compiler_version()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, function, options:str) -> str:
+        return hashlib.sha256(f'{self.version}\n{options}\n{function!r}'.encode()).hexdigest()
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, f'{key}.s')
+
+    def get(self, key:str) -> list[str] | None:
+        path = self.path(key)
+        try:
+            with open(path, 'r') as file:
+                lines = file.read().split('\n')[:-1]
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # The modification time doubles as the last use for LRU eviction
+        os.utime(path)
+        self.hits += 1
+        return lines
+
+    def put(self, key:str, lines:list[str]):
+        path = self.path(key)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as file:
+            file.write(''.join(f'{line}\n' for line in lines))
+        os.replace(temporary, path)
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.s')):
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
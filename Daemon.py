@@ -0,0 +1,71 @@
+import json
+import os
+import socketserver
+import sys
+import time
+from Cache import CompilationCache
+from main import compile_source, compile_file, assembly_path
+
+# A long running compiler: one JSON job per line in, one JSON result per line out.
+# A job names either a 'file' (written to 'output' or next to it) or carries the 'source' itself.
+
+class Daemon:
+    def __init__(self, optimization_level:int = 0, backend:str = 'stack', cache:CompilationCache = None, divide:str = 'hardware'):
+        self.optimization_level = optimization_level
+        self.backend = backend
+        self.cache = cache
+        self.divide = divide
+
+    def handle(self, job:dict) -> dict:
+        start = time.perf_counter()
+        result = {'id': job.get('id')}
+        optimization_level = job.get('optimization_level', self.optimization_level)
+        backend = job.get('backend', self.backend)
+        divide = job.get('divide', self.divide)
+        try:
+            if 'source' in job:
+                result['assembly'] = compile_source(job['source'], optimization_level=optimization_level, backend=backend, cache=self.cache, divide=divide)
+            else:
+                output_path = job.get('output') or assembly_path(job['file'])
+                compile_file(job['file'], output_path, optimization_level, backend, cache=self.cache, divide=divide)
+                result['output'] = output_path
+            result['ok'] = True
+        except Exception as e:
+            result['ok'] = False
+            result['error'] = str(e)
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    def serve_lines(self, lines, write):
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                result = {'id': None, 'ok': False, 'error': f'Invalid job: {e}'}
+            else:
+                result = self.handle(job)
+            write(json.dumps(result) + '\n')
+
+    def serve_stdin(self):
+        def write(text:str):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        self.serve_lines(sys.stdin, write)
+
+    def serve_socket(self, path:str):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                lines = (line.decode() for line in self.rfile)
+                daemon.serve_lines(lines, lambda text: self.wfile.write(text.encode()))
+
+        if os.path.exists(path):
+            os.remove(path)
+        with socketserver.UnixStreamServer(path, Handler) as server:
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(path)
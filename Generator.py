@@ -0,0 +1,84 @@
+import random
+
+# Seeded generator of valid, terminating programs for benchmarks. Every loop counts up to a
+# fixed bound and only odd functions make calls, always to even functions that make none,
+# so running a generated program stays cheap however many functions it has.
+
+class ProgramGenerator:
+    def __init__(self, seed:int = 0, functions:int = 10, depth:int = 8, loop_length:int = 10, variables:int = 4):
+        self.random = random.Random(seed)
+        self.functions = functions
+        self.depth = depth
+        self.loop_length = loop_length
+        self.variables = variables
+        self.defined = []
+        self.leaves = []
+
+    def leaf(self, names:list[str]) -> str:
+        if names and self.random.random() < 0.6:
+            return self.random.choice(names)
+        return str(self.random.randint(0, 100))
+
+    def expression(self, names:list[str], depth:int, calls:bool = True) -> str:
+        # One operand of every operator is a leaf so the size grows linearly with depth
+        if depth <= 0:
+            return self.leaf(names)
+        choice = self.random.random()
+        if calls and self.leaves and choice < 0.05:
+            name, arity = self.random.choice(self.leaves)
+            arguments = ', '.join(self.expression(names, depth // 4, False) for _ in range(arity))
+            return f'{name}({arguments})'
+        if choice < 0.1:
+            return f'!({self.expression(names, depth - 1, calls)})'
+        operator = self.random.choice(['+', '-', '*', '+', '-', '==', '!='])
+        inner = self.expression(names, depth - 1, calls)
+        if self.random.random() < 0.5:
+            return f'({self.leaf(names)} {operator} {inner})'
+        return f'({inner} {operator} {self.leaf(names)})'
+
+    def statement(self, names:list[str], indent:str, calls:bool) -> str:
+        choice = self.random.random()
+        if choice < 0.5 and names:
+            return f'{indent}{self.random.choice(names)} = {self.expression(names, self.depth, calls)};\n'
+        if choice < 0.7:
+            return (f'{indent}if ({self.expression(names, self.depth // 2, calls)}) {{\n'
+                    f'{self.statement(names, indent + "    ", calls)}'
+                    f'{indent}}} else {{\n'
+                    f'{self.statement(names, indent + "    ", calls)}'
+                    f'{indent}}}\n')
+        return f'{indent}putchar({self.expression(names, self.depth // 2, False)});\n'
+
+    def function(self, index:int) -> str:
+        name = f'f{index}'
+        calls = index % 2 == 1
+        parameters = [f'p{i}' for i in range(self.random.randint(0, 4))]
+        names = list(parameters)
+        lines = [f'function {name}({", ".join(parameters)}) {{\n']
+        for i in range(self.variables):
+            lines.append(f'    var v{i} = {self.expression(names, self.depth, calls)};\n')
+            names.append(f'v{i}')
+
+        counter = f'i{index}'
+        lines.append(f'    var {counter} = 0;\n')
+        lines.append(f'    while ({counter} != {self.loop_length}) {{\n')
+        for _ in range(self.loop_length):
+            lines.append(self.statement(names, '        ', calls))
+        lines.append(f'        {counter} = {counter} + 1;\n')
+        lines.append('    }\n')
+        lines.append(f'    return {self.expression(names, self.depth, calls)};\n')
+        lines.append('}\n\n')
+        self.defined.append((name, len(parameters)))
+        if not calls:
+            self.leaves.append((name, len(parameters)))
+        return ''.join(lines)
+
+    def program(self) -> str:
+        functions = [self.function(i) for i in range(self.functions)]
+        calls = ''.join(f'    {name}({", ".join(["1"] * arity)});\n' for name, arity in self.defined[-3:])
+        return ''.join(functions) + f'function main() {{\n{calls}}}\n'
+
+def generate_program(seed:int = 0, functions:int = 10, depth:int = 8, loop_length:int = 10, variables:int = 4) -> str:
+    return ProgramGenerator(seed, functions, depth, loop_length, variables).program()
+
+if __name__ == '__main__':
+    print(generate_program())
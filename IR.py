@@ -0,0 +1,254 @@
+from AST import *
+from Optimizer import to_int32
+from Registers import RIGHT_FIRST, has_call
+from collections import Counter
+
+# A three address form of a function: instructions read and write numbered virtual registers,
+# and are grouped into basic blocks that end in one terminator. Every function is built into
+# its own ControlFlowGraph, improved by the passes in IRPasses.py and lowered by Lowering.py.
+#
+#   const d, value          copy d, a               arg d, index
+#   add/sub/mul/udiv d, a, b                        eq/ne/lt/gt d, a, b (signed, 0 or 1)
+#   not d, a                mulc d, a, constant     lsr d, a, amount
+#   umulh d, a, b (high word of the unsigned product)
+#   call d, callee, arguments...
+# Terminators:
+#   jump block              branch a, true block, false block
+#   ret a                   tailcall callee, arguments...
+
+BINARY_OPCODES = {
+    Add: 'add',
+    Subtract: 'sub',
+    Multiply: 'mul',
+    Divide: 'udiv',
+    Equal: 'eq',
+    NotEqual: 'ne',
+    Less: 'lt',
+    Greater: 'gt',
+}
+
+COMPARISONS = ('eq', 'ne', 'lt', 'gt')
+TERMINATORS = ('jump', 'branch', 'ret', 'tailcall')
+
+class Instruction:
+    def __init__(self, opcode:str, dest:int = None, arguments:list[int] = [], value = None, targets:list['BasicBlock'] = []):
+        self.opcode = opcode
+        self.dest = dest
+        self.arguments = list(arguments)
+        # The constant, callee, argument index or shift that is not a register
+        self.value = value
+        self.targets = list(targets)
+
+    def __repr__(self):
+        operands = [f'v{argument}' for argument in self.arguments]
+        if self.value is not None:
+            operands.insert(0, str(self.value))
+        operands += [target.label for target in self.targets]
+        dest = f'v{self.dest} = ' if self.dest is not None else ''
+        return f'{dest}{self.opcode} {", ".join(operands)}'.rstrip()
+
+class BasicBlock:
+    def __init__(self, label:str):
+        self.label = label
+        self.instructions = []
+        self.terminator = None
+
+    def successors(self) -> list['BasicBlock']:
+        return self.terminator.targets if self.terminator is not None else []
+
+    def __repr__(self):
+        lines = [f'{self.label}:'] + [f'    {instruction}' for instruction in self.instructions]
+        if self.terminator is not None:
+            lines.append(f'    {self.terminator}')
+        return '\n'.join(lines)
+
+class ControlFlowGraph:
+    def __init__(self, name:str, parameter_count:int):
+        self.name = name
+        self.parameter_count = parameter_count
+        # In layout order, the first block is the entry
+        self.blocks = []
+        self.block_count = 0
+        self.register_count = 0
+
+    def new_register(self) -> int:
+        self.register_count += 1
+        return self.register_count
+
+    def new_block(self) -> BasicBlock:
+        # Placed in the layout by whoever fills it
+        block = BasicBlock(f'b{self.block_count}')
+        self.block_count += 1
+        return block
+
+    def predecessors(self) -> dict[BasicBlock, list[BasicBlock]]:
+        predecessors = {block: [] for block in self.blocks}
+        for block in self.blocks:
+            for successor in block.successors():
+                predecessors[successor].append(block)
+        return predecessors
+
+    def instructions(self):
+        for block in self.blocks:
+            yield from block.instructions
+            yield block.terminator
+
+    def definition_counts(self) -> Counter:
+        return Counter(instruction.dest for instruction in self.instructions() if instruction.dest is not None)
+
+    def use_counts(self) -> Counter:
+        return Counter(argument for instruction in self.instructions() for argument in instruction.arguments)
+
+    def liveness(self) -> tuple[dict, dict]:
+        # Registers live on entry to and on exit from every block, iterated to a fixed point
+        uses, definitions = {}, {}
+        for block in self.blocks:
+            used, defined = set(), set()
+            for instruction in block.instructions + [block.terminator]:
+                used.update(argument for argument in instruction.arguments if argument not in defined)
+                if instruction.dest is not None:
+                    defined.add(instruction.dest)
+            uses[block], definitions[block] = used, defined
+        live_in = {block: set() for block in self.blocks}
+        live_out = {block: set() for block in self.blocks}
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(self.blocks):
+                out = set().union(*(live_in[successor] for successor in block.successors()))
+                entry = uses[block] | (out - definitions[block])
+                if out != live_out[block] or entry != live_in[block]:
+                    live_out[block], live_in[block] = out, entry
+                    changed = True
+        return live_in, live_out
+
+    def __repr__(self):
+        return f'{self.name}({self.parameter_count}):\n' + '\n'.join(repr(block) for block in self.blocks)
+
+class Builder:
+    # Variables are resolved by name as the stack backend resolves them: a var takes a new
+    # register that the reads after it refer to, and assignments copy into that register
+    def __init__(self, function:Function):
+        self.function = function
+        self.graph = ControlFlowGraph(function.name, len(function.paramenters))
+        self.start(self.graph.new_block())
+        self.locals = {}
+        for i, parameter in enumerate(function.paramenters):
+            self.locals[parameter] = self.emit('arg', value=i)
+
+    def build(self) -> ControlFlowGraph:
+        self.statement(self.function.body)
+        # Falling off the end returns 0
+        self.terminate('ret', [self.emit('const', value=0)])
+        return self.graph
+
+    def emit(self, opcode:str, arguments:list[int] = [], value = None) -> int:
+        dest = self.graph.new_register()
+        self.block.instructions.append(Instruction(opcode, dest, arguments, value))
+        return dest
+
+    def terminate(self, opcode:str, arguments:list[int] = [], value = None, targets:list[BasicBlock] = []):
+        self.block.terminator = Instruction(opcode, None, arguments, value, targets)
+
+    def start(self, block:BasicBlock):
+        # Blocks are laid out in the order they are filled, so code follows the source
+        self.graph.blocks.append(block)
+        self.block = block
+
+    def statement(self, node:AST):
+        if isinstance(node, Block):
+            for statement in node.statements:
+                self.statement(statement)
+        elif isinstance(node, Var):
+            value = self.expression(node.value)
+            register = self.graph.new_register()
+            self.block.instructions.append(Instruction('copy', register, [value]))
+            self.locals[node.name] = register
+        elif isinstance(node, Assign):
+            value = self.expression(node.value)
+            self.block.instructions.append(Instruction('copy', self.lookup(node, node.name), [value]))
+        elif isinstance(node, If):
+            consequence, alternative, end = self.graph.new_block(), self.graph.new_block(), self.graph.new_block()
+            self.terminate('branch', [self.expression(node.conditional)], targets=[consequence, alternative])
+            self.start(consequence)
+            self.statement(node.consequence)
+            self.terminate('jump', targets=[end])
+            self.start(alternative)
+            self.statement(node.alternative)
+            self.terminate('jump', targets=[end])
+            self.start(end)
+        elif isinstance(node, While):
+            # Tested at the bottom, like RotatedWhile
+            body, test, end = self.graph.new_block(), self.graph.new_block(), self.graph.new_block()
+            self.terminate('jump', targets=[test])
+            self.start(body)
+            self.statement(node.body)
+            self.terminate('jump', targets=[test])
+            self.start(test)
+            self.terminate('branch', [self.expression(node.conditional)], targets=[body, end])
+            self.start(end)
+        elif isinstance(node, Return):
+            self.terminate('ret', [self.expression(node.term)])
+            # Anything after a return is unreachable, its block is dropped by simplify_cfg
+            self.start(self.graph.new_block())
+        elif isinstance(node, TailCall):
+            arguments = [self.expression(argument) for argument in node.arguments]
+            if len(arguments) > 4:
+                self.terminate('ret', [self.emit('call', arguments, node.callee)])
+            else:
+                self.terminate('tailcall', arguments, node.callee)
+            self.start(self.graph.new_block())
+        elif isinstance(node, Function):
+            raise Exception(node.located('Functions cannot be nested'))
+        else:
+            self.expression(node)
+
+    def expression(self, node:AST) -> int:
+        if isinstance(node, Number):
+            return self.emit('const', value=to_int32(node.value))
+        if isinstance(node, Id):
+            return self.lookup(node, node.value)
+        if isinstance(node, Not):
+            return self.emit('not', [self.expression(node.term)])
+        if isinstance(node, MultiplyByConstant):
+            return self.emit('mulc', [self.expression(node.term)], node.constant)
+        if isinstance(node, DivideByConstant):
+            return self.divide_by_constant(self.expression(node.term), node.divisor)
+        if isinstance(node, DivideCall):
+            left, right = node.arguments
+            if has_call(left) and has_call(right):
+                right = self.expression(right)
+                return self.emit('call', [self.expression(left), right], node.callee)
+            return self.emit('call', [self.expression(argument) for argument in node.arguments], node.callee)
+        if isinstance(node, Call):
+            return self.emit('call', [self.expression(argument) for argument in node.arguments], node.callee)
+        if type(node) in BINARY_OPCODES:
+            # Calls are evaluated in the order the stack backend evaluates them
+            if isinstance(node, RIGHT_FIRST) and has_call(node.left) and has_call(node.right):
+                right = self.expression(node.right)
+                left = self.expression(node.left)
+            else:
+                left = self.expression(node.left)
+                right = self.expression(node.right)
+            return self.emit(BINARY_OPCODES[type(node)], [left, right])
+        raise Exception(node.located(f'Cannot build {node.__class__.__name__}'))
+
+    def divide_by_constant(self, register:int, divisor:int) -> int:
+        # The steps of reciprocal_lines, one instruction each
+        if divisor & (divisor - 1) == 0:
+            return self.emit('lsr', [register], divisor.bit_length() - 1)
+        multiplier, shift, fixup = reciprocal(divisor)
+        high = self.emit('umulh', [register, self.emit('const', value=to_int32(multiplier))])
+        if fixup:
+            difference = self.emit('lsr', [self.emit('sub', [register, high])], 1)
+            high = self.emit('add', [high, difference])
+        return self.emit('lsr', [high], shift) if shift else high
+
+    def lookup(self, node:AST, name:str) -> int:
+        try:
+            return self.locals[name]
+        except KeyError:
+            raise Exception(node.located(f'Undefined variable: {name}'))
+
+def build(function:Function) -> ControlFlowGraph:
+    return Builder(function).build()
@@ -0,0 +1,189 @@
+import time
+from collections import Counter
+from IR import *
+from Optimizer import MASK, to_int32
+
+# Passes over a ControlFlowGraph, each changes the graph in place. They run in the order of
+# PASSES through a PassManager, which keeps the time every pass took.
+
+FOLDS = {
+    'copy': lambda a: a,
+    'not': lambda a: int(a == 0),
+    'add': lambda a, b: a + b,
+    'sub': lambda a, b: a - b,
+    'mul': lambda a, b: a * b,
+    'udiv': lambda a, b: (a & MASK) // (b & MASK) if b & MASK else 0,
+    'umulh': lambda a, b: (a & MASK) * (b & MASK) >> 32,
+    'eq': lambda a, b: int(a == b),
+    'ne': lambda a, b: int(a != b),
+    'lt': lambda a, b: int(a < b),
+    'gt': lambda a, b: int(a > b),
+}
+
+# Folds taking the instruction's value as their second operand
+VALUE_FOLDS = {
+    'mulc': lambda a, constant: a * constant,
+    'lsr': lambda a, amount: (a & MASK) >> amount,
+}
+
+def fold(instruction:Instruction, known:dict[int, int]):
+    arguments = [known[argument] for argument in instruction.arguments]
+    if instruction.opcode in VALUE_FOLDS:
+        return to_int32(VALUE_FOLDS[instruction.opcode](*arguments, instruction.value))
+    return to_int32(FOLDS[instruction.opcode](*arguments))
+
+def simplify_cfg(graph:ControlFlowGraph):
+    changed = True
+    while changed:
+        changed = False
+        uses = graph.use_counts()
+        for block in graph.blocks:
+            terminator = block.terminator
+            if terminator.opcode != 'branch':
+                continue
+            # A branch on a not just computed branches on its operand the other way round
+            last = block.instructions[-1] if block.instructions else None
+            if last is not None and last.opcode == 'not' and last.dest == terminator.arguments[0] and uses[last.dest] == 1:
+                terminator.arguments = list(last.arguments)
+                terminator.targets.reverse()
+                block.instructions.pop()
+                changed = True
+            if terminator.targets[0] is terminator.targets[1]:
+                block.terminator = Instruction('jump', targets=terminator.targets[:1])
+                changed = True
+
+        # Jumps to an empty block that only jumps go straight to where it jumps
+        entry = graph.blocks[0]
+        forwards = {block: block.terminator.targets[0] for block in graph.blocks
+                    if block is not entry and not block.instructions and block.terminator.opcode == 'jump' and block.terminator.targets[0] is not block}
+        for block in graph.blocks:
+            targets = []
+            for target in block.terminator.targets:
+                seen = set()
+                while target in forwards and target not in seen:
+                    seen.add(target)
+                    target = forwards[target]
+                targets.append(target)
+            if targets != block.terminator.targets:
+                block.terminator.targets = targets
+                changed = True
+
+        reachable, stack = set(), [entry]
+        while stack:
+            block = stack.pop()
+            if block not in reachable:
+                reachable.add(block)
+                stack.extend(block.successors())
+        if len(reachable) != len(graph.blocks):
+            graph.blocks = [block for block in graph.blocks if block in reachable]
+            changed = True
+
+        # A block only reached by a jump from its single predecessor joins it
+        predecessors = graph.predecessors()
+        merged = set()
+        for block in graph.blocks:
+            if block in merged:
+                continue
+            while block.terminator.opcode == 'jump':
+                successor = block.terminator.targets[0]
+                if successor is entry or successor is block or predecessors[successor] != [block]:
+                    break
+                block.instructions += successor.instructions
+                block.terminator = successor.terminator
+                merged.add(successor)
+        if merged:
+            graph.blocks = [block for block in graph.blocks if block not in merged]
+            changed = True
+
+def propagate_constants(graph:ControlFlowGraph):
+    # Registers written once by a const hold it everywhere, others until written again
+    definitions = graph.definition_counts()
+    constants = {instruction.dest: instruction.value for instruction in graph.instructions()
+                 if instruction.opcode == 'const' and definitions[instruction.dest] == 1}
+    for block in graph.blocks:
+        known = dict(constants)
+        for instruction in block.instructions:
+            if (instruction.opcode in FOLDS or instruction.opcode in VALUE_FOLDS) and all(argument in known for argument in instruction.arguments):
+                instruction.value = fold(instruction, known)
+                instruction.opcode, instruction.arguments = 'const', []
+            if instruction.opcode == 'const':
+                known[instruction.dest] = instruction.value
+                if definitions[instruction.dest] == 1:
+                    constants[instruction.dest] = instruction.value
+            elif instruction.dest is not None:
+                known.pop(instruction.dest, None)
+        terminator = block.terminator
+        if terminator.opcode == 'branch' and terminator.arguments[0] in known:
+            target = terminator.targets[0] if known[terminator.arguments[0]] else terminator.targets[1]
+            block.terminator = Instruction('jump', targets=[target])
+
+def propagate_copies(graph:ControlFlowGraph):
+    # A copy written once from a register written once earlier in the same block is that
+    # register everywhere: whenever the source is written again the copy follows it
+    definitions = graph.definition_counts()
+    replacements = {}
+    for block in graph.blocks:
+        defined = set()
+        for instruction in block.instructions:
+            if instruction.opcode == 'copy' and definitions[instruction.dest] == 1 and definitions[instruction.arguments[0]] == 1 and instruction.arguments[0] in defined:
+                source = instruction.arguments[0]
+                replacements[instruction.dest] = replacements.get(source, source)
+            if instruction.dest is not None:
+                defined.add(instruction.dest)
+
+    for block in graph.blocks:
+        # Other copies only within their block, until either side is written again
+        copies = {}
+        for instruction in block.instructions + [block.terminator]:
+            instruction.arguments = [copies.get(argument, replacements.get(argument, argument)) for argument in instruction.arguments]
+            if instruction.dest is None:
+                continue
+            copies = {dest: source for dest, source in copies.items() if instruction.dest not in (dest, source)}
+            if instruction.opcode == 'copy' and instruction.arguments[0] != instruction.dest:
+                copies[instruction.dest] = instruction.arguments[0]
+
+def eliminate_dead_code(graph:ControlFlowGraph):
+    changed = True
+    while changed:
+        changed = False
+        _, live_out = graph.liveness()
+        for block in graph.blocks:
+            live = live_out[block] | set(block.terminator.arguments)
+            kept = []
+            for instruction in reversed(block.instructions):
+                dead = instruction.dest is not None and instruction.dest not in live
+                if instruction.opcode == 'call':
+                    # Calls stay for what they do, only their result is dropped
+                    if dead:
+                        instruction.dest = None
+                elif dead or (instruction.opcode == 'copy' and instruction.arguments[0] == instruction.dest):
+                    changed = True
+                    continue
+                live.discard(instruction.dest)
+                live.update(instruction.arguments)
+                kept.append(instruction)
+            block.instructions = kept[::-1]
+
+PASSES = [
+    ('simplify_cfg', simplify_cfg),
+    ('propagate_copies', propagate_copies),
+    ('propagate_constants', propagate_constants),
+    ('simplify_cfg', simplify_cfg),
+    ('eliminate_dead_code', eliminate_dead_code),
+]
+
+class PassManager:
+    def __init__(self, passes:list[tuple] = PASSES):
+        self.passes = passes
+        # Seconds spent in every pass, summed over the graphs run
+        self.timings = Counter()
+
+    def run(self, graph:ControlFlowGraph) -> ControlFlowGraph:
+        for name, function in self.passes:
+            self.run_pass(name, function, graph)
+        return graph
+
+    def run_pass(self, name:str, function, graph:ControlFlowGraph):
+        start = time.perf_counter()
+        function(graph)
+        self.timings[name] += time.perf_counter() - start
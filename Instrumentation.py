@@ -0,0 +1,166 @@
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from AST import AST, Output
+from IRPasses import PassManager
+from Lexer import Lexer
+from Optimizer import Inliner, walk
+
+# Counters are collected by wrapping the hot methods only while installed,
+# so a compile without instrumentation runs the original, unwrapped code.
+
+def all_subclasses(cls) -> list:
+    subclasses = []
+    for subclass in cls.__subclasses__():
+        subclasses.append(subclass)
+        subclasses.extend(all_subclasses(subclass))
+    return subclasses
+
+def no_phase(name:str):
+    return nullcontext()
+
+class Instrumentation:
+    def __init__(self):
+        self.phases = Counter()
+        self.tokens = 0
+        self.labels = 0
+        self.nodes = Counter()
+        self.optimized_nodes = Counter()
+        self.inlined_calls = 0
+        self.instructions = Counter()
+        self.peephole = Counter()
+        self.originals = []
+        self.emitting = []
+
+    @contextmanager
+    def phase(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def count_nodes(self, tree:AST):
+        self.nodes.update(node.__class__.__name__ for node in walk(tree))
+
+    def count_optimized_nodes(self, tree:AST):
+        self.optimized_nodes.update(node.__class__.__name__ for node in walk(tree))
+
+    def patch(self, owner, name:str, replacement):
+        self.originals.append((owner, name, owner.__dict__[name]))
+        setattr(owner, name, replacement)
+
+    def install(self):
+        instrumentation = self
+        scan_span = Lexer._scan_span
+        def counted_scan_span(lexer, pos:int):
+            start = time.perf_counter()
+            span = scan_span(lexer, pos)
+            instrumentation.phases['lex'] += time.perf_counter() - start
+            instrumentation.tokens += 1
+            return span
+        self.patch(Lexer, '_scan_span', counted_scan_span)
+
+        # IR passes run while functions are emitted, each pass is timed as a phase of its own
+        run_pass = PassManager.run_pass
+        def timed_run_pass(manager, name:str, function, graph):
+            start = time.perf_counter()
+            run_pass(manager, name, function, graph)
+            instrumentation.phases[f'ir.{name}'] += time.perf_counter() - start
+        self.patch(PassManager, 'run_pass', timed_run_pass)
+
+        inline = Inliner.inline
+        def counted_inline(inliner, call, bind:bool = True):
+            inlined = inline(inliner, call, bind)
+            if inlined is not None:
+                instrumentation.inlined_calls += 1
+            return inlined
+        self.patch(Inliner, 'inline', counted_inline)
+
+        # Lines written outside of any emit, like the register backend's dry runs, are not counted.
+        # Local labels are counted as they are written, so those Lowering numbers itself count too.
+        output_emit = Output.emit
+        emitting = self.emitting
+        def counted_output_emit(output, content:str):
+            if emitting and content:
+                if content.endswith(':'):
+                    if content.startswith('.L'):
+                        instrumentation.labels += 1
+                elif not content.startswith('.'):
+                    instrumentation.instructions[emitting[-1]] += 1
+            output_emit(output, content)
+        self.patch(Output, 'emit', counted_output_emit)
+
+        # Instructions are attributed to the innermost node being emitted
+        for cls in all_subclasses(AST):
+            if 'emit' in cls.__dict__:
+                self.patch(cls, 'emit', self.wrap_emit(cls.__name__, cls.__dict__['emit']))
+            if 'emit_steps' in cls.__dict__:
+                self.patch(cls, 'emit_steps', self.wrap_emit_steps(cls.__name__, cls.__dict__['emit_steps']))
+
+    def wrap_emit(self, name:str, emit):
+        emitting = self.emitting
+        def counted_emit(node, env):
+            emitting.append(name)
+            try:
+                return emit(node, env)
+            finally:
+                emitting.pop()
+        return counted_emit
+
+    def wrap_emit_steps(self, name:str, emit_steps):
+        # A node is innermost while its steps run and while its lines are written,
+        # but not while a child it yielded is being expanded
+        emitting = self.emitting
+        def counted_emit_steps(node, env):
+            emitting.append(name)
+            try:
+                for step in emit_steps(node, env):
+                    if isinstance(step, AST):
+                        emitting.pop()
+                        try:
+                            yield step
+                        finally:
+                            emitting.append(name)
+                    else:
+                        yield step
+            finally:
+                emitting.pop()
+        return counted_emit_steps
+
+    def uninstall(self):
+        while self.originals:
+            owner, name, original = self.originals.pop()
+            setattr(owner, name, original)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def to_dict(self) -> dict:
+        phases = dict(self.phases)
+        # Lexing happens lazily while parsing, keep the two apart
+        if 'parse' in phases:
+            phases['parse'] -= phases.get('lex', 0)
+        # and so do the IR passes while emitting
+        if 'emit' in phases:
+            phases['emit'] -= sum(seconds for name, seconds in phases.items() if name.startswith('ir.'))
+        return {
+            'phases': phases,
+            'tokens': self.tokens,
+            'labels': self.labels,
+            'nodes': dict(self.nodes.most_common()),
+            # Calls written in the source and calls left after -O 1 inlined some and dropped dead ones
+            'static_calls': {'parsed': self.nodes['Call'], 'optimized': self.optimized_nodes['Call'] + self.optimized_nodes['TailCall']},
+            'inlined_calls': self.inlined_calls,
+            'instructions': dict(self.instructions.most_common()),
+            'peephole': dict(self.peephole),
+        }
+
+    def dump(self, file):
+        json.dump(self.to_dict(), file, indent=2)
+        file.write('\n')
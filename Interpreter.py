@@ -0,0 +1,268 @@
+import sys
+from AST import *
+from Optimizer import is_pure
+
+# Runs programs on the host by compiling every node once into a Python closure. Variables are
+# resolved to slots of a per call frame list while compiling, so running does no name lookups.
+# Values are kept as signed 32 bit integers and wrap like the registers of the compiled code,
+# and operands with side effects are evaluated in the order the stack backend evaluates them.
+
+RECURSION_LIMIT = 1000000
+
+def wrap(value:int) -> int:
+    return ((value + 0x80000000) & 0xffffffff) - 0x80000000
+
+class Scope:
+    def __init__(self, parameters:list[str]):
+        self.slots = {name: i for i, name in enumerate(parameters)}
+        self.size = len(parameters)
+
+    def declare(self, name:str) -> int:
+        # Like the stack backend, a redeclaration gets a new slot that later reads resolve to
+        slot = self.size
+        self.slots[name] = slot
+        self.size += 1
+        return slot
+
+    def lookup(self, node:AST, name:str) -> int:
+        try:
+            return self.slots[name]
+        except KeyError:
+            raise Exception(node.located(f'Undefined variable: {name}'))
+
+class Interpreter:
+    def __init__(self, tree:AST, output=None):
+        self.output = output if output is not None else sys.stdout.buffer
+        self.buffer = bytearray()
+        # Each function is called through a one element list, filled once its body is compiled,
+        # so calls to functions defined later or recursively need no lookup at run time
+        self.functions = {'putchar': [self.putchar]}
+        definitions = [statement for statement in (tree.statements if isinstance(tree, Block) else [tree]) if isinstance(statement, Function)]
+        if len(definitions) != (len(tree.statements) if isinstance(tree, Block) else 1):
+            raise Exception('Only functions can be run')
+        for function in definitions:
+            self.functions[function.name] = [None]
+        self.arities = {function.name: len(function.paramenters) for function in definitions}
+        self.arities['putchar'] = 1
+        for function in definitions:
+            self.functions[function.name][0] = self.function(function)
+
+    def putchar(self, arguments:list[int]) -> int:
+        character = arguments[0] & 0xff
+        self.buffer.append(character)
+        return character
+
+    def run(self, entry:str = 'main', arguments:list[int] = []) -> int:
+        if entry not in self.functions:
+            raise Exception(f'Undefined function: {entry}')
+        # Every call level nests a few closures, deep recursion needs more than the default
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, RECURSION_LIMIT))
+        try:
+            return self.functions[entry][0](list(arguments) + [0] * (self.arities[entry] - len(arguments)))
+        finally:
+            sys.setrecursionlimit(limit)
+            self.flush()
+
+    def flush(self):
+        self.output.write(self.buffer)
+        self.output.flush()
+        self.buffer.clear()
+
+    def function(self, node:Function):
+        # Called with a new frame holding just the arguments, the locals are appended to it.
+        # Taking one list rather than *arguments keeps calls between closures off the C stack.
+        scope = Scope(node.paramenters)
+        body = self.statement(node.body, scope)
+        locals = [0] * (scope.size - len(node.paramenters))
+        def call(frame):
+            frame += locals
+            result = body(frame)
+            return 0 if result is None else result
+        return call
+
+    def statement(self, node:AST, scope:Scope):
+        # A statement returns None to continue, or the value of a return it ran
+        if isinstance(node, Block):
+            statements = [self.statement(statement, scope) for statement in node.statements]
+            if len(statements) == 1:
+                return statements[0]
+            def block(frame):
+                for statement in statements:
+                    result = statement(frame)
+                    if result is not None:
+                        return result
+            return block
+        if isinstance(node, Return):
+            term = self.expression(node.term, scope)
+            return term
+        if isinstance(node, TailCall):
+            return self.call(node, scope)
+        if isinstance(node, Var):
+            value = self.expression(node.value, scope)
+            slot = scope.declare(node.name)
+            def var(frame):
+                frame[slot] = value(frame)
+            return var
+        if isinstance(node, Assign):
+            value = self.expression(node.value, scope)
+            slot = scope.lookup(node, node.name)
+            def assign(frame):
+                frame[slot] = value(frame)
+            return assign
+        if isinstance(node, If):
+            condition = self.condition(node.conditional, scope)
+            consequence = self.statement(node.consequence, scope)
+            alternative = self.statement(node.alternative, scope)
+            def if_(frame):
+                if condition(frame):
+                    return consequence(frame)
+                return alternative(frame)
+            return if_
+        if isinstance(node, While):
+            condition = self.condition(node.conditional, scope)
+            body = self.statement(node.body, scope)
+            def while_(frame):
+                while condition(frame):
+                    result = body(frame)
+                    if result is not None:
+                        return result
+            return while_
+        if isinstance(node, Function):
+            raise Exception(node.located('Functions cannot be nested'))
+        # An expression statement, its value is dropped
+        expression = self.expression(node, scope)
+        def discard(frame):
+            expression(frame)
+        return discard
+
+    def condition(self, node:AST, scope:Scope):
+        # Branches only test for zero, so comparisons skip building a 0 or 1
+        if isinstance(node, Not):
+            term = self.condition(node.term, scope)
+            return lambda frame: not term(frame)
+        if isinstance(node, (Equal, NotEqual, Less, Greater)):
+            left, right = self.expression(node.left, scope), self.expression(node.right, scope)
+            if isinstance(node.right, Number):
+                # Loop conditions mostly compare against a constant
+                constant = wrap(node.right.value)
+                if isinstance(node, Equal):
+                    return lambda frame: left(frame) == constant
+                if isinstance(node, NotEqual):
+                    return lambda frame: left(frame) != constant
+                if isinstance(node, Less):
+                    return lambda frame: left(frame) < constant
+                return lambda frame: left(frame) > constant
+            if isinstance(node, Equal):
+                return lambda frame: left(frame) == right(frame)
+            if isinstance(node, NotEqual):
+                return lambda frame: left(frame) != right(frame)
+            if isinstance(node, Less):
+                return lambda frame: left(frame) < right(frame)
+            return lambda frame: left(frame) > right(frame)
+        return self.expression(node, scope)
+
+    def expression(self, node:AST, scope:Scope):
+        if isinstance(node, Number):
+            value = wrap(node.value)
+            return lambda frame: value
+        if isinstance(node, Id):
+            slot = scope.lookup(node, node.value)
+            return lambda frame: frame[slot]
+        if isinstance(node, Not):
+            term = self.expression(node.term, scope)
+            return lambda frame: 0 if term(frame) else 1
+        if isinstance(node, DivideCall):
+            return self.expression(Divide(*node.arguments), scope)
+        if isinstance(node, Call):
+            return self.call(node, scope)
+        if isinstance(node, MultiplyByConstant):
+            term, constant = self.expression(node.term, scope), node.constant
+            return lambda frame: ((term(frame) * constant + 0x80000000) & 0xffffffff) - 0x80000000
+        if isinstance(node, DivideByConstant):
+            term, divisor = self.expression(node.term, scope), node.divisor
+            return lambda frame: (((term(frame) & 0xffffffff) // divisor + 0x80000000) & 0xffffffff) - 0x80000000
+
+        left, right = self.expression(node.left, scope), self.expression(node.right, scope)
+        if isinstance(node, (Add, Subtract, Multiply, Divide)) and not is_pure(node.left) and not is_pure(node.right):
+            return self.right_first(node, left, right)
+        if isinstance(node, Add):
+            if isinstance(node.left, Id) and isinstance(node.right, Number):
+                # Counters: i + 1
+                slot, constant = scope.lookup(node.left, node.left.value), wrap(node.right.value)
+                return lambda frame: ((frame[slot] + constant + 0x80000000) & 0xffffffff) - 0x80000000
+            if isinstance(node.right, Number):
+                constant = wrap(node.right.value)
+                return lambda frame: ((left(frame) + constant + 0x80000000) & 0xffffffff) - 0x80000000
+            return lambda frame: ((left(frame) + right(frame) + 0x80000000) & 0xffffffff) - 0x80000000
+        if isinstance(node, Subtract):
+            if isinstance(node.right, Number):
+                constant = wrap(node.right.value)
+                return lambda frame: ((left(frame) - constant + 0x80000000) & 0xffffffff) - 0x80000000
+            return lambda frame: ((left(frame) - right(frame) + 0x80000000) & 0xffffffff) - 0x80000000
+        if isinstance(node, Multiply):
+            return lambda frame: ((left(frame) * right(frame) + 0x80000000) & 0xffffffff) - 0x80000000
+        if isinstance(node, Divide):
+            # udiv: unsigned, and dividing by zero gives zero
+            def divide(frame):
+                dividend, divisor = left(frame) & 0xffffffff, right(frame) & 0xffffffff
+                if not divisor:
+                    return 0
+                return ((dividend // divisor + 0x80000000) & 0xffffffff) - 0x80000000
+            return divide
+        if isinstance(node, Equal):
+            return lambda frame: 1 if left(frame) == right(frame) else 0
+        if isinstance(node, NotEqual):
+            return lambda frame: 1 if left(frame) != right(frame) else 0
+        if isinstance(node, Less):
+            return lambda frame: 1 if left(frame) < right(frame) else 0
+        if isinstance(node, Greater):
+            return lambda frame: 1 if left(frame) > right(frame) else 0
+        raise Exception(node.located(f'Cannot run {node.__class__.__name__}'))
+
+    def right_first(self, node:AST, left, right):
+        operation = type(node)
+        def evaluate(frame):
+            b = right(frame)
+            a = left(frame)
+            if operation is Add:
+                value = a + b
+            elif operation is Subtract:
+                value = a - b
+            elif operation is Multiply:
+                value = a * b
+            else:
+                value = (a & 0xffffffff) // (b & 0xffffffff) if b & 0xffffffff else 0
+            return ((value + 0x80000000) & 0xffffffff) - 0x80000000
+        return evaluate
+
+    def call(self, node:Call, scope:Scope):
+        if node.callee not in self.functions:
+            raise Exception(node.located(f'Undefined function: {node.callee}'))
+        target = self.functions[node.callee]
+        arguments = [self.expression(argument, scope) for argument in node.arguments]
+        # Missing arguments read as zero and extra ones are evaluated but not passed
+        arity = self.arities[node.callee]
+        if len(arguments) < arity:
+            arguments += [lambda frame: 0] * (arity - len(arguments))
+        if len(arguments) > arity:
+            extra, arguments = arguments[arity:], arguments[:arity]
+            passed = arguments
+            def call(frame):
+                values = [argument(frame) for argument in passed]
+                for argument in extra:
+                    argument(frame)
+                return target[0](values)
+            return call
+        if arity == 0:
+            return lambda frame: target[0]([])
+        if arity == 1:
+            first, = arguments
+            return lambda frame: target[0]([first(frame)])
+        if arity == 2:
+            first, second = arguments
+            return lambda frame: target[0]([first(frame), second(frame)])
+        return lambda frame: target[0]([argument(frame) for argument in arguments])
+
+def run_tree(tree:AST, output=None, entry:str = 'main') -> int:
+    return Interpreter(tree, output).run(entry)
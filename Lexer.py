@@ -1,4 +1,6 @@
 import re
+from array import array
+from bisect import bisect_right
 from enum import StrEnum, auto
 from AST import *
 
@@ -9,6 +11,8 @@ class TokenType(StrEnum):
     ASSIGN = auto()
     EQUAL = auto()
     NOTEQUAL = auto()
+    LESS = auto()
+    GREATER = auto()
     PLUS = auto()
     MINUS = auto()
     STAR = auto()
@@ -26,117 +30,270 @@ class TokenType(StrEnum):
     WHILE = auto()
     COMMA = auto()
 
+# Small integer code per token type, used by the compact token store
+TOKEN_TYPES = [*TokenType, 'EOF']
+TOKEN_CODES = {token_type: code for code, token_type in enumerate(TOKEN_TYPES)}
+EOF_CODE = TOKEN_CODES['EOF']
+
+def decode(text:str | bytes) -> str:
+    return text if isinstance(text, str) else text.decode('utf-8', 'replace')
+
+class LineIndex:
+    # Offsets at which the lines of a source start, built once so that resolving
+    # a position is a binary search rather than a rescan of the source
+    def __init__(self, text:str | bytes):
+        self.text = text
+        self.starts = array('I', [0])
+        self.starts.extend(match.end() for match in re.finditer('\n' if isinstance(text, str) else b'\n', text))
+
+    def location(self, offset:int) -> tuple[int, int]:
+        # 1-based line and column of an offset
+        line = bisect_right(self.starts, offset)
+        return line, offset - self.starts[line - 1] + 1
+
+    def span(self, start:int, end:int) -> 'Span':
+        return Span(*self.location(start), *self.location(end))
+
+    def line_text(self, line:int) -> str:
+        start = self.starts[line - 1]
+        end = self.starts[line] - 1 if line < len(self.starts) else len(self.text)
+        return decode(self.text[start:end])
+
+class Span:
+    # Where a token or node starts and ends, the end column is one past its last character
+    __slots__ = ('line', 'column', 'end_line', 'end_column')
+
+    def __init__(self, line:int, column:int, end_line:int, end_column:int):
+        self.line = line
+        self.column = column
+        self.end_line = end_line
+        self.end_column = end_column
+
+    def to(self, other:'Span') -> 'Span':
+        return Span(self.line, self.column, other.end_line, other.end_column)
+
+    def __str__(self):
+        return f'{self.line}:{self.column}'
+
+    def __repr__(self):
+        return f'Span({self.line}:{self.column}-{self.end_line}:{self.end_column})'
+
 class Token:
-    def __init__(self, type:TokenType, value=None):
+    __slots__ = ('type', 'value', 'span')
+
+    def __init__(self, type:TokenType, value=None, span:Span = None):
         self.type = type
         self.value = value
+        self.span = span
 
     def __repr__(self):
         return f'Token({self.type},{self.value})'
 
     def __eq__(self, other):
         if(type(self) is type(other)):
-            return self.__dict__ == other.__dict__
+            return self.type == other.type and self.value == other.value
         else:
             return self.type == other
 
+KEYWORDS = {
+    'return': TokenType.RETURN,
+    'if': TokenType.IF,
+    'else': TokenType.ELSE,
+    'function': TokenType.FUNCTION,
+    'var': TokenType.VAR,
+    'while': TokenType.WHILE,
+}
+
+TOKEN_PATTERNS = [
+    (TokenType.NUMBER, r'\d+'),
+    (TokenType.IDENTIFIER, r'[a-zA-Z_][a-zA-Z0-9_]*'),
+    (TokenType.NOTEQUAL, r'!='),
+    (TokenType.EQUAL, r'=='),
+    (TokenType.SEMICOLON, r';'),
+    (TokenType.COMMA, r','),
+    (TokenType.NOT, r'!'),
+    (TokenType.LESS, r'<'),
+    (TokenType.GREATER, r'>'),
+    (TokenType.ASSIGN, r'='),
+    (TokenType.PLUS, r'\+'),
+    (TokenType.MINUS, r'-'),
+    (TokenType.STAR, r'\*'),
+    (TokenType.SLASH, r'/'),
+    (TokenType.LPAREN, r'\('),
+    (TokenType.RPAREN, r'\)'),
+    (TokenType.LBRACE, r'\{'),
+    (TokenType.RBRACE, r'\}'),
+]
+
+# Whitespace and line comments, consumed in one match before every token
+SKIP_REGEX = re.compile(r'(?:\s+|//[^\n]*)*')
+TOKEN_REGEX = re.compile('|'.join(f'(?P<{token_type}>{pattern})' for token_type, pattern in TOKEN_PATTERNS))
+
+# The same patterns over bytes, for sources lexed straight from a memory map
+BYTES_KEYWORDS = {keyword.encode(): token_type for keyword, token_type in KEYWORDS.items()}
+BYTES_SKIP_REGEX = re.compile(SKIP_REGEX.pattern.encode())
+BYTES_TOKEN_REGEX = re.compile(TOKEN_REGEX.pattern.encode())
+
 class Lexer:
     def __init__(self, text:str):
+        # Either a str or any bytes-like buffer such as an mmap, which is matched in place
         self.text = text
         self.pos = 0
-
-        self.patterns = [
-            (r'return', TokenType.RETURN),
-            (r';', TokenType.SEMICOLON),
-            (r'if', TokenType.IF),
-            (r'else', TokenType.ELSE),
-            (r'function', TokenType.FUNCTION),
-            (r'var', TokenType.VAR),
-            (r'while', TokenType.WHILE),
-            (r'\d+', TokenType.NUMBER),
-            (r'!=', TokenType.NOTEQUAL),        
-            (r'={2}', TokenType.EQUAL),
-            (r',', TokenType.COMMA),
-            (r'!', TokenType.NOT),
-            (r'=', TokenType.ASSIGN),
-            (r'\+', TokenType.PLUS),
-            (r'-', TokenType.MINUS),
-            (r'\*', TokenType.STAR),
-            (r'/', TokenType.SLASH),
-            (r'\(', TokenType.LPAREN),
-            (r'\)', TokenType.RPAREN),
-            (r'\{', TokenType.LBRACE),
-            (r'\}', TokenType.RBRACE),
-            (r'[a-zA-Z_][a-zA-Z0-9_]*', TokenType.IDENTIFIER)
-        ]
+        self.lines = LineIndex(text)
+        if isinstance(text, str):
+            self.keywords, self.skip_regex, self.token_regex = KEYWORDS, SKIP_REGEX, TOKEN_REGEX
+        else:
+            self.keywords, self.skip_regex, self.token_regex = BYTES_KEYWORDS, BYTES_SKIP_REGEX, BYTES_TOKEN_REGEX
 
     def error(self):
-        raise Exception(f'Invalid character at position {self.pos}: {self.text[self.pos]}')
+        raise Exception(self.describe(self.pos, f'Invalid character {decode(self.text[self.pos:self.pos + 1])!r}'))
 
-    def get_next_token(self):
-        # Skip Whitespace and comments
-        while self.pos < len(self.text) and (self.text[self.pos].isspace() or self.text[self.pos:self.pos + 2] == '//'):
-            if self.text[self.pos:self.pos + 2] == '//':
-                self.pos = self.text.find('\n', self.pos)
-                if self.pos == -1:
-                    self.pos = len(self.text)
-            else:
-                self.pos += 1
+    def lexeme(self, start:int, end:int) -> str:
+        return decode(self.text[start:end])
+
+    def describe(self, offset:int, message:str) -> str:
+        line, column = self.lines.location(offset)
+        return f'{line}:{column}: {message}\n{self.lines.line_text(line)}'
+
+    def _scan_span(self, pos:int):
+        pos = self.skip_regex.match(self.text, pos).end()
+        if pos >= len(self.text):
+            return EOF_CODE, pos, pos
 
-        if self.pos >= len(self.text):
-            return Token('EOF')
+        match = self.token_regex.match(self.text, pos)
+        if match is None:
+            self.pos = pos
+            self.error()
 
-        # Token patterns using regular expressions
-        for pattern, token_type in self.patterns:
-            regex = re.compile(pattern)
-            match = regex.match(self.text, self.pos)
+        token_type = TokenType(match.lastgroup)
+        if token_type is TokenType.IDENTIFIER:
+            token_type = self.keywords.get(match.group(), token_type)
+        return TOKEN_CODES[token_type], pos, match.end()
 
-            if match:
-                value = match.group()
-                token = Token(token_type, value)
-                self.pos = match.end()
-                return token
+    def _scan(self, pos:int):
+        code, start, end = self._scan_span(pos)
+        if code == EOF_CODE:
+            return Token('EOF', None, self.lines.span(start, end)), end
+        return Token(TOKEN_TYPES[code], self.lexeme(start, end), self.lines.span(start, end)), end
 
-        self.error()
+    def get_next_token(self):
+        token, self.pos = self._scan(self.pos)
+        return token
 
     def peek_next_token(self):
-        # Skip Whitespace and comments
-        pos = self.pos
-        while pos < len(self.text) and (self.text[pos].isspace() or self.text[pos:pos + 2] == '//'):
-            if self.text[pos:pos + 2] == '//':
-                pos = self.text.find('\n', pos)
-                if pos == -1:
-                    pos = len(self.text)
+        token, _ = self._scan(self.pos)
+        return token
+
+    def tokens(self):
+        while True:
+            token = self.get_next_token()
+            yield token
+            if token == 'EOF':
+                return
+
+    def spans(self):
+        while True:
+            code, start, self.pos = self._scan_span(self.pos)
+            yield code, start, self.pos
+            if code == EOF_CODE:
+                return
+
+    def get_current_line_in_source(self):
+        line, _ = self.lines.location(self.pos)
+        return self.lines.line_text(line)
+
+
+# Tokens further than this behind the cursor are dropped from a TokenStream
+TOKEN_WINDOW = 4096
+
+class TokenStream:
+    # Tokens are kept as parallel arrays of type codes and source offsets,
+    # the lexeme of a token is only sliced out of the source when asked for.
+    # The arrays are a window starting at token number base: consumed tokens
+    # are dropped as the cursor moves on, so their size does not grow with the input.
+    def __init__(self, lexer:Lexer):
+        self.lexer = lexer
+        self.spans = lexer.spans()
+        self.types = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.base = 0
+        self.index = 0
+
+    def _fill(self, k:int):
+        # k is relative to the window
+        while len(self.types) <= k:
+            if self.types and self.types[-1] == EOF_CODE:
+                code, start, end = EOF_CODE, self.ends[-1], self.ends[-1]
             else:
-                pos += 1
+                code, start, end = next(self.spans)
+            self.types.append(code)
+            self.starts.append(start)
+            self.ends.append(end)
 
-        if pos >= len(self.text):
-            return Token('EOF')
+    def fill_all(self):
+        while not self.types or self.types[-1] != EOF_CODE:
+            self._fill(len(self.types))
 
-        # Token patterns using regular expressions
-        for pattern, token_type in self.patterns:
-            regex = re.compile(pattern)
-            match = regex.match(self.text, pos)
+    def peek_type(self, k:int = 0) -> int:
+        k += self.index - self.base
+        if k >= len(self.types):
+            self._fill(k)
+        return self.types[k]
 
-            if match:
-                value = match.group()
-                token = Token(token_type, value)
-                return token
+    def start(self, k:int = 0) -> int:
+        # Source offset of a token ahead of the cursor
+        k += self.index - self.base
+        if k >= len(self.types):
+            self._fill(k)
+        return self.starts[k]
 
-        self.error()
+    def previous_end(self) -> int:
+        return self.ends[self.index - self.base - 1]
 
-    def get_current_line_in_source(self):
-        position = self.pos
-        start_index = self.text.rfind('\n', 0, position) + 1 if '\n' in self.text[:position] else 0
+    def token(self, index:int) -> Token:
+        # Only the previous token and the ones ahead of the cursor are still held
+        index -= self.base
+        if index >= len(self.types):
+            self._fill(index)
+        code = self.types[index]
+        start, end = self.starts[index], self.ends[index]
+        span = self.lexer.lines.span(start, end)
+        if code == EOF_CODE:
+            return Token('EOF', None, span)
+        return Token(TOKEN_TYPES[code], self.lexer.lexeme(start, end), span)
+
+    def peek(self, k:int = 0) -> Token:
+        return self.token(self.index + k)
+
+    def next(self) -> Token:
+        token = self.token(self.index)
+        self.advance()
+        return token
 
-        # Find the end index of the line
-        end_index = self.text.find('\n', position)
-        end_index = end_index if end_index != -1 else len(self.text)
+    def advance(self):
+        position = self.index - self.base
+        if position >= len(self.types):
+            self._fill(position)
+        elif position > TOKEN_WINDOW:
+            del self.types[:position - 1]
+            del self.starts[:position - 1]
+            del self.ends[:position - 1]
+            self.base += position - 1
+        self.index += 1
 
-        # Extract and print the line
-        return self.text[start_index:end_index]
+    def __len__(self):
+        # Tokens read so far, including the ones already dropped
+        return self.base + len(self.types)
 
+    def __iter__(self):
+        return self
 
+    def __next__(self) -> Token:
+        token = self.next()
+        if token == 'EOF':
+            raise StopIteration
+        return token
 
 if __name__ == '__main__':
 
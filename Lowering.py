@@ -0,0 +1,321 @@
+from bisect import bisect_right
+from AST import *
+from IR import *
+from IRPasses import PassManager
+from Optimizer import Transformer
+from Peephole import is_immediate
+from Registers import SCRATCH_REGISTERS, SAVED_REGISTERS, parallel_move
+
+# Lowers a ControlFlowGraph to arm32. Virtual registers get machine registers by linear scan
+# over their live ranges in layout order: a value live across a call takes a callee-saved
+# register, anything else prefers r0 to r3, and what does not fit lives in a slot below fp,
+# loaded into ip or lr where it is read. ip and lr are never allocated.
+
+CONDITIONS = {'eq': 'eq', 'ne': 'ne', 'lt': 'lt', 'gt': 'gt'}
+
+ARITHMETIC = {'add': 'add', 'sub': 'sub', 'mul': 'mul', 'udiv': 'udiv'}
+
+# Instructions whose second operand may be an immediate
+IMMEDIATE_OPERANDS = ('add', 'sub', 'eq', 'ne', 'lt', 'gt')
+
+def immediate_constants(graph:ControlFlowGraph) -> dict[int, int]:
+    # Constants that every reader takes as an immediate are never loaded into a register
+    definitions = graph.definition_counts()
+    constants = {instruction.dest: instruction.value for instruction in graph.instructions()
+                 if instruction.opcode == 'const' and definitions[instruction.dest] == 1 and is_immediate(instruction.value)}
+    for instruction in graph.instructions():
+        for position, argument in enumerate(instruction.arguments):
+            if argument in constants and not (position == 1 and instruction.opcode in IMMEDIATE_OPERANDS):
+                del constants[argument]
+    return constants
+
+class Allocation:
+    def __init__(self, graph:ControlFlowGraph, immediates:dict[int, int] = {}):
+        self.registers = {}
+        self.slots = {}
+        self.immediates = immediates
+        self.allocate(graph)
+        self.saved_registers = [register for register in SAVED_REGISTERS if register in self.registers.values()]
+
+    def live_ranges(self, graph:ControlFlowGraph) -> tuple[dict, dict, list[int]]:
+        # Instructions are numbered in layout order, a register lives from its first to its
+        # last position, widened to the blocks it is live into or out of
+        live_in, live_out = graph.liveness()
+        starts, ends, calls = {}, {}, []
+        def touch(register:int, position:int):
+            if register in self.immediates:
+                return
+            starts[register] = min(starts.get(register, position), position)
+            ends[register] = max(ends.get(register, position), position)
+        position = 0
+        for block in graph.blocks:
+            first = position
+            for instruction in block.instructions + [block.terminator]:
+                for argument in instruction.arguments:
+                    touch(argument, position)
+                if instruction.dest is not None:
+                    touch(instruction.dest, position)
+                if instruction.opcode == 'call':
+                    calls.append(position)
+                position += 1
+            for register in live_in[block]:
+                touch(register, first)
+            for register in live_out[block]:
+                touch(register, position - 1)
+        return starts, ends, calls
+
+    def allocate(self, graph:ControlFlowGraph):
+        starts, ends, calls = self.live_ranges(graph)
+        # Copies prefer to land in the register they copy, so the move goes away
+        hints = {}
+        for instruction in graph.instructions():
+            if instruction.opcode == 'copy':
+                hints[instruction.dest] = instruction.arguments[0]
+                hints.setdefault(instruction.arguments[0], instruction.dest)
+
+        free = set(SCRATCH_REGISTERS + SAVED_REGISTERS)
+        active = []
+        for register in sorted(starts, key=lambda register: (starts[register], register)):
+            start, end = starts[register], ends[register]
+            for other in [other for other in active if ends[other] <= start]:
+                active.remove(other)
+                free.add(self.registers[other])
+            # A call between the first and last position clobbers r0 to r3
+            crosses_call = bisect_right(calls, start) < len(calls) and calls[bisect_right(calls, start)] < end
+            allowed = SAVED_REGISTERS if crosses_call else SCRATCH_REGISTERS + SAVED_REGISTERS
+            candidates = [machine for machine in allowed if machine in free]
+            if candidates:
+                hint = self.registers.get(hints.get(register))
+                machine = hint if hint in candidates else candidates[0]
+                self.registers[register] = machine
+                free.remove(machine)
+                active.append(register)
+                continue
+            # Out of registers, the range ending last goes to the stack
+            victims = [other for other in active if self.registers[other] in allowed]
+            victim = max(victims, key=lambda other: ends[other], default=None)
+            if victim is not None and ends[victim] > end:
+                self.registers[register] = self.registers.pop(victim)
+                active.remove(victim)
+                active.append(register)
+                self.spill(victim)
+            else:
+                self.spill(register)
+
+    def spill(self, register:int):
+        self.slots[register] = -4 * (len(self.slots) + 1)
+
+    @property
+    def frame_size(self) -> int:
+        return align(4 * len(self.slots))
+
+class Lowering:
+    def __init__(self, graph:ControlFlowGraph, output:Output):
+        self.graph = graph
+        self.output = output
+        self.immediates = immediate_constants(graph)
+        self.allocation = Allocation(graph, self.immediates)
+        self.uses = graph.use_counts()
+        # Saved registers, fp and lr, padded with ip to keep the stack 8 byte aligned
+        self.frame_registers = self.allocation.saved_registers + ['fp'] + ['ip'] * (len(self.allocation.saved_registers) % 2)
+        self.labels = {block: f'.L{graph.name}_{block.label}' for block in graph.blocks}
+
+    def emit(self, line:str):
+        self.output.emit(line)
+
+    def read(self, register:int, scratch:str) -> str:
+        if register in self.allocation.slots:
+            self.emit(f'ldr {scratch}, [fp, #{self.allocation.slots[register]}]')
+            return scratch
+        return self.allocation.registers[register]
+
+    def operand(self, register:int, scratch:str) -> str:
+        if register in self.immediates:
+            return f'#{self.immediates[register]}'
+        return self.read(register, scratch)
+
+    def target(self, register:int) -> str:
+        return self.allocation.registers.get(register, 'ip')
+
+    def write(self, register:int, machine:str):
+        # Stores a result computed in target(register) to its slot if it has one
+        if register in self.allocation.slots:
+            self.emit(f'str {machine}, [fp, #{self.allocation.slots[register]}]')
+
+    def lower(self):
+        name = self.graph.name
+        self.emit('')
+        self.emit(f'.global {name}')
+        self.emit(f'{name}:')
+        self.emit(f'push {{{", ".join(self.frame_registers)}, lr}}')
+        self.emit('mov fp, sp')
+        if self.allocation.frame_size:
+            self.emit(f'sub sp, sp, #{self.allocation.frame_size}')
+        if any(instruction.opcode == 'tailcall' and instruction.value == name for instruction in self.graph.instructions()):
+            self.emit(f'{entry_label(name)}:')
+
+        blocks = self.graph.blocks
+        for i, block in enumerate(blocks):
+            if i:
+                self.emit(f'{self.labels[block]}:')
+            instructions = block.instructions
+            if i == 0:
+                arguments = [instruction for instruction in instructions if instruction.opcode == 'arg']
+                self.lower_arguments(arguments)
+                instructions = instructions[len(arguments):]
+            following = blocks[i + 1] if i + 1 < len(blocks) else None
+            # A comparison feeding only the branch right after it sets the flags for it
+            fused = None
+            terminator = block.terminator
+            if (terminator.opcode == 'branch' and instructions and instructions[-1].opcode in CONDITIONS
+                    and instructions[-1].dest == terminator.arguments[0] and self.uses[instructions[-1].dest] == 1):
+                fused, instructions = instructions[-1], instructions[:-1]
+            for instruction in instructions:
+                self.lower_instruction(instruction)
+            self.lower_terminator(terminator, following, fused)
+
+    def lower_arguments(self, arguments:list[Instruction]):
+        # Parameters arrive in r0 to r3 and above the saved registers, moved all at once
+        moves = []
+        for argument in arguments:
+            index = argument.value
+            if index >= 4:
+                continue
+            if argument.dest in self.allocation.slots:
+                self.write(argument.dest, f'r{index}')
+            else:
+                moves.append((f'r{index}', self.allocation.registers[argument.dest]))
+        for line in parallel_move(moves):
+            self.emit(line)
+        for argument in arguments:
+            if argument.value >= 4:
+                machine = self.target(argument.dest)
+                self.emit(f'ldr {machine}, [fp, #{4 * (len(self.frame_registers) + 1) + 4 * (argument.value - 4)}]')
+                self.write(argument.dest, machine)
+
+    def lower_instruction(self, instruction:Instruction):
+        opcode, dest = instruction.opcode, instruction.dest
+        if opcode == 'call':
+            self.lower_call(instruction)
+            return
+        if opcode == 'const':
+            if dest in self.immediates:
+                return
+            machine = self.target(dest)
+            self.emit(f'ldr {machine}, ={instruction.value}')
+        elif opcode == 'copy':
+            source = self.read(instruction.arguments[0], 'ip')
+            machine = self.target(dest)
+            if machine != source:
+                self.emit(f'mov {machine}, {source}')
+        elif opcode in ARITHMETIC:
+            left, right = self.read(instruction.arguments[0], 'ip'), self.operand(instruction.arguments[1], 'lr')
+            machine = self.target(dest)
+            self.emit(f'{ARITHMETIC[opcode]} {machine}, {left}, {right}')
+        elif opcode in CONDITIONS:
+            left, right = self.read(instruction.arguments[0], 'ip'), self.operand(instruction.arguments[1], 'lr')
+            machine = self.target(dest)
+            self.emit(f'cmp {left}, {right}')
+            self.emit(f'mov{INVERSE_CONDITIONS[CONDITIONS[opcode]]} {machine}, #0')
+            self.emit(f'mov{CONDITIONS[opcode]} {machine}, #1')
+        elif opcode == 'not':
+            source = self.read(instruction.arguments[0], 'ip')
+            machine = self.target(dest)
+            self.emit(f'cmp {source}, #0')
+            self.emit(f'moveq {machine}, #1')
+            self.emit(f'movne {machine}, #0')
+        elif opcode == 'mulc':
+            source = self.read(instruction.arguments[0], 'ip')
+            machine = self.target(dest)
+            if machine != source:
+                self.emit(f'mov {machine}, {source}')
+            for line in shift_add_lines(machine, instruction.value):
+                self.emit(line)
+        elif opcode == 'lsr':
+            source = self.read(instruction.arguments[0], 'ip')
+            machine = self.target(dest)
+            self.emit(f'lsr {machine}, {source}, #{instruction.value}' if instruction.value else f'mov {machine}, {source}')
+        elif opcode == 'umulh':
+            left, right = self.read(instruction.arguments[0], 'ip'), self.read(instruction.arguments[1], 'lr')
+            machine = self.target(dest)
+            # The low word is dropped in whichever scratch register the result does not use
+            self.emit(f'umull {"lr" if machine == "ip" else "ip"}, {machine}, {left}, {right}')
+        else:
+            raise Exception(f'Cannot lower {opcode}')
+        self.write(dest, self.target(dest))
+
+    def pass_arguments(self, arguments:list[int]):
+        # The fifth argument on are stored below sp first, then r0 to r3 are filled at once
+        for i, argument in enumerate(arguments[4:]):
+            self.emit(f'str {self.read(argument, "ip")}, [sp, #{4 * i}]')
+        moves = [(self.allocation.registers[argument], f'r{i}') for i, argument in enumerate(arguments[:4]) if argument not in self.allocation.slots]
+        for line in parallel_move(moves):
+            self.emit(line)
+        for i, argument in enumerate(arguments[:4]):
+            if argument in self.allocation.slots:
+                self.read(argument, f'r{i}')
+
+    def lower_call(self, instruction:Instruction):
+        size = stack_arguments_size(len(instruction.arguments))
+        if size:
+            self.emit(f'sub sp, sp, #{size}')
+        self.pass_arguments(instruction.arguments)
+        self.emit(f'bl {instruction.value}')
+        if size:
+            self.emit(f'add sp, sp, #{size}')
+        if instruction.dest in self.allocation.slots:
+            self.write(instruction.dest, 'r0')
+        elif instruction.dest is not None and self.target(instruction.dest) != 'r0':
+            self.emit(f'mov {self.target(instruction.dest)}, r0')
+
+    def leave(self, last:str):
+        if self.allocation.frame_size:
+            self.emit('mov sp, fp')
+        self.emit(f'pop {{{", ".join(self.frame_registers)}, {last}}}')
+
+    def lower_terminator(self, terminator:Instruction, following:BasicBlock, fused:Instruction):
+        opcode = terminator.opcode
+        if opcode == 'ret':
+            value = self.read(terminator.arguments[0], 'r0')
+            if value != 'r0':
+                self.emit(f'mov r0, {value}')
+            self.leave('pc')
+        elif opcode == 'tailcall':
+            self.pass_arguments(terminator.arguments)
+            if terminator.value == self.graph.name:
+                self.emit(f'b {entry_label(terminator.value)}')
+            else:
+                self.leave('lr')
+                self.emit(f'b {terminator.value}')
+        elif opcode == 'jump':
+            if terminator.targets[0] is not following:
+                self.emit(f'b {self.labels[terminator.targets[0]]}')
+        else:
+            if fused is not None:
+                left, right = self.read(fused.arguments[0], 'ip'), self.operand(fused.arguments[1], 'lr')
+                self.emit(f'cmp {left}, {right}')
+                condition = CONDITIONS[fused.opcode]
+            else:
+                self.emit(f'cmp {self.read(terminator.arguments[0], "ip")}, #0')
+                condition = 'ne'
+            true, false = terminator.targets
+            if false is following:
+                self.emit(f'b{condition} {self.labels[true]}')
+            elif true is following:
+                self.emit(f'b{INVERSE_CONDITIONS[condition]} {self.labels[false]}')
+            else:
+                self.emit(f'b{condition} {self.labels[true]}')
+                self.emit(f'b {self.labels[false]}')
+
+class IRFunction(Function):
+    # A function compiled through the IR instead of the emit path
+    __slots__ = ()
+
+    def emit(self, env:Environment):
+        graph = build(self)
+        PassManager().run(graph)
+        Lowering(graph, env.output).lower()
+
+class IRBackend(Transformer):
+    def visit_Function(self, node:Function) -> AST:
+        return IRFunction(node.name, node.paramenters, node.body)
@@ -0,0 +1,539 @@
+from collections import Counter
+from AST import *
+
+MASK = 0xffffffff
+
+def to_int32(value:int) -> int:
+    value &= MASK
+    return value - (MASK + 1) if value & 0x80000000 else value
+
+def is_pure(node:AST) -> bool:
+    return not any(isinstance(child, Call) for child in walk(node))
+
+def is_number(node:AST, value:int = None) -> bool:
+    return isinstance(node, Number) and (value is None or to_int32(node.value) == value)
+
+def copy_span(node:AST, original:AST) -> AST:
+    # A node built by a pass stands where the node it replaces was in the source
+    span = getattr(original, 'span', None)
+    if span is not None and node is not original and getattr(node, 'span', None) is None:
+        node.span = span
+    return node
+
+class Transformer:
+    def visit(self, node:AST) -> AST:
+        method = getattr(self, f'visit_{node.__class__.__name__}', self.generic_visit)
+        return copy_span(method(node), node)
+
+    def generic_visit(self, node:AST) -> AST:
+        fields = {}
+        for name, value in zip(node._fields, node.field_values()):
+            if isinstance(value, AST):
+                value = self.visit(value)
+            elif isinstance(value, list):
+                value = [self.visit(item) if isinstance(item, AST) else item for item in value]
+            fields[name] = value
+        return type(node)(**fields)
+
+class ConstantFolder(Transformer):
+    # Arithmetic wraps like the 32 bit registers it runs on, division is unsigned like udiv
+    folds = {
+        Add: lambda a, b: a + b,
+        Subtract: lambda a, b: a - b,
+        Multiply: lambda a, b: a * b,
+        Divide: lambda a, b: (a & MASK) // (b & MASK),
+        Equal: lambda a, b: int(to_int32(a) == to_int32(b)),
+        NotEqual: lambda a, b: int(to_int32(a) != to_int32(b)),
+        Less: lambda a, b: int(to_int32(a) < to_int32(b)),
+        Greater: lambda a, b: int(to_int32(a) > to_int32(b)),
+    }
+
+    def generic_visit(self, node:AST) -> AST:
+        node = super().generic_visit(node)
+        if type(node) in self.folds:
+            return self.fold_binary(node)
+        return node
+
+    def fold_binary(self, node:AST) -> AST:
+        left, right = node.left, node.right
+        if is_number(left) and is_number(right):
+            if isinstance(node, Divide) and right.value & MASK == 0:
+                return node
+            return Number(to_int32(self.folds[type(node)](left.value, right.value)))
+
+        if isinstance(node, Add):
+            if is_number(left, 0):
+                return right
+            if is_number(right, 0):
+                return left
+        elif isinstance(node, Subtract):
+            if is_number(right, 0):
+                return left
+        elif isinstance(node, Multiply):
+            if is_number(left, 1):
+                return right
+            if is_number(right, 1):
+                return left
+            if (is_number(left, 0) and is_pure(right)) or (is_number(right, 0) and is_pure(left)):
+                return Number(0)
+        elif isinstance(node, Divide):
+            if is_number(right, 1):
+                return left
+        return node
+
+    def visit_Not(self, node:Not) -> AST:
+        term = self.visit(node.term)
+        if is_number(term):
+            return Number(int(to_int32(term.value) == 0))
+        if isinstance(term, Equal):
+            return NotEqual(term.left, term.right)
+        if isinstance(term, NotEqual):
+            return Equal(term.left, term.right)
+        # !!!x is !x, the inner pair only normalises to 0 or 1
+        if isinstance(term, Not) and isinstance(term.term, Not):
+            return term.term
+        return Not(term)
+
+    def visit_condition(self, node:AST) -> AST:
+        node = self.visit(node)
+        # In a branch only zero or non-zero matters, so !!x tests the same as x
+        while isinstance(node, Not) and isinstance(node.term, Not):
+            node = node.term.term
+        return node
+
+    def visit_If(self, node:If) -> AST:
+        return If(self.visit_condition(node.conditional), self.visit(node.consequence), self.visit(node.alternative))
+
+    def visit_While(self, node:While) -> AST:
+        return While(self.visit_condition(node.conditional), self.visit(node.body))
+
+class TailCalls(Transformer):
+    # A call whose value is returned right away can reuse the frame of the caller
+    def visit_Return(self, node:Return) -> AST:
+        term = self.visit(node.term)
+        # Arguments past the fourth live in the caller's frame, such calls stay calls
+        if isinstance(term, Call) and len(term.arguments) <= 4:
+            return TailCall(term.callee, term.arguments)
+        return Return(term)
+
+def always_returns(node:AST) -> bool:
+    if isinstance(node, (Return, TailCall)):
+        return True
+    if isinstance(node, Block):
+        return any(always_returns(statement) for statement in node.statements)
+    if isinstance(node, If):
+        return always_returns(node.consequence) and always_returns(node.alternative)
+    return False
+
+class DeadCode(Transformer):
+    # Drops statements after a return, and branches and loops whose condition folded to a constant
+    def visit_Block(self, node:Block) -> AST:
+        statements = []
+        for statement in node.statements:
+            statements.append(self.visit(statement))
+            if always_returns(statements[-1]):
+                break
+        return Block(statements)
+
+    def visit_If(self, node:If) -> AST:
+        conditional = self.visit(node.conditional)
+        if is_number(conditional):
+            return self.visit(node.consequence if to_int32(conditional.value) else node.alternative)
+        return If(conditional, self.visit(node.consequence), self.visit(node.alternative))
+
+    def visit_While(self, node:While) -> AST:
+        if is_number(node.conditional, 0):
+            return Block([])
+        return While(self.visit(node.conditional), self.visit(node.body))
+
+class StrengthReduction(Transformer):
+    # A multiplication by a constant becomes shifts and adds where they take at most three
+    # instructions, a division by a constant a shift or a multiplication by its reciprocal
+    def visit_Multiply(self, node:Multiply) -> AST:
+        left, right = self.visit(node.left), self.visit(node.right)
+        if is_number(right) and shift_add_sequence(right.value) is not None:
+            return MultiplyByConstant(left, to_int32(right.value))
+        if is_number(left) and shift_add_sequence(left.value) is not None:
+            return MultiplyByConstant(right, to_int32(left.value))
+        return Multiply(left, right)
+
+    def visit_Divide(self, node:Divide) -> AST:
+        left, right = self.visit(node.left), self.visit(node.right)
+        if is_number(right) and right.value & MASK > 1:
+            return DivideByConstant(left, right.value & MASK)
+        return Divide(left, right)
+
+# Expressions worth computing once, leaves already take a single instruction
+INVARIANT_CANDIDATES = (Not, Equal, NotEqual, Less, Greater, Add, Subtract, Multiply, Divide, MultiplyByConstant, DivideByConstant)
+
+class InvariantHoister(Transformer):
+    # Replaces the largest pure expressions reading none of the names assigned in a loop by
+    # new locals, equal expressions share one. Movable vars with such a value move out whole.
+    def __init__(self, assigned:set[str], movable:set[str], hoisted:list[Var], name:str):
+        self.assigned = assigned
+        self.movable = movable
+        self.hoisted = hoisted
+        self.name = name
+
+    def is_invariant(self, node:AST) -> bool:
+        # Hoisted code runs even when the loop does not, so a division is only moved when its
+        # divisor is a constant other than zero: divided through the library, zero could trap
+        for child in walk(node):
+            if isinstance(child, Id) and child.value in self.assigned:
+                return False
+            if isinstance(child, Call) or (isinstance(child, Divide) and not (is_number(child.right) and child.right.value & MASK)):
+                return False
+        return True
+
+    def visit(self, node:AST) -> AST:
+        if isinstance(node, Var) and node.name in self.movable and self.is_invariant(node.value):
+            self.hoisted.append(node)
+            self.assigned.discard(node.name)
+            return copy_span(Block([]), node)
+        if isinstance(node, INVARIANT_CANDIDATES) and self.is_invariant(node):
+            for var in self.hoisted:
+                if var.value == node:
+                    return copy_span(Id(var.name), node)
+            self.hoisted.append(copy_span(Var(f'{self.name}.{len(self.hoisted)}', node), node))
+            return copy_span(Id(self.hoisted[-1].name), node)
+        return super().visit(node)
+
+class LoopInvariants(Transformer):
+    # Moves what a loop computes the same in every iteration to locals set before it. Inner
+    # loops go first, so what they hoist can move further out. A var declared in the loop
+    # counts as assigned, as its slot changes every iteration, unless it is one the passes
+    # made up, declared once and never assigned: nothing can read it before it is declared.
+    def __init__(self):
+        self.count = 0
+
+    def visit_While(self, node:While) -> AST:
+        node = While(self.visit(node.conditional), self.visit(node.body))
+        declared = Counter(child.name for child in walk(node.body) if isinstance(child, Var))
+        written = {child.name for child in walk(node.body) if isinstance(child, Assign)}
+        movable = {name for name, count in declared.items() if count == 1 and '.' in name and name not in written}
+        hoisted = []
+        self.count += 1
+        node = InvariantHoister(written | set(declared), movable, hoisted, f'loop.{self.count}').generic_visit(node)
+        return Block(hoisted + [node]) if hoisted else node
+
+class CommonSubexpressions(Transformer):
+    # Within a block, a pure expression evaluated again before any name it reads is written
+    # is computed once, into a new local declared before the statement it first appears in.
+    # Expressions are interned, so counting them compares by identity. An expression inside
+    # a repeat is not counted again, it only gets a local when it repeats elsewhere too.
+    # Branches and loops are blocks of their own and write what they assign.
+    def __init__(self):
+        self.count = 0
+        self.table = InternTable()
+        self.summaries = {}
+
+    def summary(self, node:AST) -> tuple[bool, frozenset]:
+        # Whether node is pure and the names it reads, kept per interned structure
+        node = self.table.intern(node)
+        if node not in self.summaries:
+            pure, names = not isinstance(node, Call), set()
+            if isinstance(node, Id):
+                names.add(node.value)
+            for child in node.children():
+                child_pure, child_names = self.summary(child)
+                pure = pure and child_pure
+                names |= child_names
+            self.summaries[node] = (pure, frozenset(names))
+        return self.summaries[node]
+
+    def key(self, node:AST, written:dict[str, int]):
+        # Equal expressions share a key until a name they read is written
+        if not isinstance(node, INVARIANT_CANDIDATES):
+            return None
+        pure, names = self.summary(node)
+        if not pure:
+            return None
+        return self.table.intern(node), max((written.get(name, -1) for name in names), default=-1)
+
+    def expressions(self, statement:AST) -> list[AST]:
+        if isinstance(statement, (Var, Assign)):
+            return [statement.value]
+        if isinstance(statement, Return):
+            return [statement.term]
+        if isinstance(statement, TailCall):
+            return statement.arguments
+        if isinstance(statement, If):
+            return [statement.conditional]
+        if isinstance(statement, (While, Block, Function)):
+            return []
+        return [statement]
+
+    def writes(self, statement:AST) -> set[str]:
+        if isinstance(statement, (Var, Assign)):
+            return {statement.name}
+        if isinstance(statement, (If, While, Block)):
+            return {node.name for node in walk(statement) if isinstance(node, (Var, Assign))}
+        return set()
+
+    def visit_Block(self, node:Block) -> AST:
+        statements = [self.visit(statement) for statement in node.statements]
+        # Counted in the order the rewrite below meets them, so both agree on the first
+        counts, written = Counter(), {}
+        for i, statement in enumerate(statements):
+            for expression in self.expressions(statement):
+                stack = [expression]
+                while stack:
+                    expression = stack.pop()
+                    key = self.key(expression, written)
+                    if key is not None:
+                        counts[key] += 1
+                        if counts[key] > 1:
+                            continue
+                    stack.extend(reversed(expression.children()))
+            for name in self.writes(statement):
+                written[name] = i
+        if all(count == 1 for count in counts.values()):
+            return Block(statements)
+
+        rewritten, written, locals = [], {}, {}
+        for i, statement in enumerate(statements):
+            declarations = []
+            replacer = SubexpressionReplacer(self, counts, written, locals, declarations)
+            if isinstance(statement, (Var, Assign)):
+                statement = copy_span(type(statement)(statement.name, replacer.visit(statement.value)), statement)
+            elif isinstance(statement, Return):
+                statement = copy_span(Return(replacer.visit(statement.term)), statement)
+            elif isinstance(statement, TailCall):
+                statement = copy_span(TailCall(statement.callee, [replacer.visit(argument) for argument in statement.arguments]), statement)
+            elif isinstance(statement, If):
+                statement = copy_span(If(replacer.visit(statement.conditional), statement.consequence, statement.alternative), statement)
+            elif self.expressions(statement):
+                statement = replacer.visit(statement)
+            rewritten += declarations + [statement]
+            for name in self.writes(statement):
+                written[name] = i
+        return Block(rewritten)
+
+class SubexpressionReplacer(Transformer):
+    def __init__(self, elimination:CommonSubexpressions, counts:Counter, written:dict[str, int], locals:dict, declarations:list[Var]):
+        self.elimination = elimination
+        self.counts = counts
+        self.written = written
+        self.locals = locals
+        self.declarations = declarations
+
+    def visit(self, node:AST) -> AST:
+        key = self.elimination.key(node, self.written)
+        if key is None or self.counts[key] < 2:
+            return super().visit(node)
+        if key not in self.locals:
+            # The first time its value is computed, with what repeats inside it replaced first
+            value = super().visit(node)
+            self.elimination.count += 1
+            self.locals[key] = f'cse.{self.elimination.count}'
+            self.declarations.append(copy_span(Var(self.locals[key], value), node))
+        return copy_span(Id(self.locals[key]), node)
+
+class LoopRotation(Transformer):
+    def visit_While(self, node:While) -> AST:
+        return RotatedWhile(self.visit(node.conditional), self.visit(node.body))
+
+class LibraryDivide(Transformer):
+    # For cores without udiv, the divisions left call the library
+    def visit_Divide(self, node:Divide) -> AST:
+        return DivideCall(DIVIDE_FUNCTION, [self.visit(node.left), self.visit(node.right)])
+
+def reachable_functions(tree:AST, entry:str = 'main') -> AST:
+    # Keeps the functions a chain of calls from entry or from a statement outside the functions
+    # reaches. A program without entry is a library, all of its functions are kept.
+    if not isinstance(tree, Block):
+        return tree
+    functions = {}
+    for statement in tree.statements:
+        if isinstance(statement, Function):
+            functions.setdefault(statement.name, []).append(statement)
+    if entry not in functions:
+        return tree
+    reached = {entry}
+    stack = list(functions[entry]) + [statement for statement in tree.statements if not isinstance(statement, Function)]
+    while stack:
+        for node in walk(stack.pop()):
+            if isinstance(node, (Call, TailCall)) and node.callee in functions and node.callee not in reached:
+                reached.add(node.callee)
+                stack.extend(functions[node.callee])
+    if len(reached) == len(functions):
+        return tree
+    return copy_span(Block([statement for statement in tree.statements if not isinstance(statement, Function) or statement.name in reached]), tree)
+
+# A function is inlined when its body has at most INLINE_SIZE nodes, or when all its copies
+# together have at most INLINE_BUDGET, which lets a bigger function called once go inline
+INLINE_SIZE = 12
+INLINE_BUDGET = 40
+
+class Substitution(Transformer):
+    # Copies a callee's statement with its parameters and locals replaced
+    def __init__(self, mapping:dict[str, AST]):
+        self.mapping = mapping
+
+    def visit_Id(self, node:Id) -> AST:
+        if node.value in self.mapping:
+            return Transformer().visit(self.mapping[node.value])
+        return Id(node.value)
+
+    def visit_Assign(self, node:Assign) -> AST:
+        return Assign(self.mapping[node.name].value, self.visit(node.value))
+
+class Inliner(Transformer):
+    # Replaces calls to small leaf functions, those calling no function of the program, by
+    # their bodies, so recursive functions are never inlined. A call in an expression takes a
+    # function that only returns an expression, a call as a statement or as the value of a var,
+    # assignment or return takes one whose only return is its last statement. Arguments are
+    # substituted when that cannot change what they evaluate to or how often, otherwise they
+    # are bound to new locals.
+    def __init__(self, tree:AST):
+        functions = [statement for statement in tree.statements if isinstance(statement, Function)] if isinstance(tree, Block) else []
+        definitions = Counter(function.name for function in functions)
+        calls = Counter(node.callee for node in walk(tree) if isinstance(node, Call))
+        self.candidates = {}
+        for function in functions:
+            size = sum(1 for _ in walk(function.body))
+            if definitions[function.name] == 1 and self.is_inlinable(function, definitions) and (size <= INLINE_SIZE or size * calls[function.name] <= INLINE_BUDGET):
+                self.candidates[function.name] = function
+        self.count = 0
+
+    def is_inlinable(self, function:Function, definitions:Counter) -> bool:
+        statements = function.body.statements if isinstance(function.body, Block) else [function.body]
+        if len(set(function.paramenters)) != len(function.paramenters):
+            return False
+        for node in walk(function.body):
+            if isinstance(node, Call) and node.callee in definitions:
+                return False
+            if isinstance(node, (Function, TailCall)):
+                return False
+            if isinstance(node, Var) and not any(node is statement for statement in statements):
+                return False
+            if isinstance(node, Return) and node is not statements[-1]:
+                return False
+        # Every name must be a parameter or a local, a free name would be captured by the caller
+        names = set(function.paramenters)
+        for statement in statements:
+            for node in walk(statement):
+                if (isinstance(node, Id) and node.value not in names) or (isinstance(node, Assign) and node.name not in names):
+                    return False
+            if isinstance(statement, Var):
+                names.add(statement.name)
+        return True
+
+    def visit_If(self, node:If) -> AST:
+        return If(self.visit(node.conditional), self.visit_statement(node.consequence), self.visit_statement(node.alternative))
+
+    def visit_While(self, node:While) -> AST:
+        return While(self.visit(node.conditional), self.visit_statement(node.body))
+
+    def visit_Block(self, node:Block) -> AST:
+        statements = []
+        for statement in node.statements:
+            statements.extend(self.visit_statements(statement))
+        return Block(statements)
+
+    def visit_statement(self, node:AST) -> AST:
+        if isinstance(node, Block):
+            return self.visit(node)
+        statements = self.visit_statements(node)
+        return statements[0] if len(statements) == 1 else Block(statements)
+
+    def visit_statements(self, node:AST) -> list[AST]:
+        statement = self.visit(node)
+        if isinstance(statement, Call):
+            call, use = statement, lambda value: [] if is_pure(value) else [value]
+        elif isinstance(statement, Var) and isinstance(statement.value, Call):
+            call, use = statement.value, lambda value: [Var(statement.name, value)]
+        elif isinstance(statement, Assign) and isinstance(statement.value, Call):
+            call, use = statement.value, lambda value: [Assign(statement.name, value)]
+        elif isinstance(statement, Return) and isinstance(statement.term, Call):
+            call, use = statement.term, lambda value: [Return(value)]
+        elif isinstance(node, Call) and is_pure(statement):
+            # A call to a function that only returned an expression, its value is dropped
+            return []
+        else:
+            return [statement]
+        inlined = self.inline(call)
+        if inlined is None:
+            return [statement]
+        statements, value = inlined
+        statements += use(copy_span(value, call))
+        return [copy_span(inlined, node) for inlined in statements]
+
+    def visit_Call(self, node:Call) -> AST:
+        call = Call(node.callee, [self.visit(argument) for argument in node.arguments])
+        function = self.candidates.get(call.callee)
+        if function is None or not isinstance(function.body, Block) or len(function.body.statements) != 1 or not isinstance(function.body.statements[0], Return):
+            return call
+        inlined = self.inline(call, False)
+        if inlined is None:
+            return call
+        return inlined[1]
+
+    def inline(self, call:Call, bind:bool = True) -> tuple[list[AST], AST] | None:
+        # The statements the call runs and the expression it returns, or None when it stays a call
+        function = self.candidates.get(call.callee)
+        if function is None or len(call.arguments) != len(function.paramenters):
+            return None
+        statements = function.body.statements if isinstance(function.body, Block) else [function.body]
+        locals = [statement.name for statement in statements if isinstance(statement, Var)]
+        if locals and not bind:
+            return None
+        self.count += 1
+        mapping = {}
+        inlined = []
+        for parameter, argument in zip(function.paramenters, call.arguments):
+            if self.is_substitutable(function, parameter, argument):
+                mapping[parameter] = argument
+            elif bind:
+                name = f'{function.name}.{parameter}.{self.count}'
+                inlined.append(Var(name, argument))
+                mapping[parameter] = Id(name)
+            else:
+                return None
+        value = Number(0)
+        for statement in statements:
+            if isinstance(statement, Var):
+                inlined.append(Var(f'{function.name}.{statement.name}.{self.count}', Substitution(mapping).visit(statement.value)))
+                mapping[statement.name] = Id(inlined[-1].name)
+            elif isinstance(statement, Return):
+                value = Substitution(mapping).visit(statement.term)
+            else:
+                inlined.append(Substitution(mapping).visit(statement))
+        return inlined, value
+
+    def is_substitutable(self, function:Function, parameter:str, argument:AST) -> bool:
+        # Arguments are evaluated once, before the body, and the callee can change none of the
+        # caller's variables. So a parameter that is never assigned can take a constant or a
+        # variable, or a pure expression when it is read at most once and not in a loop.
+        uses = 0
+        for node in walk(function.body):
+            if isinstance(node, (Assign, Var)) and node.name == parameter:
+                return False
+            if isinstance(node, Id) and node.value == parameter:
+                uses += 1
+            if isinstance(node, While) and any(isinstance(child, Id) and child.value == parameter for child in walk(node)):
+                uses += 2
+        if isinstance(argument, (Number, Id)):
+            return True
+        return is_pure(argument) and uses <= 1
+
+# The -O 1 pipeline in order. Unreachable functions are dropped first to spare the passes,
+# and again at the end for those only inlined or dead code called.
+OPTIMIZATIONS = [
+    ('reachable_functions', reachable_functions),
+    ('inline', lambda tree: Inliner(tree).visit(tree)),
+    ('fold', lambda tree: ConstantFolder().visit(tree)),
+    ('dead_code', lambda tree: DeadCode().visit(tree)),
+    ('strength_reduction', lambda tree: StrengthReduction().visit(tree)),
+    ('common_subexpressions', lambda tree: CommonSubexpressions().visit(tree)),
+    ('loop_invariants', lambda tree: LoopInvariants().visit(tree)),
+    ('loop_rotation', lambda tree: LoopRotation().visit(tree)),
+    ('tail_calls', lambda tree: TailCalls().visit(tree)),
+    ('reachable_functions', reachable_functions),
+]
+
+def optimize(tree:AST, level:int = 1, passes:list = OPTIMIZATIONS) -> AST:
+    if level >= 1:
+        for _, function in passes:
+            tree = function(tree)
+    return tree
@@ -1,206 +1,267 @@
 from AST import *
 from Lexer import *
 
+# Precedence and node of every binary operator, all of them left associative
+BINARY_OPERATORS = {
+    TOKEN_CODES[TokenType.EQUAL]: (1, Equal),
+    TOKEN_CODES[TokenType.NOTEQUAL]: (1, NotEqual),
+    TOKEN_CODES[TokenType.LESS]: (2, Less),
+    TOKEN_CODES[TokenType.GREATER]: (2, Greater),
+    TOKEN_CODES[TokenType.PLUS]: (3, Add),
+    TOKEN_CODES[TokenType.MINUS]: (3, Subtract),
+    TOKEN_CODES[TokenType.STAR]: (4, Multiply),
+    TOKEN_CODES[TokenType.SLASH]: (4, Divide),
+}
+# Prefix ! binds tighter than any binary operator
+NOT_PRECEDENCE = 5
+
+NUMBER_CODE = TOKEN_CODES[TokenType.NUMBER]
+IDENTIFIER_CODE = TOKEN_CODES[TokenType.IDENTIFIER]
+NOT_CODE = TOKEN_CODES[TokenType.NOT]
+LPAREN_CODE = TOKEN_CODES[TokenType.LPAREN]
+RPAREN_CODE = TOKEN_CODES[TokenType.RPAREN]
+COMMA_CODE = TOKEN_CODES[TokenType.COMMA]
+
 class Parser:
     def __init__(self, source:str):
         self.source = source
         self.lexer = Lexer(source)
-        self.current_token = self.lexer.get_next_token()
-        self.previous_token = None
+        self.tokens = TokenStream(self.lexer)
+
+    @property
+    def current_token(self) -> Token:
+        return self.tokens.peek()
+
+    @property
+    def previous_token(self) -> Token:
+        return self.tokens.token(self.tokens.index - 1)
 
     def parse(self) -> AST | None:
         return self._parse_statement()
 
-    def _parse_expression(self):
-        return self._parse_comparison()
+    def parse_program(self) -> Block:
+        # The whole source is the body of an implicit block, read up to the end of input
+        statements = []
+        while not self._peek('EOF'):
+            statements.append(self._parse_statement())
+        return self._located(Block(statements), self.lexer.lines.span(0, len(self.source)))
 
-    def _parse_comparison(self):
-        left = self._parse_sum()
-        while True:
-            if(self._match(TokenType.EQUAL)):
-                right = self._parse_sum()
-                left = Equal(left, right)
-            elif(self._match(TokenType.NOTEQUAL)):
-                right = self._parse_sum()
-                left = NotEqual(left, right)
-            else: break
-        return left
-
-    def _parse_sum(self):
-        left = self._parse_product()
-        while True:
-            if(self._match(TokenType.PLUS)):
-                right = self._parse_product()
-                left = Add(left, right)
-            elif(self._match(TokenType.MINUS)):
-                right = self._parse_product()
-                left = Subtract(left, right)
-            else: break
-        return left
-
-    def _parse_product(self):
-        left = self._parse_unary()
+    def _parse_expression(self):
+        # Operator precedence parsing over explicit stacks, so neither deep nesting nor long
+        # chains of operators cost Python frames. Markers for open parentheses and calls sit
+        # on the operator stack with precedence 0, which stops every reduction at them.
+        tokens = self.tokens
+        lines = self.lexer.lines
+        operands = []
+        operators = []
+        groups = 0
         while True:
-            if(self._match(TokenType.STAR)):
-                right = self._parse_unary()
-                left = Multiply(left, right)
-            elif(self._match(TokenType.SLASH)):
-                right = self._parse_unary()
-                left = Divide(left, right)
-            else: break
-        return left
-
-    def _parse_unary(self):
-        if self._match(TokenType.NOT):
-            operand = self._parse_atomic()
-            return Not(operand)
-        else:
-            return self._parse_atomic()
-
-    def _parse_atomic(self):
-        if self._peek(TokenType.IDENTIFIER):
-            return self._parse_call()
-        elif self._match(TokenType.NUMBER):
-            return Number(int(self.previous_token.value))
-        elif self._match(TokenType.LPAREN):
-            expression = self._parse_expression()
-            self._consume(TokenType.RPAREN, "Expected ')' after expression.")
-            return expression
-
-    def _parse_call(self):
-        if self._match(TokenType.IDENTIFIER):
-            if self._peek(TokenType.LPAREN):
-                function_name = str(self.previous_token.value)
-                if self._match(TokenType.LPAREN):
-                    args = self._parse_args()
-                    self._consume(TokenType.RPAREN, "Expected ')' after expression.")
-                    # if function_name == 'assert':
-                    #     return Assert(args[0])
-                    return Call(function_name, args)
+            code = tokens.peek_type()
+            while code == NOT_CODE:
+                operators.append((NOT_PRECEDENCE, Not, tokens.start()))
+                tokens.advance()
+                code = tokens.peek_type()
+            start = tokens.start()
+            if code == NUMBER_CODE:
+                token = tokens.next()
+                operands.append(self._located(Number(int(token.value)), token.span))
+            elif code == IDENTIFIER_CODE:
+                token = tokens.next()
+                name = str(token.value)
+                if tokens.peek_type() != LPAREN_CODE:
+                    operands.append(self._located(Id(name), token.span))
+                elif tokens.peek_type(1) == RPAREN_CODE:
+                    tokens.advance()
+                    tokens.advance()
+                    operands.append(self._located(Call(name, []), lines.span(start, tokens.previous_end())))
+                else:
+                    tokens.advance()
+                    operators.append((0, name, len(operands), start))
+                    groups += 1
+                    continue
+            elif code == LPAREN_CODE:
+                tokens.advance()
+                operators.append((0, None, 0, start))
+                groups += 1
+                continue
             else:
-                return Id(str(self.previous_token.value))
+                raise self._error('Expected expression')
 
-    def _parse_args(self):
-        args = []
-        if not self._peek(TokenType.RPAREN):
-            args.append(self._parse_expression())
-            while self._match(TokenType.COMMA):
-                args.append(self._parse_expression())
-        return args
+            while True:
+                code = tokens.peek_type()
+                operator = BINARY_OPERATORS.get(code)
+                if operator is not None:
+                    precedence = operator[0]
+                    while operators and operators[-1][0] >= precedence:
+                        self._reduce(operands, operators.pop())
+                    operators.append(operator)
+                    tokens.advance()
+                    break
+                if groups and (code == RPAREN_CODE or code == COMMA_CODE):
+                    while operators[-1][0]:
+                        self._reduce(operands, operators.pop())
+                    _, name, base, start = operators[-1]
+                    if code == COMMA_CODE:
+                        if name is None:
+                            raise self._error("Expected ')'")
+                        tokens.advance()
+                        break
+                    operators.pop()
+                    groups -= 1
+                    tokens.advance()
+                    if name is not None:
+                        arguments = operands[base:]
+                        del operands[base:]
+                        operands.append(self._located(Call(name, arguments), lines.span(start, tokens.previous_end())))
+                    continue
+                if groups:
+                    raise self._error("Expected ')'")
+                while operators:
+                    self._reduce(operands, operators.pop())
+                return operands.pop()
+
+    def _reduce(self, operands:list[AST], operator:tuple):
+        node_class = operator[1]
+        if node_class is Not:
+            term = operands[-1]
+            node = Not(term)
+            node.span = Span(*self.lexer.lines.location(operator[2]), term.span.end_line, term.span.end_column)
+        else:
+            right = operands.pop()
+            left = operands[-1]
+            node = node_class(left, right)
+            node.span = left.span.to(right.span)
+        operands[-1] = node
 
     def _parse_statement(self):
+        start = self.tokens.start()
         if self._peek(TokenType.RETURN):
-            return self._parse_return_statement()
+            statement = self._parse_return_statement()
         elif self._peek(TokenType.IF):
-            return self._parse_if_statement()
+            statement = self._parse_if_statement()
         elif self._peek(TokenType.WHILE):
-            return self._parse_while_statement()
+            statement = self._parse_while_statement()
         elif self._peek(TokenType.VAR):
-            return self._parse_var_statement()
+            statement = self._parse_var_statement()
         elif self._peek(TokenType.IDENTIFIER) and self._peeknext(TokenType.ASSIGN):
-            return self._parse_assignment_statement()
+            statement = self._parse_assignment_statement()
         elif self._peek(TokenType.LBRACE):
-            return self._parse_block_statement()
+            statement = self._parse_block_statement()
         elif self._peek(TokenType.FUNCTION):
-            return self._parse_function_statement()
+            statement = self._parse_function_statement()
         elif self._peek(TokenType.IDENTIFIER):
-            return self._parse_expression_statement()
-        
+            statement = self._parse_expression_statement()
+        else:
+            raise self._error('Expected statement')
+        if not hasattr(statement, 'span'):
+            self._located(statement, self._span_from(start))
+        return statement
+
     def _parse_function_statement(self):
         if self._match(TokenType.FUNCTION):
             self._consume(TokenType.IDENTIFIER, "Expected function name")
             function_name = str(self.previous_token.value)
-            self._consume(TokenType.LPAREN, "Expected parameters")
+            self._consume(TokenType.LPAREN, "Expected '('")
             paramenters = self._parse_parameters()
-            self._consume(TokenType.RPAREN, "Expected Right PAREN")
+            self._consume(TokenType.RPAREN, "Expected ')'")
             body = self._parse_block_statement()
-            # if function_name == 'main':
-            #     return Main(body.statements)
             return Function(function_name, paramenters, body)
 
     def _parse_parameters(self):
         paramenters = []
         if not self._peek(TokenType.RPAREN):
-            self._consume(TokenType.IDENTIFIER, "Expectede parameters")
+            self._consume(TokenType.IDENTIFIER, "Expected parameter name")
             paramenters.append(self.previous_token.value)
             while self._match(TokenType.COMMA):
-                self._consume(TokenType.IDENTIFIER, "Expected parameters")          
+                self._consume(TokenType.IDENTIFIER, "Expected parameter name")
                 paramenters.append(self.previous_token.value)
         return paramenters
 
     def _parse_block_statement(self):
-        self._consume(TokenType.LBRACE, "Expected {")
+        start = self.tokens.start()
+        self._consume(TokenType.LBRACE, "Expected '{'")
         statements = []
-        while not self._peek(TokenType.RBRACE):
+        while not self._peek(TokenType.RBRACE) and not self._peek('EOF'):
             statements.append(self._parse_statement())
-        self._consume(TokenType.RBRACE, "Expected }")
-        return Block(statements)
+        self._consume(TokenType.RBRACE, "Expected '}'")
+        return self._located(Block(statements), self._span_from(start))
 
     def _parse_assignment_statement(self):
         if self._match(TokenType.IDENTIFIER):
             name = str(self.previous_token.value)
             if self._match(TokenType.ASSIGN):
                 value = self._parse_expression()
-                self._consume(TokenType.SEMICOLON, "Expected ;")
+                self._consume(TokenType.SEMICOLON, "Expected ';'")
                 return Assign(name, value)
 
     def _parse_var_statement(self):
-        self._consume(TokenType.VAR, "Expected")
-        self._consume(TokenType.IDENTIFIER, "Expected")
+        self._consume(TokenType.VAR, "Expected 'var'")
+        self._consume(TokenType.IDENTIFIER, "Expected variable name")
         var_name = str(self.previous_token.value)
-        self._consume(TokenType.ASSIGN, "Expected")
+        self._consume(TokenType.ASSIGN, "Expected '='")
         value = self._parse_expression()
-        self._consume(TokenType.SEMICOLON, "Expected")
+        self._consume(TokenType.SEMICOLON, "Expected ';'")
         return Var(var_name, value)
 
     def _parse_while_statement(self):
-        self._consume(TokenType.WHILE, "Expected")
-        self._consume(TokenType.LPAREN, "Expected")
+        self._consume(TokenType.WHILE, "Expected 'while'")
+        self._consume(TokenType.LPAREN, "Expected '('")
         conditional = self._parse_expression()
-        self._consume(TokenType.RPAREN, "Expected")
+        self._consume(TokenType.RPAREN, "Expected ')'")
         body = self._parse_block_statement()
         return While(conditional, body)
 
     def _parse_if_statement(self):
-        self._consume(TokenType.IF, "Expected")
-        self._consume(TokenType.LPAREN, "Expected")
+        self._consume(TokenType.IF, "Expected 'if'")
+        self._consume(TokenType.LPAREN, "Expected '('")
         conditional = self._parse_expression()
-        self._consume(TokenType.RPAREN, "Expected")
+        self._consume(TokenType.RPAREN, "Expected ')'")
         consequence = self._parse_statement()
         if self._match(TokenType.ELSE):
             alternative = self._parse_statement()
             return If(conditional, consequence, alternative)
-        return If(conditional, consequence, Block([]))
+        end = self.tokens.previous_end()
+        return If(conditional, consequence, self._located(Block([]), self.lexer.lines.span(end, end)))
 
     def _parse_expression_statement(self):
         expression = self._parse_expression()
-        self._consume(TokenType.SEMICOLON, "exptec")
+        self._consume(TokenType.SEMICOLON, "Expected ';'")
         return expression
 
     def _parse_return_statement(self):
-        self._consume(TokenType.RETURN, "expected")
+        self._consume(TokenType.RETURN, "Expected 'return'")
         expression = self._parse_expression()
-        self._consume(TokenType.SEMICOLON, "expected")
+        self._consume(TokenType.SEMICOLON, "Expected ';'")
         return Return(expression)
     
     def _match(self, token_type:TokenType) -> bool:
         if self._peek(token_type):
-            self.previous_token = self.current_token
-            self.current_token = self.lexer.get_next_token()
+            self.tokens.advance()
             return True
         return False
 
     def _peek(self, token_type:TokenType) -> bool:
-        if(self.current_token == token_type):
+        if(self.tokens.peek_type() == TOKEN_CODES[token_type]):
             return True
         return False
 
     def _peeknext(self, token_type:TokenType) -> bool:
-        return self.lexer.peek_next_token() == token_type
+        return self.tokens.peek_type(1) == TOKEN_CODES[token_type]
 
     def _consume(self, token_type:TokenType, message:str):
         if self._peek(token_type):
-            self.previous_token = self.current_token
-            self.current_token = self.lexer.get_next_token()
+            self.tokens.advance()
         else:
-            raise Exception(self.lexer.get_current_line_in_source())
\ No newline at end of file
+            raise self._error(message)
+
+    def _error(self, message:str) -> Exception:
+        # Reported at the start of the token the parser stopped at
+        return Exception(self.lexer.describe(self.tokens.start(), message))
+
+    def _span_from(self, start:int) -> Span:
+        # From the source offset start up to the end of the last token consumed
+        return self.lexer.lines.span(start, self.tokens.previous_end())
+
+    def _located(self, node:AST, span:Span) -> AST:
+        node.span = span
+        return node
\ No newline at end of file
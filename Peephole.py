@@ -0,0 +1,230 @@
+import re
+from collections import Counter
+from AST import Output
+
+# Operands are split on commas outside of [...] and {...}
+OPERAND_SEPARATOR = re.compile(r',\s*(?![^\[]*\])(?![^{]*\})')
+
+BRANCHES = {'b', 'beq', 'bne', 'blt', 'bgt', 'ble', 'bge', 'blo', 'bhi', 'bls', 'bhs'}
+
+class Label:
+    __slots__ = ('name',)
+
+    def __init__(self, name:str):
+        self.name = name
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.name == other.name
+
+    def __str__(self):
+        return f'{self.name}:'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+class Instruction:
+    __slots__ = ('opcode', 'operands')
+
+    def __init__(self, opcode:str, operands:list[str] = []):
+        self.opcode = opcode
+        self.operands = list(operands)
+
+    @staticmethod
+    def parse(line:str):
+        line = line.strip()
+        if line.endswith(':'):
+            return Label(line[:-1])
+        opcode, _, rest = line.partition(' ')
+        if opcode in ('push', 'pop'):
+            return Instruction(opcode, [register.strip() for register in rest.strip('{} ').split(',')])
+        return Instruction(opcode, OPERAND_SEPARATOR.split(rest) if rest else [])
+
+    @property
+    def is_directive(self) -> bool:
+        return self.opcode == '' or self.opcode.startswith('.')
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.opcode == other.opcode and self.operands == other.operands
+
+    def __str__(self):
+        if self.opcode in ('push', 'pop'):
+            return f'{self.opcode} {{{", ".join(self.operands)}}}'
+        if self.operands:
+            return f'{self.opcode} {", ".join(self.operands)}'
+        return self.opcode
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self})'
+
+def is_immediate(value:int) -> bool:
+    # An arm32 data processing immediate is an 8 bit value rotated right by an even amount
+    value &= 0xffffffff
+    for rotation in range(0, 32, 2):
+        if ((value << rotation) | (value >> (32 - rotation))) & 0xffffffff < 256:
+            return True
+    return False
+
+def is_instruction(item) -> bool:
+    return isinstance(item, Instruction) and not item.is_directive
+
+def ends_flow(item) -> bool:
+    if not isinstance(item, Instruction):
+        return False
+    if item.opcode == 'b' or (item.opcode == 'bx' and item.operands == ['lr']):
+        return True
+    return item.opcode == 'pop' and 'pc' in item.operands
+
+def literal(operand:str) -> int | None:
+    if operand.startswith('='):
+        try:
+            return int(operand[1:], 0)
+        except ValueError:
+            return None
+    return None
+
+# Each rule looks at the code from index i and returns how many items it consumed
+# together with their replacement, or None when it does not apply
+
+def push_pop(code:list, i:int, references:Counter):
+    # push {rX, ip} / pop {rY, ip} is a register move
+    first, second = code[i], code[i + 1] if i + 1 < len(code) else None
+    if not (isinstance(first, Instruction) and first.opcode == 'push' and len(first.operands) == 2 and first.operands[1] == 'ip'):
+        return None
+    if not (isinstance(second, Instruction) and second.opcode == 'pop' and len(second.operands) == 2 and second.operands[1] == 'ip'):
+        return None
+    source, target = first.operands[0], second.operands[0]
+    return 2, [] if source == target else [Instruction('mov', [target, source])]
+
+def push_load_pop(code:list, i:int, references:Counter):
+    # push {rX, ip} / <load into rX> / pop {rY, ip} keeps the pushed value in rY instead
+    if i + 2 >= len(code):
+        return None
+    first, load, last = code[i], code[i + 1], code[i + 2]
+    if not (isinstance(first, Instruction) and first.opcode == 'push' and len(first.operands) == 2 and first.operands[1] == 'ip'):
+        return None
+    if not (isinstance(last, Instruction) and last.opcode == 'pop' and len(last.operands) == 2 and last.operands[1] == 'ip'):
+        return None
+    source, target = first.operands[0], last.operands[0]
+    if not (isinstance(load, Instruction) and load.opcode in ('ldr', 'mov') and load.operands[0] == source and source != target):
+        return None
+    if load.opcode == 'mov' and not load.operands[1].startswith('#'):
+        return None
+    if load.opcode == 'ldr' and not (literal(load.operands[1]) is not None or load.operands[1].startswith('[fp,')):
+        return None
+    return 3, [Instruction('mov', [target, source]), load]
+
+def small_constant(code:list, i:int, references:Counter):
+    # ldr rX, =N loads from a literal pool, mov/mvn encode N in the instruction
+    item = code[i]
+    if not (isinstance(item, Instruction) and item.opcode == 'ldr' and len(item.operands) == 2):
+        return None
+    value = literal(item.operands[1])
+    if value is None:
+        return None
+    if is_immediate(value):
+        return 1, [Instruction('mov', [item.operands[0], f'#{value & 0xffffffff if value < 0 else value}'])]
+    if is_immediate(~value):
+        return 1, [Instruction('mvn', [item.operands[0], f'#{~value & 0xffffffff}'])]
+    return None
+
+def self_move(code:list, i:int, references:Counter):
+    item = code[i]
+    if isinstance(item, Instruction) and item.opcode == 'mov' and len(item.operands) == 2 and item.operands[0] == item.operands[1]:
+        return 1, []
+    return None
+
+def branch_to_next(code:list, i:int, references:Counter):
+    # A branch to one of the labels that directly follow it falls through anyway
+    item = code[i]
+    if not (isinstance(item, Instruction) and item.opcode in BRANCHES and len(item.operands) == 1):
+        return None
+    j = i + 1
+    while j < len(code) and isinstance(code[j], Label):
+        if code[j].name == item.operands[0]:
+            references[item.operands[0]] -= 1
+            return 1, []
+        j += 1
+    return None
+
+def unreachable(code:list, i:int, references:Counter):
+    # Nothing after an unconditional branch or return runs until the next label
+    if not (ends_flow(code[i]) and i + 1 < len(code) and is_instruction(code[i + 1])):
+        return None
+    removed = code[i + 1]
+    if removed.opcode in BRANCHES:
+        references[removed.operands[0]] -= 1
+    return 2, [code[i]]
+
+def unused_label(code:list, i:int, references:Counter):
+    item = code[i]
+    if isinstance(item, Label) and item.name.startswith('.L') and references[item.name] <= 0:
+        return 1, []
+    return None
+
+RULES = [
+    ('push_pop', push_pop),
+    ('push_load_pop', push_load_pop),
+    ('small_constant', small_constant),
+    ('self_move', self_move),
+    ('branch_to_next', branch_to_next),
+    ('unreachable', unreachable),
+    ('unused_label', unused_label),
+]
+
+class Ahead:
+    # The code still to be looked at is kept reversed so consuming and putting back items
+    # happen at its end, this indexes it from the current item on like the rules expect
+    __slots__ = ('pending',)
+
+    def __init__(self, pending:list):
+        self.pending = pending
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __getitem__(self, i:int):
+        return self.pending[-1 - i]
+
+class Peephole:
+    def __init__(self, rules:list = RULES):
+        self.rules = rules
+        self.stats = Counter()
+
+    def run(self, code:list) -> list:
+        references = Counter(item.operands[0] for item in code if isinstance(item, Instruction) and item.opcode in BRANCHES)
+        while True:
+            code = self.forward(code, references)
+            # A branch removed late in a pass can leave a label already passed unreferenced
+            if not any(isinstance(item, Label) and item.name.startswith('.L') and references[item.name] <= 0 for item in code):
+                return code
+
+    def forward(self, code:list, references:Counter) -> list:
+        pending = code[::-1]
+        ahead = Ahead(pending)
+        output = []
+        while pending:
+            for name, rule in self.rules:
+                result = rule(ahead, 0, references)
+                if result is None:
+                    continue
+                consumed, replacement = result
+                removed = pending[-consumed:]
+                self.stats[name] += sum(map(is_instruction, removed)) - sum(map(is_instruction, replacement))
+                self.stats[f'{name}.applied'] += 1
+                del pending[-consumed:]
+                pending.extend(reversed(replacement))
+                # Step back so rules spanning the rewritten spot see the new neighbours
+                for _ in range(min(2, len(output))):
+                    pending.append(output.pop())
+                break
+            else:
+                output.append(pending.pop())
+        return output
+
+def optimize_output(output:Output, stats:Counter = None) -> Output:
+    peephole = Peephole()
+    code = peephole.run([Instruction.parse(line) for line in output.lines])
+    output.lines = [str(item) for item in code]
+    if stats is not None:
+        stats.update(peephole.stats)
+    return output
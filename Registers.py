@@ -0,0 +1,316 @@
+from AST import *
+from Optimizer import Transformer, copy_span, walk
+
+# r11 is the frame pointer and ip is kept as a temporary for spills and moves
+SCRATCH_REGISTERS = ['r0', 'r1', 'r2', 'r3']
+SAVED_REGISTERS = ['r4', 'r5', 'r6', 'r7', 'r8', 'r9', 'r10']
+
+EXPRESSIONS = (Number, Id, Not, Equal, NotEqual, Less, Greater, Add, Subtract, Multiply, Divide, MultiplyByConstant, DivideByConstant, Call)
+
+# Binary nodes the stack machine evaluates right operand first, kept when both sides call
+RIGHT_FIRST = (Add, Subtract, Multiply, Divide)
+
+OPERATIONS = {
+    Add: 'add',
+    Subtract: 'sub',
+    Multiply: 'mul',
+    Divide: 'udiv',
+}
+
+# Conditional moves setting the result of a comparison, comparisons are signed
+COMPARISONS = {
+    Equal: (('eq', '#1'), ('ne', '#0')),
+    NotEqual: (('eq', '#0'), ('ne', '#1')),
+    Less: (('lt', '#1'), ('ge', '#0')),
+    Greater: (('gt', '#1'), ('le', '#0')),
+}
+
+def has_call(node:AST) -> bool:
+    return any(isinstance(child, Call) for child in walk(node))
+
+def need(node:AST) -> int:
+    # Sethi-Ullman number: registers needed to evaluate node without spilling
+    if isinstance(node, (Not, MultiplyByConstant)):
+        return need(node.term)
+    if isinstance(node, DivideByConstant):
+        # The reciprocal multiplication takes two more
+        return max(need(node.term), 3)
+    if isinstance(node, (Number, Id, Call)):
+        return 1
+    left, right = need(node.left), need(node.right)
+    return left + 1 if left == right else max(left, right)
+
+def parallel_move(moves:list[tuple[str, str]]) -> list[str]:
+    # Sequentialise a parallel register move, breaking cycles through ip
+    lines = []
+    moves = [(source, target) for source, target in moves if source != target]
+    while moves:
+        for i, (source, target) in enumerate(moves):
+            if all(other_source != target for other_source, _ in moves):
+                lines.append(f'mov {target}, {source}')
+                moves.pop(i)
+                break
+        else:
+            source, target = moves[0]
+            lines.append(f'mov ip, {source}')
+            moves = [('ip' if other_source == source else other_source, other_target) for other_source, other_target in moves]
+    return lines
+
+class RegisterAllocator:
+    def __init__(self, output:Output, locals:dict[str, int] = None, saved_registers:list[str] = SAVED_REGISTERS):
+        self.output = output
+        self.locals = locals
+        self.scratch = list(SCRATCH_REGISTERS)
+        self.saved = list(saved_registers)
+        self.saved_used = set()
+
+    def free_count(self) -> int:
+        return len(self.scratch) + len(self.saved)
+
+    def allocate(self, saved:bool) -> str:
+        pools = (self.saved, self.scratch) if saved else (self.scratch, self.saved)
+        for pool in pools:
+            if pool:
+                register = pool.pop(0)
+                if register in SAVED_REGISTERS:
+                    self.saved_used.add(register)
+                return register
+        raise Exception('Out of registers')
+
+    def take(self, register:str):
+        self.scratch.remove(register)
+
+    def release(self, register:str):
+        pool = self.saved if register in SAVED_REGISTERS else self.scratch
+        pool.append(register)
+        pool.sort(key=lambda name: int(name[1:]))
+
+    def generate(self, node:AST, saved:bool = False) -> str:
+        if isinstance(node, Number):
+            register = self.allocate(saved)
+            self.output.emit(f'ldr {register}, ={node.value}')
+            return register
+        elif isinstance(node, Id):
+            register = self.allocate(saved)
+            if self.locals is None:
+                offset = 0
+            elif node.value in self.locals:
+                offset = self.locals[node.value]
+            else:
+                raise Exception(node.located(f'Undefined variable: {node.value}'))
+            self.output.emit(f'ldr {register}, [fp, #{offset}]')
+            return register
+        elif isinstance(node, Not):
+            register = self.generate(node.term, saved)
+            self.output.emit(f'cmp {register}, #0')
+            self.output.emit(f'moveq {register}, #1')
+            self.output.emit(f'movne {register}, #0')
+            return register
+        elif isinstance(node, MultiplyByConstant):
+            register = self.generate(node.term, saved)
+            for line in shift_add_lines(register, node.constant):
+                self.output.emit(line)
+            return register
+        elif isinstance(node, DivideByConstant):
+            register = self.generate(node.term, saved)
+            high, low = self.allocate(False), self.allocate(False)
+            for line in reciprocal_lines(register, high, low, node.divisor):
+                self.output.emit(line)
+            self.release(high)
+            self.release(low)
+            return register
+        elif isinstance(node, Call):
+            return self.generate_call(node, saved)
+        return self.generate_binary(node, saved)
+
+    def generate_binary(self, node:AST, saved:bool, flags_only:bool = False) -> str:
+        left_call, right_call = has_call(node.left), has_call(node.right)
+        if left_call and right_call:
+            first = node.right if isinstance(node, RIGHT_FIRST) else node.left
+        elif left_call or right_call:
+            # Evaluating the call first means nothing has to be held across it
+            first = node.left if left_call else node.right
+        else:
+            first = node.left if need(node.left) >= need(node.right) else node.right
+        second = node.right if first is node.left else node.left
+        second_call = has_call(second)
+
+        held = self.generate(first, saved or second_call)
+        if (second_call and held not in SAVED_REGISTERS) or self.free_count() < need(second):
+            self.output.emit(f'push {{{held}, ip}}')
+            self.release(held)
+            other = self.generate(second, saved)
+            self.output.emit('pop {ip, lr}')
+            held, result = 'ip', other
+        else:
+            other = self.generate(second)
+            result = held
+
+        left, right = (held, other) if first is node.left else (other, held)
+        if type(node) in COMPARISONS:
+            self.output.emit(f'cmp {left}, {right}')
+            if flags_only:
+                for register in (held, other):
+                    if register != 'ip':
+                        self.release(register)
+                return None
+            for condition, value in COMPARISONS[type(node)]:
+                self.output.emit(f'mov{condition} {result}, {value}')
+        else:
+            self.output.emit(f'{OPERATIONS[type(node)]} {result}, {left}, {right}')
+
+        unused = other if result == held else held
+        if unused != 'ip':
+            self.release(unused)
+        return result
+
+    def generate_condition(self, node:AST) -> str:
+        # Sets the flags for a branch on node and returns the condition that holds when it is
+        # not zero, a comparison leaves its result in the flags
+        if type(node) in COMPARISONS:
+            self.generate_binary(node, False, flags_only=True)
+            return next(condition for condition, value in COMPARISONS[type(node)] if value == '#1')
+        register = self.generate(node)
+        self.output.emit(f'cmp {register}, #0')
+        self.release(register)
+        return 'ne'
+
+    def generate_call(self, node:Call, saved:bool) -> str:
+        if len(node.arguments) > 4:
+            return self.generate_stack_call(node, saved)
+
+        # A library division evaluates its operands in the order of the Divide it replaces
+        order = list(range(len(node.arguments)))
+        if isinstance(node, DivideCall) and all(has_call(argument) for argument in node.arguments):
+            order.reverse()
+        registers = [None] * len(node.arguments)
+        spilled = []
+        for position, i in enumerate(order):
+            later = [node.arguments[j] for j in order[position + 1:]]
+            later_call = any(has_call(argument) for argument in later)
+            register = self.generate(node.arguments[i], later_call)
+            later_need = max((need(argument) for argument in later), default=0)
+            if (later_call and register not in SAVED_REGISTERS) or self.free_count() < later_need:
+                self.output.emit(f'push {{{register}, ip}}')
+                self.release(register)
+                spilled.append(f'r{i}')
+            else:
+                registers[i] = register
+
+        self.move([(source, f'r{i}') for i, source in enumerate(registers) if source is not None])
+        for target in reversed(spilled):
+            self.output.emit(f'pop {{{target}, ip}}')
+        for register in registers:
+            if register is not None:
+                self.release(register)
+
+        self.output.emit(f'bl {node.callee}')
+        return self.call_result(saved)
+
+    def generate_stack_call(self, node:Call, saved:bool) -> str:
+        # Like the stack backend, every argument is stored to an area reserved below sp as soon
+        # as it is evaluated, the first four are then popped into r0 to r3
+        count = len(node.arguments)
+        self.output.emit(f'sub sp, sp, #{align(4 * count)}')
+        for i, argument in enumerate(node.arguments):
+            register = self.generate(argument)
+            self.output.emit(f'str {register}, [sp, #{4 * i}]')
+            self.release(register)
+        self.output.emit('pop {r0, r1, r2, r3}')
+        self.output.emit(f'bl {node.callee}')
+        self.output.emit(f'add sp, sp, #{stack_arguments_size(count)}')
+        return self.call_result(saved)
+
+    def call_result(self, saved:bool) -> str:
+        self.take('r0')
+        if saved and self.saved:
+            register = self.allocate(True)
+            self.output.emit(f'mov {register}, r0')
+            self.release('r0')
+            return register
+        return 'r0'
+
+    def move(self, moves:list[tuple[str, str]]):
+        for line in parallel_move(moves):
+            self.output.emit(line)
+
+class RegisterExpression(AST):
+    __slots__ = ('term',)
+
+    def __init__(self, term:AST):
+        self.term = term
+
+    def emit(self, env:Environment):
+        allocator = RegisterAllocator(env.output, env.locals, [register for register in env.saved_registers if register in SAVED_REGISTERS])
+        register = allocator.generate(self.term)
+        if register != 'r0':
+            env.output.emit(f'mov r0, {register}')
+
+    def branch_steps(self, env:Environment, true_label:str, false_label:str):
+        node = self.term
+        while isinstance(node, Not):
+            node, true_label, false_label = node.term, false_label, true_label
+        if isinstance(node, Number):
+            yield from node.branch_steps(env, true_label, false_label)
+            return
+        allocator = RegisterAllocator(env.output, env.locals, [register for register in env.saved_registers if register in SAVED_REGISTERS])
+        yield from branch_lines(allocator.generate_condition(node), true_label, false_label)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.term})'
+
+class RegisterFunction(Function):
+    # What the body needs saved is worked out from the fields, it is no field itself
+    __slots__ = ('saved_registers', 'frame_registers')
+    _fields = Function._fields
+
+    def __init__(self, name:str, paramenters:list[AST], body:AST):
+        super().__init__(name, paramenters, body)
+        # Dry run every expression to find the callee-saved registers the body needs
+        used = set()
+        for node in walk(body):
+            if isinstance(node, RegisterExpression):
+                allocator = RegisterAllocator(Output())
+                allocator.generate(node.term)
+                used |= allocator.saved_used
+        self.saved_registers = [register for register in SAVED_REGISTERS if register in used]
+        # Saved registers go below lr, padded with ip to keep the stack 8 byte aligned
+        self.frame_registers = self.saved_registers + ['ip'] * (len(self.saved_registers) % 2 == 0)
+
+    def emit_prologue(self, env:Environment):
+        if not self.saved_registers:
+            super().emit_prologue(env)
+            return
+        env.output.emit(f'push {{{", ".join(self.frame_registers)}, lr}}')
+        env.output.emit('push {fp, ip}')
+        env.output.emit('mov fp, sp')
+        self.emit_entry(env)
+        self.emit_frame(env)
+
+    def emit_epilogue(self, env:Environment):
+        if not self.saved_registers:
+            super().emit_epilogue(env)
+            return
+        env.output.emit('mov sp, fp')
+        env.output.emit('mov r0, #0')
+        env.output.emit('pop {fp, ip}')
+        env.output.emit(f'pop {{{", ".join(self.frame_registers)}, pc}}')
+
+    def stack_parameter_offset(self, index:int) -> int:
+        # Above the saved fp and ip come the saved registers and lr
+        return super().stack_parameter_offset(index) + 4 * (len(self.frame_registers) + 1) * bool(self.saved_registers)
+
+    def set_environment(self, output:Output):
+        env = super().set_environment(output)
+        if self.saved_registers:
+            env.saved_registers = self.frame_registers
+        return env
+
+class RegisterBackend(Transformer):
+    def visit(self, node:AST) -> AST:
+        if isinstance(node, EXPRESSIONS):
+            return copy_span(RegisterExpression(node), node)
+        return super().visit(node)
+
+    def visit_Function(self, node:Function) -> AST:
+        return RegisterFunction(node.name, node.paramenters, self.visit(node.body))
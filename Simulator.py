@@ -0,0 +1,241 @@
+import re
+from AST import DIVIDE_FUNCTION
+
+# Runs the arm32 the compiler emits, for tests and benchmarks on hosts without an ARM
+# toolchain. Only the instructions the backends produce are known. Memory is a dict of
+# words, putchar and the library division are built in, and every executed instruction,
+# branch and conditional move is counted.
+
+MASK = 0xffffffff
+REGISTERS = {f'r{i}': i for i in range(13)} | {'fp': 11, 'ip': 12, 'sp': 13, 'lr': 14, 'pc': 15}
+CONDITIONS = {'eq', 'ne', 'lt', 'gt', 'le', 'ge', 'lo', 'hs', 'hi', 'ls', 'mi', 'pl', 'cc', 'cs'}
+OPCODES = ['push', 'pop', 'ldr', 'str', 'mov', 'mvn', 'add', 'sub', 'rsb', 'and', 'orr', 'eor', 'lsl', 'lsr', 'asr',
+           'mul', 'mla', 'umull', 'smull', 'udiv', 'sdiv', 'cmp', 'cmn', 'bl', 'bx', 'b']
+OPERAND_SEPARATOR = re.compile(r',\s*(?![^\[]*\])(?![^{]*\})')
+# Returning to this address ends the run, registers a call clobbers are filled with junk
+RETURN_ADDRESS = 0xdead0000
+CLOBBERED = (1, 2, 3, 12)
+JUNK = 0x5a5a5a5a
+STACK_TOP = 0x80000000
+
+def signed(value:int) -> int:
+    value &= MASK
+    return value - (MASK + 1) if value & 0x80000000 else value
+
+def split_opcode(mnemonic:str) -> tuple[str, str]:
+    # The longest known opcode the mnemonic starts with, the rest must be a condition
+    for opcode in OPCODES:
+        if mnemonic.startswith(opcode) and (mnemonic[len(opcode):] in CONDITIONS or mnemonic == opcode):
+            return opcode, mnemonic[len(opcode):]
+    raise Exception(f'Unknown instruction: {mnemonic}')
+
+class Simulator:
+    def __init__(self, assembly:str, max_steps:int = 100_000_000):
+        self.code = []
+        self.labels = {}
+        for line in assembly.splitlines():
+            line = line.split('@')[0].strip()
+            if line.endswith(':'):
+                self.labels[line[:-1]] = len(self.code)
+            elif line and not line.startswith('.'):
+                mnemonic, _, rest = line.partition(' ')
+                opcode, condition = split_opcode(mnemonic)
+                self.code.append((opcode, condition, OPERAND_SEPARATOR.split(rest.strip()) if rest else [], line))
+        self.max_steps = max_steps
+        self.registers = [0] * 16
+        self.memory = {}
+        self.output = bytearray()
+        self.negative = self.zero = self.carry = self.overflow = False
+        self.steps = 0
+        self.branches = 0
+        self.conditional_moves = 0
+        self.calls = 0
+
+    def holds(self, condition:str) -> bool:
+        if condition == '':
+            return True
+        if condition == 'eq':
+            return self.zero
+        if condition == 'ne':
+            return not self.zero
+        if condition == 'lt':
+            return self.negative != self.overflow
+        if condition == 'ge':
+            return self.negative == self.overflow
+        if condition == 'gt':
+            return not self.zero and self.negative == self.overflow
+        if condition == 'le':
+            return self.zero or self.negative != self.overflow
+        if condition in ('hs', 'cs'):
+            return self.carry
+        if condition in ('lo', 'cc'):
+            return not self.carry
+        if condition == 'hi':
+            return self.carry and not self.zero
+        if condition == 'ls':
+            return not self.carry or self.zero
+        if condition == 'mi':
+            return self.negative
+        return not self.negative
+
+    def compare(self, a:int, b:int):
+        result = (a - b) & MASK
+        self.negative = bool(result & 0x80000000)
+        self.zero = result == 0
+        self.carry = a >= b
+        self.overflow = bool((a ^ b) & (a ^ result) & 0x80000000)
+
+    def register(self, name:str) -> int:
+        try:
+            return REGISTERS[name.strip()]
+        except KeyError:
+            raise Exception(f'Unknown register: {name}')
+
+    def operand(self, operands:list[str]) -> int:
+        # An immediate or a register, optionally shifted: #5, r1, r1, lsl #2
+        first = operands[0]
+        value = int(first[1:], 0) & MASK if first.startswith('#') else self.registers[self.register(first)]
+        if len(operands) > 1:
+            shift, amount = operands[1].split()
+            amount = int(amount[1:], 0) if amount.startswith('#') else self.registers[self.register(amount)] & 0xff
+            value = self.shift(shift, value, amount)
+        return value
+
+    def shift(self, shift:str, value:int, amount:int) -> int:
+        if shift == 'lsl':
+            return (value << amount) & MASK
+        if shift == 'lsr':
+            return value >> amount if amount < 32 else 0
+        if shift == 'asr':
+            return (signed(value) >> min(amount, 31)) & MASK
+        raise Exception(f'Unknown shift: {shift}')
+
+    def address(self, operand:str) -> int:
+        base, _, offset = operand.strip('[]').partition(',')
+        offset = offset.strip()
+        value = self.registers[self.register(base)]
+        if offset:
+            value += int(offset[1:], 0) if offset.startswith('#') else self.registers[self.register(offset)]
+        return value & MASK
+
+    def register_list(self, operand:str) -> list[int]:
+        return sorted(self.register(name) for name in operand.strip('{}').split(','))
+
+    def call_builtin(self, name:str) -> bool:
+        registers = self.registers
+        if name == 'putchar':
+            registers[0] &= 0xff
+            self.output.append(registers[0])
+        elif name == DIVIDE_FUNCTION:
+            registers[0] = registers[0] // registers[1] if registers[1] else 0
+        else:
+            return False
+        for i in CLOBBERED:
+            registers[i] = JUNK
+        return True
+
+    def run(self, entry:str = 'main', arguments:list[int] = []) -> int:
+        registers = self.registers
+        for i, argument in enumerate(arguments):
+            registers[i] = argument & MASK
+        registers[13] = STACK_TOP
+        registers[14] = RETURN_ADDRESS
+        try:
+            pc = self.labels[entry]
+        except KeyError:
+            raise Exception(f'Undefined function: {entry}')
+        code = self.code
+        while True:
+            if pc == RETURN_ADDRESS:
+                return signed(registers[0])
+            self.steps += 1
+            if self.steps > self.max_steps:
+                raise Exception(f'More than {self.max_steps} instructions executed')
+            opcode, condition, operands, line = code[pc]
+            pc += 1
+            if opcode in ('b', 'bl', 'bx'):
+                self.branches += 1
+            elif condition:
+                self.conditional_moves += 1
+            if not self.holds(condition):
+                continue
+
+            if opcode == 'b':
+                pc = self.labels[operands[0]]
+            elif opcode == 'bl':
+                self.calls += 1
+                if not self.call_builtin(operands[0]):
+                    registers[14] = pc
+                    pc = self.labels[operands[0]]
+            elif opcode == 'bx':
+                pc = registers[self.register(operands[0])]
+            elif opcode == 'push':
+                names = self.register_list(operands[0])
+                registers[13] -= 4 * len(names)
+                for i, name in enumerate(names):
+                    self.memory[registers[13] + 4 * i] = registers[name]
+            elif opcode == 'pop':
+                names = self.register_list(operands[0])
+                for i, name in enumerate(names):
+                    value = self.memory.get(registers[13] + 4 * i, 0)
+                    if name == 15:
+                        pc = value
+                    else:
+                        registers[name] = value
+                registers[13] += 4 * len(names)
+            elif opcode == 'ldr':
+                if operands[1].startswith('='):
+                    registers[self.register(operands[0])] = int(operands[1][1:], 0) & MASK
+                else:
+                    registers[self.register(operands[0])] = self.memory.get(self.address(operands[1]), 0)
+            elif opcode == 'str':
+                self.memory[self.address(operands[1])] = registers[self.register(operands[0])]
+            elif opcode == 'mov':
+                registers[self.register(operands[0])] = self.operand(operands[1:])
+            elif opcode == 'mvn':
+                registers[self.register(operands[0])] = ~self.operand(operands[1:]) & MASK
+            elif opcode in ('add', 'sub', 'rsb', 'and', 'orr', 'eor'):
+                a, b = registers[self.register(operands[1])], self.operand(operands[2:])
+                if opcode == 'add':
+                    value = a + b
+                elif opcode == 'sub':
+                    value = a - b
+                elif opcode == 'rsb':
+                    value = b - a
+                elif opcode == 'and':
+                    value = a & b
+                elif opcode == 'orr':
+                    value = a | b
+                else:
+                    value = a ^ b
+                registers[self.register(operands[0])] = value & MASK
+            elif opcode in ('lsl', 'lsr', 'asr'):
+                registers[self.register(operands[0])] = self.shift(opcode, registers[self.register(operands[1])], self.operand(operands[2:]))
+            elif opcode == 'mul':
+                registers[self.register(operands[0])] = registers[self.register(operands[1])] * registers[self.register(operands[2])] & MASK
+            elif opcode == 'mla':
+                registers[self.register(operands[0])] = (registers[self.register(operands[1])] * registers[self.register(operands[2])] + registers[self.register(operands[3])]) & MASK
+            elif opcode in ('umull', 'smull'):
+                a, b = registers[self.register(operands[2])], registers[self.register(operands[3])]
+                product = a * b if opcode == 'umull' else signed(a) * signed(b)
+                registers[self.register(operands[0])] = product & MASK
+                registers[self.register(operands[1])] = (product >> 32) & MASK
+            elif opcode == 'udiv':
+                a, b = registers[self.register(operands[1])], registers[self.register(operands[2])]
+                registers[self.register(operands[0])] = a // b if b else 0
+            elif opcode == 'sdiv':
+                a, b = signed(registers[self.register(operands[1])]), signed(registers[self.register(operands[2])])
+                quotient = abs(a) // abs(b) if b else 0
+                registers[self.register(operands[0])] = (quotient if (a < 0) == (b < 0) else -quotient) & MASK
+            elif opcode == 'cmp':
+                self.compare(registers[self.register(operands[0])], self.operand(operands[1:]))
+            elif opcode == 'cmn':
+                self.compare(registers[self.register(operands[0])], -self.operand(operands[1:]) & MASK)
+            else:
+                raise Exception(f'Unhandled instruction: {line}')
+
+def simulate(assembly:str, entry:str = 'main', arguments:list[int] = []) -> tuple[int, bytes, Simulator]:
+    # The value entry returns, what it wrote with putchar and the simulator with its counters
+    simulator = Simulator(assembly)
+    value = simulator.run(entry, arguments)
+    return value, bytes(simulator.output), simulator
@@ -0,0 +1,582 @@
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from Lexer import *
+from Parser import *
+from Optimizer import OPTIMIZATIONS, Transformer, optimize
+from Peephole import optimize_output
+from Generator import generate_program
+from Registers import RegisterExpression
+from Simulator import simulate
+from main import compile_source, run
+
+class LegacyLexer(Lexer):
+    # The original lexer: every pattern is compiled and tried in order for every token
+    patterns = [
+        (r'return', TokenType.RETURN),
+        (r';', TokenType.SEMICOLON),
+        (r'if', TokenType.IF),
+        (r'else', TokenType.ELSE),
+        (r'function', TokenType.FUNCTION),
+        (r'var', TokenType.VAR),
+        (r'while', TokenType.WHILE),
+        (r'\d+', TokenType.NUMBER),
+        (r'!=', TokenType.NOTEQUAL),
+        (r'={2}', TokenType.EQUAL),
+        (r',', TokenType.COMMA),
+        (r'!', TokenType.NOT),
+        (r'=', TokenType.ASSIGN),
+        (r'\+', TokenType.PLUS),
+        (r'-', TokenType.MINUS),
+        (r'\*', TokenType.STAR),
+        (r'/', TokenType.SLASH),
+        (r'\(', TokenType.LPAREN),
+        (r'\)', TokenType.RPAREN),
+        (r'\{', TokenType.LBRACE),
+        (r'\}', TokenType.RBRACE),
+        (r'[a-zA-Z_][a-zA-Z0-9_]*', TokenType.IDENTIFIER)
+    ]
+
+    def get_next_token(self):
+        while self.pos < len(self.text) and (self.text[self.pos].isspace() or self.text[self.pos:self.pos + 2] == '//'):
+            if self.text[self.pos:self.pos + 2] == '//':
+                self.pos = self.text.find('\n', self.pos)
+                if self.pos == -1:
+                    self.pos = len(self.text)
+            else:
+                self.pos += 1
+
+        if self.pos >= len(self.text):
+            return Token('EOF')
+
+        for pattern, token_type in self.patterns:
+            match = re.compile(pattern).match(self.text, self.pos)
+            if match:
+                self.pos = match.end()
+                return Token(token_type, match.group())
+
+        self.error()
+
+class NaiveEvaluator:
+    # A plain tree walk over the AST for comparison with Interpreter: variables live in a dict
+    # per call, every node is dispatched on its class every time and return unwinds by exception
+    class Returned(Exception):
+        def __init__(self, value:int):
+            self.value = value
+
+    def __init__(self, tree:Block):
+        self.functions = {function.name: function for function in tree.statements}
+        self.output = bytearray()
+
+    def call(self, name:str, arguments:list[int]) -> int:
+        if name == 'putchar':
+            self.output.append(arguments[0] & 0xff)
+            return arguments[0] & 0xff
+        function = self.functions[name]
+        env = dict(zip(function.paramenters, arguments))
+        try:
+            self.execute(function.body, env)
+        except NaiveEvaluator.Returned as returned:
+            return returned.value
+        return 0
+
+    def execute(self, node:AST, env:dict):
+        if isinstance(node, Block):
+            for statement in node.statements:
+                self.execute(statement, env)
+        elif isinstance(node, Return):
+            raise NaiveEvaluator.Returned(self.evaluate(node.term, env))
+        elif isinstance(node, (Var, Assign)):
+            env[node.name] = self.evaluate(node.value, env)
+        elif isinstance(node, If):
+            self.execute(node.consequence if self.evaluate(node.conditional, env) else node.alternative, env)
+        elif isinstance(node, While):
+            while self.evaluate(node.conditional, env):
+                self.execute(node.body, env)
+        else:
+            self.evaluate(node, env)
+
+    def evaluate(self, node:AST, env:dict) -> int:
+        if isinstance(node, Number):
+            return node.value
+        if isinstance(node, Id):
+            return env[node.value]
+        if isinstance(node, Not):
+            return int(not self.evaluate(node.term, env))
+        if isinstance(node, Call):
+            return self.call(node.callee, [self.evaluate(argument, env) for argument in node.arguments])
+        left, right = self.evaluate(node.left, env), self.evaluate(node.right, env)
+        if isinstance(node, Add):
+            value = left + right
+        elif isinstance(node, Subtract):
+            value = left - right
+        elif isinstance(node, Multiply):
+            value = left * right
+        elif isinstance(node, Divide):
+            value = (left & 0xffffffff) // (right & 0xffffffff) if right & 0xffffffff else 0
+        elif isinstance(node, Equal):
+            value = int(left == right)
+        elif isinstance(node, NotEqual):
+            value = int(left != right)
+        elif isinstance(node, Less):
+            value = int(left < right)
+        else:
+            value = int(left > right)
+        return ((value + 0x80000000) & 0xffffffff) - 0x80000000
+
+# Programs the interpreters are timed on: deep recursion, and a loop doing arithmetic
+INTERPRETER_PROGRAMS = {
+    'factorial': """
+function factorial(n) {
+    if (n == 0) {
+        return 1;
+    }
+    return n * factorial(n - 1);
+}
+function main() {
+    var i = 0;
+    var total = 0;
+    while (i < 2000) {
+        total = total + factorial(i / 100 + 10);
+        i = i + 1;
+    }
+    putchar(48 + total / 1000000 / 100);
+}
+""",
+    'loop': """
+function main() {
+    var i = 0;
+    var sum = 0;
+    while (i < 100000) {
+        sum = sum + i * i / 3 - i;
+        if (sum > 1000000) {
+            sum = sum - 1000000;
+        }
+        i = i + 1;
+    }
+    putchar(48 + sum / 100000);
+}
+""",
+}
+
+# Loop heavy programs whose compiled code is run in the simulator: nested loops with
+# invariant arithmetic, and a loop whose condition reads a value it does not change
+LOOP_PROGRAMS = {
+    'nested': """
+function work(n, scale, offset) {
+    var i = 0;
+    var total = 0;
+    while (i < n) {
+        var j = 0;
+        while (j < n) {
+            total = total + (scale * offset + n / 3) * j - i * (scale + 1);
+            j = j + 1;
+        }
+        i = i + 1;
+    }
+    return total;
+}
+function main() {
+    var total = work(100, 7, 3);
+    putchar(48 + total / 10000000);
+    return total;
+}
+""",
+    'countdown': """
+function count(limit, step) {
+    var left = limit * step;
+    var steps = 0;
+    while (left > step * 2 + 1) {
+        left = left - step;
+        steps = steps + 1;
+    }
+    return steps;
+}
+function main() {
+    var total = 0;
+    var k = 0;
+    while (k < 30) {
+        total = total + count(200, k + 1);
+        k = k + 1;
+    }
+    putchar(48 + total / 1000);
+    return total;
+}
+""",
+}
+
+# Small helpers called in a loop, the calls the inliner removes
+INLINING_PROGRAM = """
+function square(x) {
+    return x * x;
+}
+function clamp(x, limit) {
+    if (x > limit) {
+        return limit;
+    }
+    return x;
+}
+function main() {
+    var i = 0;
+    var total = 0;
+    while (i < 500) {
+        var next = square(i + 1);
+        total = total + clamp(square(i), 1000) + next;
+        i = i + 1;
+    }
+    putchar(48 + total / 10000000);
+    return total;
+}
+"""
+
+# Compile options the simulated benchmarks compare
+SIMULATED_OPTIONS = {
+    'O0': {'optimization_level': 0},
+    'O1': {'optimization_level': 1},
+    'O1 registers': {'optimization_level': 1, 'backend': 'registers'},
+    'O1 ir': {'optimization_level': 1, 'backend': 'ir'},
+}
+
+def bench_simulated(programs:dict[str, str], simulated_options:dict[str, dict] = SIMULATED_OPTIONS) -> dict[str, dict[str, dict[str, int]]]:
+    # Instructions, branches and conditional moves executed, every option checked against the interpreter
+    results = {}
+    for name, source in programs.items():
+        output = io.BytesIO()
+        expected = run(source, output=output), output.getvalue()
+        results[name] = {}
+        for label, options in simulated_options.items():
+            value, written, simulator = simulate(compile_source(source, **options))
+            if (value, written) != expected:
+                raise Exception(f'{name} compiled with {label} does not run like the interpreter')
+            results[name][label] = {'instructions': simulator.steps, 'branches': simulator.branches, 'conditional_moves': simulator.conditional_moves}
+    return results
+
+@contextmanager
+def materialized_conditions():
+    # Conditions as they were emitted before branching on flags: the value is computed into a
+    # register with conditional moves, compared with zero and branched on
+    classes = [Equal, NotEqual, Less, Greater, Not, Number, RegisterExpression]
+    branch_steps = [cls.__dict__['branch_steps'] for cls in classes]
+    for cls in classes:
+        cls.branch_steps = AST.branch_steps
+    try:
+        yield
+    finally:
+        for cls, steps in zip(classes, branch_steps):
+            cls.branch_steps = steps
+
+def bench_branches(programs:dict[str, str]) -> dict[str, dict[str, dict[str, dict[str, int]]]]:
+    # The emit path with conditions branching on flags against materialized ones, the IR
+    # backend always branches on flags
+    options = {label: options for label, options in SIMULATED_OPTIONS.items() if options.get('backend') != 'ir'}
+    fused = bench_simulated(programs, options)
+    with materialized_conditions():
+        materialized = bench_simulated(programs, options)
+    return {name: {label: {'fused': fused[name][label], 'materialized': materialized[name][label]} for label in options} for name in programs}
+
+def bench_interpreter(repeat:int = 3) -> dict[str, dict[str, float]]:
+    results = {}
+    for name, source in INTERPRETER_PROGRAMS.items():
+        tree = Parser(source).parse_program()
+        def naive():
+            evaluator = NaiveEvaluator(tree)
+            evaluator.call('main', [])
+            return bytes(evaluator.output)
+        def closures():
+            output = io.BytesIO()
+            run(source, output=output)
+            return output.getvalue()
+        if naive() != closures():
+            raise Exception(f'Interpreters disagree on {name}')
+        results[name] = {}
+        for evaluator, function in [('naive', naive), ('closures', closures)]:
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function()
+                best = min(best, time.perf_counter() - start)
+            results[name][evaluator] = best
+    return results
+
+def count_tokens(lexer_class, source:str) -> int:
+    lexer = lexer_class(source)
+    count = 0
+    while lexer.get_next_token() != 'EOF':
+        count += 1
+    return count
+
+def bench_lexer(lexer_class, source:str, repeat:int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokens = count_tokens(lexer_class, source)
+        best = min(best, time.perf_counter() - start)
+    return tokens / best
+
+def token_memory(source:str) -> tuple[float, float]:
+    tracemalloc.start()
+    tokens = list(Lexer(source).tokens())
+    objects = tracemalloc.get_traced_memory()[0] / len(tokens)
+    tracemalloc.stop()
+    del tokens
+
+    tracemalloc.start()
+    stream = TokenStream(Lexer(source))
+    stream.fill_all()
+    compact = tracemalloc.get_traced_memory()[0] / len(stream)
+    tracemalloc.stop()
+    return objects, compact
+
+def bench_ast(source:str, repeat:int = 3) -> dict[str, float]:
+    # Bytes per node of the node objects alone and of the whole parsed tree with its spans,
+    # names and lists, then equality against an equal rebuilt copy and between all functions
+    tracemalloc.start()
+    tree = Parser(source).parse_program()
+    tree_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes = list(walk(tree))
+    # Counts the instance dict of nodes that have one, so revisions before slotted nodes compare fairly
+    node_bytes = sum(sys.getsizeof(node) + (sys.getsizeof(node.__dict__) if hasattr(node, '__dict__') else 0) for node in nodes)
+    copy = Transformer().visit(tree)
+
+    def equal():
+        return all(a == b for a, b in zip(tree.statements, copy.statements))
+
+    def pairwise():
+        return sum(a == b for a in tree.statements for b in tree.statements)
+
+    equal_seconds, _, same = measure(equal, repeat)
+    if not same:
+        raise Exception('A rebuilt tree is not equal to the parsed one')
+    pairwise_seconds, _, _ = measure(pairwise, repeat)
+    return {
+        'nodes': len(nodes),
+        'node_bytes_per_node': node_bytes / len(nodes),
+        'tree_bytes_per_node': tree_bytes / len(nodes),
+        'equal_seconds': equal_seconds,
+        'pairwise_seconds': pairwise_seconds,
+    }
+
+def bench_jobs(source:str, jobs:list[int]) -> dict[int, float]:
+    times = {}
+    for count in jobs:
+        start = time.perf_counter()
+        compile_source(source, optimization_level=1, jobs=count)
+        times[count] = time.perf_counter() - start
+    return times
+
+def bench_latency(file_paths:list[str]) -> tuple[float, float]:
+    # Cold starts a new interpreter per file, warm sends the same files to one running daemon
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    with tempfile.TemporaryDirectory() as directory:
+        outputs = [os.path.join(directory, f'{i}.s') for i in range(len(file_paths))]
+
+        start = time.perf_counter()
+        for file_path, output_path in zip(file_paths, outputs):
+            subprocess.run([sys.executable, main_path, file_path, '-o', output_path], check=True)
+        cold = (time.perf_counter() - start) / len(file_paths)
+
+        daemon = subprocess.Popen([sys.executable, main_path, '--daemon'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        daemon.stdin.write(json.dumps({'source': ''}) + '\n')
+        daemon.stdin.flush()
+        daemon.stdout.readline()
+        start = time.perf_counter()
+        for file_path, output_path in zip(file_paths, outputs):
+            daemon.stdin.write(json.dumps({'file': file_path, 'output': output_path}) + '\n')
+            daemon.stdin.flush()
+            daemon.stdout.readline()
+        warm = (time.perf_counter() - start) / len(file_paths)
+        daemon.stdin.close()
+        daemon.wait()
+    return cold, warm
+
+def measure(function, repeat:int = 3) -> tuple[float, int, object]:
+    # Best wall time over repeat runs, then peak traced memory of one more run
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+def bench_phases(source:str, optimization_level:int = 1, repeat:int = 3) -> dict[str, dict]:
+    def lex():
+        stream = TokenStream(Lexer(source))
+        stream.fill_all()
+        return len(stream)
+
+    def parse():
+        return Parser(source).parse_program()
+
+    tree = Parser(source).parse_program()
+    def optimize_tree():
+        return optimize(tree, optimization_level)
+
+    optimized = optimize_tree()
+    def emit():
+        output = Output()
+        optimized.emit(Environment(output=output))
+        return output
+
+    emitted = emit()
+    def peephole():
+        output = Output()
+        output.lines = list(emitted.lines)
+        return optimize_output(output)
+
+    results = {}
+    for name, phase in [('lex', lex), ('parse', parse), ('optimize', optimize_tree), ('emit', emit), ('peephole', peephole)]:
+        if name in ('optimize', 'peephole') and optimization_level < 1:
+            continue
+        seconds, peak, _ = measure(phase, repeat)
+        results[name] = {'seconds': seconds, 'peak_bytes': peak}
+    results['lex']['tokens'] = lex()
+    results['emit']['instructions'] = len(emitted.lines)
+    return results
+
+def bench_inlining(source:str, execute:bool = False) -> dict[str, dict[str, int]]:
+    # Instructions and bl calls emitted at -O 1 with and without the inliner, and executed if asked
+    tree = Parser(source).parse_program()
+    results = {}
+    for name, passes in [('inlined', OPTIMIZATIONS), ('not_inlined', [item for item in OPTIMIZATIONS if item[0] != 'inline'])]:
+        output = Output()
+        optimize(tree, 1, passes).emit(Environment(output=output))
+        lines = optimize_output(output).lines
+        instructions = [line for line in lines if line and not line.endswith(':') and not line.startswith('.')]
+        results[name] = {'instructions': len(instructions), 'calls': sum(1 for line in instructions if line.startswith('bl '))}
+        if execute:
+            _, _, simulator = simulate('\n'.join(lines))
+            results[name] |= {'executed_instructions': simulator.steps, 'executed_calls': simulator.calls}
+    return results
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results:dict, baseline:dict):
+    # Ratios above 1 are slower or bigger than the baseline run
+    for name, phase in results.get('phases', {}).items():
+        previous = baseline.get('phases', {}).get(name)
+        if previous is None:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if previous.get(metric):
+                print(f'{name:>9} {metric:<10} {phase[metric] / previous[metric]:6.2f}x of {baseline.get("revision") or "baseline"}')
+    for metric, value in results.get('ast', {}).items():
+        previous = baseline.get('ast', {}).get(metric)
+        if previous and metric != 'nodes':
+            print(f'      ast {metric:<20} {value / previous:6.2f}x of {baseline.get("revision") or "baseline"}')
+
+BENCHMARKS = ['phases', 'lexer', 'tokens', 'ast', 'inlining', 'jobs', 'latency', 'interpreter', 'loops', 'branches']
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(usage='python benchmark.py [--functions N] [--depth N] [--seed N] [--json results.json] [--compare previous.json]')
+    arg_parser.add_argument('--source', help='benchmark this file instead of a generated program')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--functions', type=int, default=200)
+    arg_parser.add_argument('--depth', type=int, default=12, help='nesting depth of generated expressions')
+    arg_parser.add_argument('--loop-length', type=int, default=20, help='statements in every generated while body')
+    arg_parser.add_argument('--variables', type=int, default=8, help='vars declared in every generated function')
+    arg_parser.add_argument('-O', dest='optimization_level', type=int, default=1, choices=[0, 1])
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--only', default=','.join(BENCHMARKS), help=f'comma separated subset of {",".join(BENCHMARKS)}')
+    arg_parser.add_argument('--json', help='write the results to this file')
+    arg_parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = arg_parser.parse_args()
+
+    parameters = {name: getattr(args, name) for name in ('seed', 'functions', 'depth', 'loop_length', 'variables', 'optimization_level')}
+    if args.source:
+        with open(args.source, 'r') as file:
+            source = file.read()
+        parameters['source'] = args.source
+    else:
+        source = generate_program(args.seed, args.functions, args.depth, args.loop_length, args.variables)
+    only = args.only.split(',')
+    results = {'revision': git_revision(), 'python': platform.python_version(), 'parameters': parameters, 'source_bytes': len(source)}
+    print(f'source: {len(source):,} bytes')
+
+    if 'phases' in only:
+        results['phases'] = bench_phases(source, args.optimization_level, args.repeat)
+        for name, phase in results.get('phases', {}).items():
+            print(f'{name:>9}: {phase["seconds"]:8.3f} s  peak {phase["peak_bytes"] / 1e6:8.2f} MB')
+
+    if 'lexer' in only:
+        results['lexer'] = {name: bench_lexer(lexer_class, source, args.repeat) for name, lexer_class in [('legacy', LegacyLexer), ('lexer', Lexer)]}
+        for name, rate in results['lexer'].items():
+            print(f'{name:>9}: {rate:12,.0f} tokens/s')
+
+    if 'tokens' in only:
+        objects, compact = token_memory(source)
+        results['tokens'] = {'object_bytes_per_token': objects, 'compact_bytes_per_token': compact}
+        print(f'token memory: {objects:.1f} bytes/token as objects, {compact:.1f} bytes/token compact')
+
+    if 'ast' in only:
+        results['ast'] = bench_ast(source, args.repeat)
+        ast = results['ast']
+        print(f'ast: {ast["nodes"]:,} nodes, {ast["node_bytes_per_node"]:.1f} bytes/node as objects, {ast["tree_bytes_per_node"]:.1f} bytes/node with spans and names')
+        print(f'ast equality: {ast["equal_seconds"]:.3f} s against an equal copy, {ast["pairwise_seconds"]:.3f} s between every pair of functions')
+
+    if 'inlining' in only:
+        results['inlining'] = {'source': bench_inlining(source), 'helpers': bench_inlining(INLINING_PROGRAM, execute=True)}
+        for name, runs in results['inlining'].items():
+            inlined, not_inlined = runs['inlined'], runs['not_inlined']
+            print(f'inlining {name}: {not_inlined["instructions"]:,} -> {inlined["instructions"]:,} instructions, {not_inlined["calls"]:,} -> {inlined["calls"]:,} static calls'
+                  + (f', {not_inlined["executed_instructions"]:,} -> {inlined["executed_instructions"]:,} executed' if 'executed_instructions' in inlined else ''))
+
+    if 'jobs' in only:
+        jobs = sorted({1, 2, *(2 ** i for i in range((os.cpu_count() or 1).bit_length()))})
+        times = bench_jobs(source, jobs)
+        results['jobs'] = {str(count): elapsed for count, elapsed in times.items()}
+        for count, elapsed in times.items():
+            print(f'compile -O 1 with {count} jobs: {elapsed:.2f} s ({times[1] / elapsed:.2f}x)')
+
+    if 'latency' in only:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+            file.write(generate_program(args.seed, 3, 4, 4, 2) if not args.source else source)
+        try:
+            cold, warm = bench_latency([file.name] * 20)
+        finally:
+            os.remove(file.name)
+        results['latency'] = {'cold_seconds': cold, 'warm_seconds': warm}
+        print(f'latency per file: {cold * 1000:.1f} ms cold, {warm * 1000:.1f} ms warm daemon')
+
+    if 'interpreter' in only:
+        results['interpreter'] = bench_interpreter(args.repeat)
+        for name, times in results['interpreter'].items():
+            print(f'run {name}: {times["naive"]:.3f} s naive, {times["closures"]:.3f} s closures ({times["naive"] / times["closures"]:.1f}x)')
+
+    if 'loops' in only:
+        results['loops'] = bench_simulated(LOOP_PROGRAMS)
+        for name, runs in results['loops'].items():
+            baseline = runs['O0']['instructions']
+            print(f'loop {name}: ' + ', '.join(f'{label} {counts["instructions"]:,} instructions ({baseline / counts["instructions"]:.2f}x)' for label, counts in runs.items()))
+
+    if 'branches' in only:
+        results['branches'] = bench_branches(LOOP_PROGRAMS)
+        for name, runs in results['branches'].items():
+            for label, counts in runs.items():
+                fused, materialized = counts['fused'], counts['materialized']
+                print(f'branch {name} {label}: {materialized["instructions"]:,} -> {fused["instructions"]:,} instructions, '
+                      f'{materialized["branches"]:,} -> {fused["branches"]:,} branches, {materialized["conditional_moves"]:,} -> {fused["conditional_moves"]:,} conditional moves')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            compare(results, json.load(file))
@@ -1,27 +1,226 @@
 from Parser import *
 from AST import *
 from Lexer import *
+from Optimizer import *
+from Registers import RegisterBackend
+from Lowering import IRBackend
+from Peephole import RULES, optimize_output
+from Cache import CompilationCache
+from Instrumentation import Instrumentation, no_phase
+from Interpreter import Interpreter
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from itertools import repeat
+import argparse
+import cProfile
+import mmap
+import os
+import pstats
 import sys
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('Usage: python main.py <file_path>')
+BACKENDS = ['stack', 'registers', 'ir']
+# How divisions by a runtime value are emitted: udiv, or a library call for cores without it
+DIVIDES = ['hardware', 'library']
+
+def emit_fragment(node:AST, optimization_level:int = 0, stats:Counter = None, instrumentation:Instrumentation = None) -> list[str]:
+    timer = instrumentation.phase if instrumentation is not None else no_phase
+    fragment = Output()
+    with timer('emit'):
+        node.emit(Environment(output=fragment))
+    if optimization_level >= 1:
+        with timer('peephole'):
+            optimize_output(fragment, stats)
+    return fragment.lines
+
+def emit_function(function:Function, optimization_level:int = 0) -> tuple[list[str], Counter]:
+    stats = Counter()
+    return emit_fragment(function, optimization_level, stats), stats
+
+def emit_functions(functions:list[Function], optimization_level:int = 0, stats:Counter = None, jobs:int = 1, instrumentation:Instrumentation = None) -> list[list[str]]:
+    if jobs > 1 and len(functions) > 1:
+        # Labels are numbered per function, so fragments emitted apart join up byte for byte.
+        # Workers are not instrumented, their whole run counts as the emit phase.
+        timer = instrumentation.phase if instrumentation is not None else no_phase
+        with timer('emit'), ProcessPoolExecutor(jobs) as pool:
+            chunksize = max(1, len(functions) // (jobs * 4))
+            results = list(pool.map(emit_function, functions, repeat(optimization_level), chunksize=chunksize))
     else:
-        file_path = sys.argv[1]
+        results = []
+        for function in functions:
+            function_stats = Counter()
+            results.append((emit_fragment(function, optimization_level, function_stats, instrumentation), function_stats))
+
+    fragments = []
+    for lines, fragment_stats in results:
+        if stats is not None:
+            stats.update(fragment_stats)
+        fragments.append(lines)
+    return fragments
+
+def compile_source(source:str | bytes, output:Output = None, optimization_level:int = 0, backend:str = 'stack', stats:Counter = None, cache:CompilationCache = None, jobs:int = 1, instrumentation:Instrumentation = None, divide:str = 'hardware') -> str:
+    timer = instrumentation.phase if instrumentation is not None else no_phase
+    output = output if output is not None else Output()
+    with timer('parse'):
+        parser = Parser(source)
+        parsed = parser.parse_program()
+    if instrumentation is not None:
+        instrumentation.count_nodes(parsed)
+    with timer('optimize'):
+        parsed = optimize(parsed, optimization_level)
+        if divide == 'library':
+            parsed = LibraryDivide().visit(parsed)
+        if backend == 'registers':
+            parsed = RegisterBackend().visit(parsed)
+        elif backend == 'ir' and optimization_level >= 1:
+            # -O 0 keeps the emit path, the IR is built when a function is emitted
+            parsed = IRBackend().visit(parsed)
+    if instrumentation is not None:
+        instrumentation.count_optimized_nodes(parsed)
+
+    if (cache is not None or jobs > 1) and isinstance(parsed, Block) and all(isinstance(statement, Function) for statement in parsed.statements):
+        # Functions only share label-free global names, so each one is emitted and cached on its own
+        functions = parsed.statements
+        fragments = [None] * len(functions)
+        if cache is not None:
+            with timer('cache'):
+                options = f'{optimization_level}:{backend}:{divide}'
+                keys = [cache.key(function, options) for function in functions]
+                fragments = [cache.get(key) for key in keys]
+
+        missing = [i for i, lines in enumerate(fragments) if lines is None]
+        for i, lines in zip(missing, emit_functions([functions[i] for i in missing], optimization_level, stats, jobs, instrumentation)):
+            fragments[i] = lines
+            if cache is not None:
+                with timer('cache'):
+                    cache.put(keys[i], lines)
+
+        for lines in fragments:
+            output.lines.extend(lines)
+        if cache is not None:
+            with timer('cache'):
+                cache.evict()
+    else:
+        output.lines.extend(emit_fragment(parsed, optimization_level, stats, instrumentation))
+    with timer('write'):
+        output.close()
+    return output.getvalue()
+
+def assembly_path(file_path:str) -> str:
+    return f'{os.path.splitext(file_path)[0]}.s'
+
+def read_manifest(manifest_path:str) -> list[str]:
+    # One source path per line, relative to the manifest
+    directory = os.path.dirname(manifest_path)
+    with open(manifest_path, 'r') as file:
+        return [os.path.join(directory, line.strip()) for line in file if line.strip() and not line.startswith('#')]
+
+@contextmanager
+def open_source(file_path:str):
+    # The lexer matches the mapped bytes in place, the source is never copied into a str
+    with open(file_path, 'rb') as file:
         try:
-            with open(file_path, 'r') as file:
-                file_content = file.read()
-
-                with open('./out.s', 'w') as file:
-                    pass
-                
-                parser = Parser(f'{{{file_content}}}')
-                parsed = parser.parse()
-                parsed.emit(Environment())
-                
-        except FileNotFoundError:
-            print(f"File not found: {file_path}")
-        except Exception as e:
-            print(f"An error occurred: {e}")
-
-        
\ No newline at end of file
+            source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            yield b''
+            return
+        with source:
+            yield source
+
+def compile_file(file_path:str, output_path:str = './out.s', optimization_level:int = 0, backend:str = 'stack', stats:Counter = None, cache:CompilationCache = None, jobs:int = 1, instrumentation:Instrumentation = None, divide:str = 'hardware') -> str:
+    timer = instrumentation.phase if instrumentation is not None else no_phase
+    with ExitStack() as stack:
+        with timer('read'):
+            source = stack.enter_context(open_source(file_path))
+        return compile_source(source, FileOutput(output_path), optimization_level, backend, stats, cache, jobs, instrumentation, divide)
+
+def run(source:str | bytes, optimization_level:int = 0, output = None) -> int:
+    # Runs main on the host instead of compiling, putchar writes to output (stdout by default)
+    parsed = optimize(Parser(source).parse_program(), optimization_level)
+    return Interpreter(parsed, output).run()
+
+def run_file(file_path:str, optimization_level:int = 0, output = None) -> int:
+    with open_source(file_path) as source:
+        return run(source, optimization_level, output)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(usage='python main.py <file_path>... [-o out.s] [-O level] [--backend stack|registers|ir] [--divide hardware|library] [--cache DIRECTORY] [-j jobs] [--manifest FILE] [--daemon [--socket PATH]] [--run] [--stats FILE] [--profile FILE]')
+    arg_parser.add_argument('file_paths', metavar='file_path', nargs='*')
+    arg_parser.add_argument('-o', '--output', help='path of the generated assembly for a single input, ./out.s by default')
+    arg_parser.add_argument('-O', dest='optimization_level', type=int, default=0, choices=[0, 1], help='optimization level')
+    arg_parser.add_argument('--backend', default='stack', choices=BACKENDS, help='code generator, ir lowers functions through the IR at -O 1')
+    arg_parser.add_argument('--divide', default='hardware', choices=DIVIDES, help='divide by runtime values with udiv or through the library')
+    arg_parser.add_argument('--peephole-stats', action='store_true', help='print the instructions removed by each peephole rule')
+    arg_parser.add_argument('--cache', metavar='DIRECTORY', help='reuse the assembly of unchanged functions from this directory')
+    arg_parser.add_argument('--cache-size', type=int, default=64 * 1024 * 1024, help='bytes kept in the cache before the least recently used entries are evicted')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='processes emitting functions in parallel')
+    arg_parser.add_argument('--manifest', help='file listing the sources to compile, one per line')
+    arg_parser.add_argument('--daemon', action='store_true', help='compile JSON jobs read line by line from stdin or --socket')
+    arg_parser.add_argument('--socket', help='unix socket the daemon listens on')
+    arg_parser.add_argument('--run', action='store_true', help='run the programs on the host instead of compiling them')
+    arg_parser.add_argument('--stats', metavar='FILE', help='write phase times and counters as JSON to FILE, - for stdout')
+    arg_parser.add_argument('--profile', metavar='FILE', help='run the compile under cProfile and save the profile to FILE')
+    args = arg_parser.parse_args()
+
+    cache = CompilationCache(args.cache, args.cache_size) if args.cache else None
+    if args.daemon:
+        from Daemon import Daemon
+        daemon = Daemon(args.optimization_level, args.backend, cache, args.divide)
+        if args.socket:
+            daemon.serve_socket(args.socket)
+        else:
+            daemon.serve_stdin()
+        sys.exit(0)
+
+    file_paths = list(args.file_paths)
+    if args.manifest:
+        file_paths += read_manifest(args.manifest)
+    if not file_paths:
+        arg_parser.error('no input files')
+    if args.output and len(file_paths) > 1:
+        arg_parser.error('-o can only be used with a single input, batch outputs go next to each input')
+
+    # A single input keeps writing ./out.s, a batch writes one .s next to every input
+    batch = len(file_paths) > 1 or args.manifest is not None
+    stats = Counter()
+    instrumentation = Instrumentation() if args.stats else None
+    statuses = []
+
+    def compile_all():
+        for file_path in file_paths:
+            output_path = args.output or (assembly_path(file_path) if batch else './out.s')
+            try:
+                if args.run:
+                    statuses.append(run_file(file_path, args.optimization_level))
+                else:
+                    compile_file(file_path, output_path, args.optimization_level, args.backend, stats, cache, args.jobs, instrumentation, args.divide)
+            except FileNotFoundError:
+                print(f"File not found: {file_path}")
+            except Exception as e:
+                print(f"An error occurred in {file_path}: {e}" if batch else f"An error occurred: {e}")
+
+    with instrumentation if instrumentation is not None else nullcontext():
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.runcall(compile_all)
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(15)
+        else:
+            compile_all()
+
+    if instrumentation is not None:
+        instrumentation.peephole = stats
+        if args.stats == '-':
+            instrumentation.dump(sys.stdout)
+        else:
+            with open(args.stats, 'w') as file:
+                instrumentation.dump(file)
+
+    if args.peephole_stats:
+        for name, _ in RULES:
+            print(f'{name}: {stats[name]} removed in {stats[name + ".applied"]} rewrites')
+
+    # Like a process, a single program run exits with the low byte of what main returned
+    if args.run and not batch and statuses:
+        sys.exit(statuses[0] & 0xff)
@@ -0,0 +1,70 @@
+import sys
+from AST import *
+from Lexer import Span
+from Parser import Parser
+from Optimizer import Transformer
+from Generator import generate_program
+
+def test_nodes_have_no_instance_dict():
+    tree = Parser(generate_program(0, functions=5)).parse_program()
+    for node in walk(tree):
+        assert not hasattr(node, '__dict__')
+    # Span and the cached hash are the only slots besides the fields
+    class FourSlots:
+        __slots__ = ('span', '_hash', 'left', 'right')
+    assert sys.getsizeof(Add(Number(1), Number(2))) == sys.getsizeof(FourSlots())
+
+def test_equality_compares_fields():
+    assert Add(Number(1), Id('x')) == Add(Number(1), Id('x'))
+    assert Add(Number(1), Id('x')) != Add(Number(2), Id('x'))
+    assert Add(Number(1), Id('x')) != Subtract(Number(1), Id('x'))
+    assert Call('f', [Number(1)]) == Call('f', [Number(1)])
+    assert Call('f', [Number(1)]) != Call('f', [Number(1), Number(2)])
+    assert Number(1) != 1
+
+def test_equality_ignores_spans():
+    located = Number(1)
+    located.span = Span(1, 1, 1, 2)
+    assert located == Number(1)
+    assert hash(located) == hash(Number(1))
+
+def test_equality_does_not_hash():
+    left, right = Add(Number(1), Id('x')), Add(Number(1), Id('x'))
+    assert left == right
+    assert not hasattr(left, '_hash') and not hasattr(right, '_hash')
+
+def test_hash_is_structural_and_cached():
+    node = Multiply(Add(Id('a'), Number(1)), Id('b'))
+    assert hash(node) == hash(Multiply(Add(Id('a'), Number(1)), Id('b')))
+    assert node._hash == hash(node) and node.left._hash == hash(node.left)
+    assert len({node, Multiply(Add(Id('a'), Number(1)), Id('b')), Multiply(Id('b'), Add(Id('a'), Number(1)))}) == 2
+
+def test_rebuilt_tree_is_equal():
+    tree = Parser(generate_program(1, functions=20)).parse_program()
+    copy = Transformer().visit(tree)
+    assert copy is not tree and copy == tree
+    assert hash(copy) == hash(tree)
+    functions = tree.statements
+    assert sum(a == b for a in functions for b in functions) == len(functions)
+
+def test_deep_tree_hash():
+    node = Number(0)
+    for i in range(100000):
+        node = Add(node, Number(i))
+    assert isinstance(hash(node), int)
+
+def deep_sum(depth:int, last:int = 0) -> AST:
+    node = Number(last)
+    for i in range(depth):
+        node = Add(node, Number(i))
+    return node
+
+def test_deep_tree_equality():
+    assert deep_sum(100000) == deep_sum(100000)
+    assert deep_sum(100000) != deep_sum(100000, 1)
+    assert deep_sum(100000) != deep_sum(99999)
+
+def test_equality_compares_lists_of_names():
+    assert Function('f', ['a', 'b'], Block([])) == Function('f', ['a', 'b'], Block([]))
+    assert Function('f', ['a', 'b'], Block([])) != Function('f', ['a', 'c'], Block([]))
+    assert Function('f', ['a'], Block([])) != Function('f', ['a', 'b'], Block([]))
@@ -0,0 +1,50 @@
+import re
+import pytest
+from Simulator import simulate, split_opcode
+from benchmark import LOOP_PROGRAMS, bench_branches
+from main import compile_source
+
+CONDITIONS = '''
+function f(a, b) {
+    var x = 0;
+    if (a < b) {
+        x = x + 1;
+    }
+    while (!(a == b)) {
+        a = a + 1;
+        x = x + 2;
+    }
+    return x;
+}
+'''
+
+BACKENDS = [(0, 'stack'), (1, 'stack'), (0, 'registers'), (1, 'registers'), (1, 'ir')]
+
+def instructions(assembly:str) -> list[tuple[str, str, str]]:
+    lines = [line.strip() for line in assembly.splitlines()]
+    return [(*split_opcode(line.split()[0]), line) for line in lines if line and not line.endswith(':') and not line.startswith('.')]
+
+@pytest.mark.parametrize('optimization_level, backend', BACKENDS)
+def test_conditions_branch_on_the_comparison(optimization_level:int, backend:str):
+    code = instructions(compile_source(CONDITIONS, optimization_level=optimization_level, backend=backend))
+    assert not any(opcode == 'mov' and condition for opcode, condition, _ in code)
+    # Each condition is a cmp of the two operands followed by the conditional branch
+    branches = [(previous[2], line) for previous, (opcode, condition, line) in zip(code, code[1:]) if opcode == 'b' and condition]
+    assert len(branches) == 2
+    for compare, branch in branches:
+        assert re.fullmatch(r'cmp r\d+, r\d+', compare)
+    assert {split_opcode(branch.split()[0])[1] for _, branch in branches} <= {'lt', 'ge', 'eq', 'ne'}
+
+@pytest.mark.parametrize('optimization_level, backend', BACKENDS)
+@pytest.mark.parametrize('a, b, value', [(1, 5, 9), (2, 4, 5), (3, 3, 0)])
+def test_conditions_run_without_conditional_moves(optimization_level:int, backend:str, a:int, b:int, value:int):
+    result, _, simulator = simulate(compile_source(CONDITIONS, optimization_level=optimization_level, backend=backend), 'f', [a, b])
+    assert result == value and simulator.conditional_moves == 0
+
+def test_branch_benchmark_counts_the_moves_saved():
+    results = bench_branches({'countdown': LOOP_PROGRAMS['countdown']})
+    for counts in results['countdown'].values():
+        fused, materialized = counts['fused'], counts['materialized']
+        assert fused['conditional_moves'] == 0 < materialized['conditional_moves']
+        assert fused['branches'] == materialized['branches']
+        assert fused['instructions'] < materialized['instructions']
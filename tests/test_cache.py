@@ -0,0 +1,62 @@
+import os
+import time
+from Cache import CompilationCache
+from Generator import generate_program
+from main import compile_source
+
+SOURCE = generate_program(0, functions=6)
+FUNCTIONS = SOURCE.count('function ')
+
+def cached_compile(cache:CompilationCache, source:str = SOURCE, **options) -> tuple[str, int, int]:
+    # The assembly and the hits and misses of this compile alone
+    hits, misses = cache.hits, cache.misses
+    assembly = compile_source(source, cache=cache, **options)
+    return assembly, cache.hits - hits, cache.misses - misses
+
+def test_second_compile_hits_every_function(tmp_path):
+    cache = CompilationCache(str(tmp_path))
+    # -O 1 drops the functions main does not reach, only those left are cached
+    assembly, hits, misses = cached_compile(cache, optimization_level=1)
+    assert hits == 0 and 0 < misses <= FUNCTIONS
+    assert len(os.listdir(tmp_path)) == misses
+    again, hits, misses_again = cached_compile(cache, optimization_level=1)
+    assert (hits, misses_again) == (misses, 0)
+    assert again == assembly == compile_source(SOURCE, optimization_level=1)
+
+def test_changed_function_misses_alone(tmp_path):
+    cache = CompilationCache(str(tmp_path))
+    cached_compile(cache)
+    changed = SOURCE.replace('function f1(', 'function f1(extra, ', 1)
+    assembly, hits, misses = cached_compile(cache, changed)
+    assert (hits, misses) == (FUNCTIONS - 1, 1)
+    assert assembly == compile_source(changed)
+
+def test_options_and_compiler_version_invalidate(tmp_path):
+    cache = CompilationCache(str(tmp_path))
+    cached_compile(cache)
+    for options in [{'optimization_level': 1}, {'backend': 'registers'}, {'divide': 'library'}]:
+        assembly, hits, misses = cached_compile(cache, **options)
+        assert hits == 0 and misses > 0
+        assert assembly == compile_source(SOURCE, **options)
+        assert cached_compile(cache, **options)[1:] == (misses, 0)
+    # A different compiler, as after an edit to its sources, reuses nothing
+    cache.version = 'edited'
+    assert cached_compile(cache)[1:] == (0, FUNCTIONS)
+
+def test_evict_removes_least_recently_used_until_under_the_size(tmp_path):
+    cache = CompilationCache(str(tmp_path), max_size=250)
+    now = time.time()
+    for i in range(5):
+        cache.put(f'key{i}', ['x' * 99])
+        os.utime(cache.path(f'key{i}'), (now - 100 + i, now - 100 + i))
+    # Reading key0 makes it the most recently used
+    assert cache.get('key0') == ['x' * 99]
+    cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ['key0.s', 'key4.s']
+    assert cache.get('key1') is None
+
+def test_evict_keeps_everything_under_the_size(tmp_path):
+    cache = CompilationCache(str(tmp_path))
+    cached_compile(cache)
+    cache.evict()
+    assert len(os.listdir(tmp_path)) == FUNCTIONS
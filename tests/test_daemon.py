@@ -0,0 +1,79 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from Daemon import Daemon
+from main import compile_source
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROGRAM = 'function main() { putchar(72); return 3; }'
+BROKEN = 'function main() { return 1 }'
+
+def main_py(*arguments:str, cwd, stdin:str = None) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), *arguments], input=stdin, capture_output=True, text=True, cwd=cwd)
+
+def test_batch_writes_next_to_every_input_and_goes_on_after_errors(tmp_path):
+    (tmp_path / 'a.txt').write_text(PROGRAM)
+    (tmp_path / 'b.txt').write_text(BROKEN)
+    (tmp_path / 'c.txt').write_text(PROGRAM.replace('72', '73'))
+    result = main_py('a.txt', 'b.txt', 'c.txt', 'missing.txt', cwd=tmp_path)
+    assert (tmp_path / 'a.s').read_text() == compile_source(PROGRAM)
+    assert (tmp_path / 'c.s').read_text() == compile_source(PROGRAM.replace('72', '73'))
+    assert not (tmp_path / 'b.s').exists()
+    assert 'An error occurred in b.txt' in result.stdout and 'File not found: missing.txt' in result.stdout
+
+def test_manifest_paths_are_relative_to_it(tmp_path):
+    (tmp_path / 'sources').mkdir()
+    (tmp_path / 'sources' / 'a.txt').write_text(PROGRAM)
+    (tmp_path / 'sources' / 'list.txt').write_text('# programs\na.txt\n\n')
+    main_py('--manifest', 'sources/list.txt', '-O', '1', cwd=tmp_path)
+    assert (tmp_path / 'sources' / 'a.s').read_text() == compile_source(PROGRAM, optimization_level=1)
+
+def test_daemon_answers_every_job(tmp_path):
+    (tmp_path / 'a.txt').write_text(PROGRAM)
+    jobs = [
+        {'id': 1, 'source': PROGRAM},
+        {'id': 2, 'source': PROGRAM, 'optimization_level': 1, 'backend': 'registers'},
+        {'id': 3, 'file': 'a.txt', 'output': 'a.s'},
+        {'id': 4, 'source': BROKEN},
+        {'id': 5, 'file': 'missing.txt'},
+    ]
+    stdin = '\n'.join(json.dumps(job) for job in jobs) + '\n\nnot json\n'
+    result = main_py('--daemon', cwd=tmp_path, stdin=stdin)
+    results = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [result['id'] for result in results] == [1, 2, 3, 4, 5, None]
+    assert [result['ok'] for result in results] == [True, True, True, False, False, False]
+    assert results[0]['assembly'] == compile_source(PROGRAM)
+    assert results[1]['assembly'] == compile_source(PROGRAM, optimization_level=1, backend='registers')
+    assert results[2]['output'] == 'a.s' and (tmp_path / 'a.s').read_text() == compile_source(PROGRAM)
+    assert "Expected ';'" in results[3]['error']
+    assert 'missing.txt' in results[4]['error']
+    assert results[5]['error'].startswith('Invalid job')
+    assert all(result['seconds'] >= 0 for result in results[:5])
+
+def test_daemon_defaults_apply_to_jobs_without_options():
+    daemon = Daemon(optimization_level=1, backend='ir', divide='library')
+    result = daemon.handle({'source': 'function main() { var x = 7; return 100 / x; }'})
+    assert result['ok'] and result['id'] is None
+    assert result['assembly'] == compile_source('function main() { var x = 7; return 100 / x; }', optimization_level=1, backend='ir', divide='library')
+
+def test_daemon_serves_a_socket(tmp_path):
+    path = str(tmp_path / 'compiler.sock')
+    thread = threading.Thread(target=Daemon().serve_socket, args=(path,), daemon=True)
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.05)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall((json.dumps({'id': 'x', 'source': PROGRAM}) + '\n').encode())
+        client.shutdown(socket.SHUT_WR)
+        response = b''
+        while chunk := client.recv(65536):
+            response += chunk
+    result = json.loads(response)
+    assert result['id'] == 'x' and result['assembly'] == compile_source(PROGRAM)
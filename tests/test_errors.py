@@ -0,0 +1,50 @@
+import pytest
+from Lexer import LineIndex
+from Parser import Parser
+from Interpreter import Interpreter
+from main import compile_source
+
+def error(source:str | bytes, **options) -> str:
+    with pytest.raises(Exception) as raised:
+        compile_source(source, **options)
+    return str(raised.value)
+
+@pytest.mark.parametrize('encode', [False, True])
+@pytest.mark.parametrize('source, message', [
+    # A missing ; is reported at the token found instead
+    ('function main() {\n    var x = 1\n    return x;\n}', "3:5: Expected ';'\n    return x;"),
+    ('function main() {\n  return 1 # 2;\n}', "2:12: Invalid character '#'\n  return 1 # 2;"),
+    ('function main() {\n  return (1 + 2;\n}', "2:16: Expected ')'\n  return (1 + 2;"),
+    ('function main() {\n  return 1 + ;\n}', '2:14: Expected expression\n  return 1 + ;'),
+    ('function main() {\n  return 1;\n', "3:1: Expected '}'\n"),
+    ('function (a) {}', '1:10: Expected function name\nfunction (a) {}'),
+])
+def test_syntax_errors_give_line_column_and_the_line(source:str, message:str, encode:bool):
+    # A mapped file is lexed as bytes and reports the same positions
+    assert error(source.encode() if encode else source) == message
+
+@pytest.mark.parametrize('backend', ['stack', 'registers', 'ir'])
+def test_undefined_variables_give_their_position(backend:str):
+    source = 'function main() {\n  return f(1);\n}\nfunction f(a) {\n  var b = a;\n  return b + yy;\n}'
+    assert error(source, optimization_level=1, backend=backend) == '6:14: Undefined variable: yy'
+    assert error('function main() { y = 1; }', backend=backend) == '1:19: Undefined variable: y'
+
+def test_interpreter_errors_give_their_position():
+    with pytest.raises(Exception, match='^2:10: Undefined variable: x$'):
+        Interpreter(Parser('function main() {\n  return x;\n}').parse_program())
+    with pytest.raises(Exception, match='^1:26: Undefined function: g$'):
+        Interpreter(Parser('function main() { return g(1); }').parse_program())
+
+def test_line_index_finds_line_starts_and_ends():
+    for text in ['ab\ncd\n\nef', b'ab\ncd\n\nef']:
+        lines = LineIndex(text)
+        assert [lines.location(offset) for offset in range(len(text) + 1)] == [
+            (1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3), (3, 1), (4, 1), (4, 2), (4, 3)]
+        assert [lines.line_text(line) for line in (1, 2, 3, 4)] == ['ab', 'cd', '', 'ef']
+
+def test_nodes_span_their_source():
+    function, = Parser('function f(a) {\n  return a +\n    f(a - 1);\n}').parse_program().statements
+    term = function.body.statements[0].term
+    assert repr(term.span) == 'Span(2:10-3:13)'
+    assert repr(term.right.span) == 'Span(3:5-3:13)'
+    assert str(function.span) == '1:1'
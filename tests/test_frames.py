@@ -0,0 +1,16 @@
+import pytest
+from main import BACKENDS, compile_source
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('optimization_level', [0, 1])
+def test_top_level_var_is_rejected(backend:str, optimization_level:int):
+    source = 'var x = 1;\nfunction main() { return 0; }\n'
+    with pytest.raises(Exception, match='1:1: Variables must be declared inside a function'):
+        compile_source(source, optimization_level=optimization_level, backend=backend)
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_vars_in_branches_get_their_own_slots(backend:str):
+    source = 'function main(a) { var x = 1; if (a) { var y = 2; x = y; } else { var z = 3; x = z; } return x; }'
+    assembly = compile_source(source, backend=backend)
+    stores = {line.split()[-1] for line in assembly.splitlines() if line.startswith('str r0, [fp')}
+    assert len(stores) == 3
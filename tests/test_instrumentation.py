@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+from AST import *
+from IRPasses import PassManager
+from Lexer import Lexer
+from Optimizer import Inliner
+from Instrumentation import Instrumentation, all_subclasses
+from main import compile_source
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, 'sample.txt')
+
+def compile_with_stats(tmp_path, *options:str) -> tuple[dict, str]:
+    stats_path, output_path = tmp_path / 'stats.json', tmp_path / 'out.s'
+    subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), SAMPLE, '-o', str(output_path), '--stats', str(stats_path), *options], check=True, cwd=tmp_path)
+    with open(stats_path) as file:
+        return json.load(file), output_path.read_text()
+
+def local_labels(assembly:str) -> int:
+    return sum(1 for line in assembly.splitlines() if line.startswith('.L') and line.endswith(':'))
+
+def test_stats_have_the_documented_phases_and_counters(tmp_path):
+    stats, _ = compile_with_stats(tmp_path, '-O', '1')
+    assert set(stats) == {'phases', 'tokens', 'labels', 'nodes', 'static_calls', 'inlined_calls', 'instructions', 'peephole'}
+    assert {'read', 'lex', 'parse', 'optimize', 'emit', 'peephole', 'write'} <= set(stats['phases'])
+    assert all(seconds >= 0 for seconds in stats['phases'].values())
+    with open(SAMPLE) as file:
+        assert stats['nodes']['Function'] == file.read().count('function ')
+    assert stats['tokens'] > 0
+    assert stats['static_calls']['parsed'] >= stats['static_calls']['optimized']
+    assert sum(stats['instructions'].values()) > 0
+    assert any(name.endswith('.applied') for name in stats['peephole'])
+
+@pytest.mark.parametrize('backend', ['stack', 'registers', 'ir'])
+def test_labels_are_counted_where_they_are_written(tmp_path, backend:str):
+    # Without the peephole rules every label written reaches the file
+    stats, assembly = compile_with_stats(tmp_path, '--backend', backend)
+    assert stats['labels'] == local_labels(assembly) > 0
+
+def test_ir_labels_are_counted(tmp_path):
+    stats, assembly = compile_with_stats(tmp_path, '-O', '1', '--backend', 'ir')
+    assert 'ir.simplify_cfg' in stats['phases']
+    # Lowering numbers its blocks itself, the peephole rules may drop some afterwards
+    assert stats['labels'] >= local_labels(assembly) > 0
+
+def patched_methods() -> list:
+    methods = [Lexer.__dict__['_scan_span'], PassManager.__dict__['run_pass'], Inliner.__dict__['inline'], Output.__dict__['emit']]
+    for cls in all_subclasses(AST):
+        methods += [cls.__dict__[name] for name in ('emit', 'emit_steps') if name in cls.__dict__]
+    return methods
+
+def test_patches_are_removed_on_exit():
+    before = patched_methods()
+    with Instrumentation() as instrumentation:
+        assert patched_methods() != before
+        compile_source('function main() { return 1; }', optimization_level=1, instrumentation=instrumentation)
+    assert patched_methods() == before
+
+    with pytest.raises(Exception, match='Undefined variable'):
+        with Instrumentation() as instrumentation:
+            compile_source('function main() { return x; }', instrumentation=instrumentation)
+    assert patched_methods() == before
@@ -0,0 +1,82 @@
+import io
+import pytest
+from Parser import Parser
+from Interpreter import Interpreter
+from Simulator import simulate
+from main import compile_source, run
+
+def interpret(source:str, entry:str = 'main', arguments:list[int] = [], optimization_level:int = 0) -> tuple[int, bytes]:
+    output = io.BytesIO()
+    value = run(source, optimization_level, output) if entry == 'main' and not arguments else Interpreter(Parser(source).parse_program(), output).run(entry, arguments)
+    return value, output.getvalue()
+
+def simulated(source:str) -> tuple[int, bytes]:
+    return simulate(compile_source(source))[:2]
+
+def test_putchar_writes_the_low_byte_and_returns_it():
+    source = 'function main() { putchar(72); putchar(105 + 256); var c = putchar(0 - 223); return c; }'
+    assert interpret(source) == (33, b'Hi!') == simulated(source)
+
+def test_frames_keep_their_own_slots_across_recursion():
+    source = '''
+function fib(n) {
+    var a = n - 1;
+    var b = n - 2;
+    if (n < 2) {
+        return n;
+    }
+    var x = fib(a);
+    var y = fib(b);
+    putchar(48 + n);
+    return x + y + a - a;
+}
+function main() {
+    return fib(10);
+}
+'''
+    value, output = interpret(source)
+    assert value == 55
+    assert (value, output) == simulated(source)
+
+def test_redeclared_variables_and_block_locals_get_new_slots():
+    source = '''
+function f(n) {
+    var x = n;
+    var x = x * 2;
+    if (n > 1) {
+        var y = f(n - 1);
+        x = x + y;
+    }
+    return x;
+}
+function main() {
+    return f(5);
+}
+'''
+    assert interpret(source)[0] == 30 == simulated(source)[0]
+
+def test_calls_with_more_than_four_arguments():
+    source = '''
+function seven(a, b, c, d, e, f, g) {
+    return a - b * 2 + c * 3 - d * 5 + e * 7 - f * 11 + g * 13;
+}
+function main() {
+    putchar(48 + seven(1, 0, 0, 0, 0, 0, 0));
+    return seven(1, 2, 3, 4, 5, 6, seven(7, 6, 5, 4, 3, 2, 1));
+}
+'''
+    assert interpret(source) == simulated(source) == (-19, b'1')
+
+def test_missing_arguments_read_zero_and_extra_ones_still_run():
+    source = 'function f(a, b) { return a * 10 + b; } function main() { return f(4) + f(1, 2, putchar(33)); }'
+    assert interpret(source) == (52, b'!')
+
+def test_entry_and_arguments():
+    assert interpret('function twice(n) { return n * 2; }', 'twice', [21]) == (42, b'')
+    with pytest.raises(Exception, match='Undefined function: main'):
+        interpret('function f() { return 1; }', 'main', [0])
+
+@pytest.mark.parametrize('optimization_level', [0, 1])
+def test_arithmetic_wraps_like_the_registers(optimization_level:int):
+    source = 'function main() { var x = 2147483647; var y = x + 1; var z = 0 - 1; return y / 2 + (z / 3 == 1431655765) + 65536 * 65536; }'
+    assert interpret(source, optimization_level=optimization_level)[0] == 1073741825
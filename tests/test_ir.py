@@ -0,0 +1,194 @@
+import io
+import os
+import pytest
+from IR import ControlFlowGraph, Instruction, build
+from IRPasses import simplify_cfg, propagate_constants, propagate_copies, eliminate_dead_code, PassManager
+from Lowering import Allocation
+from Registers import SCRATCH_REGISTERS, SAVED_REGISTERS
+from Parser import Parser
+from Generator import generate_program
+from Simulator import simulate
+from benchmark import LOOP_PROGRAMS
+from main import compile_source, run
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample.txt')
+
+def graph_of(*blocks:int) -> tuple[ControlFlowGraph, list]:
+    graph = ControlFlowGraph('f', 1)
+    graph.blocks = [graph.new_block() for _ in range(blocks[0])]
+    graph.register_count = 100
+    return graph, graph.blocks
+
+def test_branch_on_not_branches_the_other_way():
+    graph, (entry, then, other) = graph_of(3)
+    entry.instructions = [Instruction('arg', 1, value=0), Instruction('not', 2, [1])]
+    entry.terminator = Instruction('branch', arguments=[2], targets=[then, other])
+    then.terminator = Instruction('ret', arguments=[1])
+    other.terminator = Instruction('ret', arguments=[2])
+    # v2 is returned too, so its not has to stay
+    simplify_cfg(graph)
+    assert entry.terminator.arguments == [2] and entry.terminator.targets == [then, other]
+
+    other.terminator = Instruction('ret', arguments=[1])
+    simplify_cfg(graph)
+    assert [instruction.opcode for instruction in entry.instructions] == ['arg']
+    assert entry.terminator.arguments == [1] and entry.terminator.targets == [other, then]
+
+def test_branch_with_identical_targets_becomes_a_jump():
+    graph, (entry, join) = graph_of(2)
+    entry.instructions = [Instruction('arg', 1, value=0)]
+    entry.terminator = Instruction('branch', arguments=[1], targets=[join, join])
+    join.terminator = Instruction('ret', arguments=[1])
+    simplify_cfg(graph)
+    # The jump is left to a block nothing else reaches, which joins the entry
+    assert graph.blocks == [entry]
+    assert entry.terminator.opcode == 'ret'
+
+def test_jumps_are_threaded_through_empty_blocks():
+    graph, (entry, empty, other, join) = graph_of(4)
+    entry.instructions = [Instruction('arg', 1, value=0)]
+    entry.terminator = Instruction('branch', arguments=[1], targets=[empty, other])
+    empty.terminator = Instruction('jump', targets=[join])
+    other.instructions = [Instruction('const', 2, value=5)]
+    other.terminator = Instruction('jump', targets=[join])
+    join.terminator = Instruction('ret', arguments=[1])
+    simplify_cfg(graph)
+    assert entry.terminator.targets[0] is join
+    assert empty not in graph.blocks
+
+def test_unreachable_blocks_are_removed():
+    graph, (entry, dead) = graph_of(2)
+    entry.terminator = Instruction('ret', arguments=[])
+    dead.terminator = Instruction('jump', targets=[entry])
+    simplify_cfg(graph)
+    assert graph.blocks == [entry]
+
+def test_constants_fold_and_decide_branches():
+    graph, (entry, then, other) = graph_of(3)
+    entry.instructions = [Instruction('const', 1, value=6), Instruction('const', 2, value=7), Instruction('mul', 3, [1, 2]),
+                          Instruction('mulc', 4, [3], value=3), Instruction('lt', 5, [4, 1])]
+    entry.terminator = Instruction('branch', arguments=[5], targets=[then, other])
+    then.terminator = Instruction('ret', arguments=[3])
+    other.terminator = Instruction('ret', arguments=[4])
+    propagate_constants(graph)
+    assert [(instruction.opcode, instruction.value) for instruction in entry.instructions] == [('const', 6), ('const', 7), ('const', 42), ('const', 126), ('const', 0)]
+    assert entry.terminator.opcode == 'jump' and entry.terminator.targets == [other]
+
+def test_constants_wrap_and_division_by_zero_folds_like_udiv():
+    graph, (entry,) = graph_of(1)
+    entry.instructions = [Instruction('const', 1, value=2147483647), Instruction('const', 2, value=1), Instruction('add', 3, [1, 2]),
+                          Instruction('const', 4, value=0), Instruction('udiv', 5, [1, 4])]
+    entry.terminator = Instruction('ret', arguments=[3])
+    propagate_constants(graph)
+    assert entry.instructions[2].value == -2147483648 and entry.instructions[4].value == 0
+
+def test_register_written_again_is_not_a_constant():
+    graph, (entry, loop, done) = graph_of(3)
+    entry.instructions = [Instruction('const', 1, value=0)]
+    entry.terminator = Instruction('jump', targets=[loop])
+    loop.instructions = [Instruction('const', 2, value=1), Instruction('add', 1, [1, 2]), Instruction('arg', 3, value=0), Instruction('lt', 4, [1, 3])]
+    loop.terminator = Instruction('branch', arguments=[4], targets=[loop, done])
+    done.terminator = Instruction('ret', arguments=[1])
+    propagate_constants(graph)
+    assert loop.instructions[1].opcode == 'add'
+
+def test_copies_are_propagated():
+    graph, (entry,) = graph_of(1)
+    entry.instructions = [Instruction('arg', 1, value=0), Instruction('copy', 2, [1]), Instruction('add', 3, [2, 2])]
+    entry.terminator = Instruction('ret', arguments=[3])
+    propagate_copies(graph)
+    assert entry.instructions[2].arguments == [1, 1]
+
+def test_copy_stops_where_its_source_is_written_again():
+    graph, (entry,) = graph_of(1)
+    entry.instructions = [Instruction('arg', 1, value=0), Instruction('copy', 2, [1]), Instruction('const', 1, value=3),
+                          Instruction('add', 3, [2, 1])]
+    entry.terminator = Instruction('ret', arguments=[3])
+    propagate_copies(graph)
+    assert entry.instructions[3].arguments == [2, 1]
+
+def test_dead_code_is_removed_and_calls_stay():
+    graph, (entry,) = graph_of(1)
+    entry.instructions = [Instruction('arg', 1, value=0), Instruction('add', 2, [1, 1]), Instruction('mul', 3, [2, 2]),
+                          Instruction('call', 4, [1], value='g'), Instruction('copy', 1, [1])]
+    entry.terminator = Instruction('ret', arguments=[1])
+    eliminate_dead_code(graph)
+    assert [instruction.opcode for instruction in entry.instructions] == ['arg', 'call']
+    assert entry.instructions[1].dest is None
+
+def test_values_live_around_a_loop_are_kept():
+    graph, (entry, loop, done) = graph_of(3)
+    entry.instructions = [Instruction('arg', 1, value=0), Instruction('const', 2, value=0)]
+    entry.terminator = Instruction('jump', targets=[loop])
+    loop.instructions = [Instruction('add', 2, [2, 1]), Instruction('sub', 1, [1, 1]), Instruction('ne', 3, [1, 2])]
+    loop.terminator = Instruction('branch', arguments=[3], targets=[loop, done])
+    done.terminator = Instruction('ret', arguments=[2])
+    eliminate_dead_code(graph)
+    assert len(loop.instructions) == 3
+
+def test_allocation_spills_when_registers_run_out():
+    # More values live at once than there are registers: all are read at the end
+    count = len(SCRATCH_REGISTERS) + len(SAVED_REGISTERS) + 4
+    graph, (entry,) = graph_of(1)
+    entry.instructions = [Instruction('arg', i + 1, value=0) for i in range(count)]
+    total = count + 1
+    entry.instructions.append(Instruction('add', total, [1, 2]))
+    for register in range(3, count + 1):
+        entry.instructions.append(Instruction('add', total + 1, [total, register]))
+        total += 1
+    entry.terminator = Instruction('ret', arguments=[total])
+    allocation = Allocation(graph)
+    assert len(allocation.slots) >= 4
+    assert allocation.frame_size == (4 * len(allocation.slots) + 7) // 8 * 8
+    assert sorted(allocation.slots.values()) == [-4 * i for i in range(len(allocation.slots), 0, -1)]
+    # Values defined up front are all live until the adds, none share a machine register
+    values = [register for register in range(1, count + 1) if register in allocation.registers]
+    assert len({allocation.registers[register] for register in values}) == len(values)
+    assert set(values) | set(allocation.slots) >= set(range(1, count + 1))
+
+def test_build_and_passes_keep_a_function_small():
+    function, = Parser('function f(a) { var x = 1; var y = x + 2; if (!(a == 0)) { return y * a; } return y; }').parse_program().statements
+    graph = PassManager().run(build(function))
+    opcodes = [instruction.opcode for instruction in graph.instructions()]
+    assert 'not' not in opcodes and 'copy' not in opcodes
+    assert opcodes.count('const') <= 2
+
+# Many values live across calls, more than four arguments and a tail call
+STRESS = '''
+function mix(a, b, c, d, e, f) {
+    return a * 3 + b * 5 - c + d * 7 + e / 3 - f;
+}
+function spill(n) {
+    var a = n + 1; var b = n * 2; var c = n + 3; var d = n * 4; var e = n + 5; var f = n * 6;
+    var g = n + 7; var h = n * 8; var i = n + 9; var j = n * 10; var k = n + 11; var l = n * 12;
+    var m = mix(a, b, c, d, e, f);
+    return m + a + b + c + d + e + f + g + h + i + j + k + l + mix(g, h, i, j, k, l);
+}
+function count(n, total) {
+    if (n == 0) {
+        return total;
+    }
+    return count(n - 1, total + n);
+}
+function main() {
+    var s = spill(3) + spill(100) / 7;
+    putchar(48 + s / 1000);
+    putchar(48 + count(300, 0) / 10000);
+    return s;
+}
+'''
+
+def programs() -> dict[str, str]:
+    with open(SAMPLE) as file:
+        sources = {'sample': file.read(), 'stress': STRESS}
+    sources |= LOOP_PROGRAMS
+    sources |= {f'generated {seed}': generate_program(seed, 4, 6, 6, 4) for seed in range(4)}
+    return sources
+
+@pytest.mark.parametrize('name, source', programs().items())
+@pytest.mark.parametrize('divide', ['hardware', 'library'])
+def test_ir_backend_runs_like_the_interpreter(name:str, source:str, divide:str):
+    output = io.BytesIO()
+    expected = run(source, output=output), output.getvalue()
+    value, written, _ = simulate(compile_source(source, optimization_level=1, backend='ir', divide=divide))
+    assert (value, written) == expected
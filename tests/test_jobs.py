@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import pytest
+from collections import Counter
+from Cache import CompilationCache
+from Generator import generate_program
+from main import compile_source
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = generate_program(1, functions=12)
+
+@pytest.mark.parametrize('options', [
+    {'optimization_level': 0},
+    {'optimization_level': 1},
+    {'optimization_level': 1, 'backend': 'registers'},
+    {'optimization_level': 1, 'backend': 'ir', 'divide': 'library'},
+])
+def test_parallel_output_is_identical_to_serial(options:dict):
+    serial_stats, parallel_stats = Counter(), Counter()
+    serial = compile_source(SOURCE, stats=serial_stats, **options)
+    assert compile_source(SOURCE, jobs=3, stats=parallel_stats, **options) == serial
+    # Peephole counts are gathered from the workers too
+    assert parallel_stats == serial_stats
+
+def test_parallel_compile_fills_the_cache(tmp_path):
+    cache = CompilationCache(str(tmp_path))
+    serial = compile_source(SOURCE, optimization_level=1)
+    assert compile_source(SOURCE, optimization_level=1, jobs=2, cache=cache) == serial
+    assert compile_source(SOURCE, optimization_level=1, jobs=2, cache=cache) == serial
+    assert cache.hits == cache.misses > 0
+
+def test_jobs_option_writes_the_same_file(tmp_path):
+    path = tmp_path / 'program.txt'
+    path.write_text(SOURCE)
+    outputs = []
+    for jobs in ('1', '4'):
+        output = tmp_path / f'out{jobs}.s'
+        subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), str(path), '-O', '1', '-j', jobs, '-o', str(output)], check=True, cwd=tmp_path)
+        outputs.append(output.read_bytes())
+    assert outputs[0] == outputs[1] and outputs[0]
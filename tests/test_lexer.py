@@ -0,0 +1,101 @@
+import pytest
+from Lexer import *
+from Generator import generate_program
+from benchmark import LegacyLexer
+
+def scan(text:str | bytes) -> list[tuple[str, str]]:
+    return [(token.type, token.value) for token in Lexer(text).tokens()]
+
+@pytest.mark.parametrize('encode', [False, True])
+def test_keywords_are_whole_words(encode:bool):
+    text = 'iffy if returned return varx var whilst while elsewhere else functions function if1 _if'
+    tokens = scan(text.encode() if encode else text)
+    assert [token_type for token_type, _ in tokens] == [
+        'identifier', 'if', 'identifier', 'return', 'identifier', 'var', 'identifier', 'while',
+        'identifier', 'else', 'identifier', 'function', 'identifier', 'identifier', 'EOF']
+    assert tokens[0] == ('identifier', 'iffy')
+
+def test_operators_take_the_longest_match():
+    assert [token_type for token_type, _ in scan('a!=b==c=!d<e>f')] == [
+        'identifier', 'notequal', 'identifier', 'equal', 'identifier', 'assign', 'not', 'identifier',
+        'less', 'identifier', 'greater', 'identifier', 'EOF']
+    assert scan('12ab') == [('number', '12'), ('identifier', 'ab'), ('EOF', None)]
+
+@pytest.mark.parametrize('text', ['x // comment', 'x // comment\n', 'x //', 'x\n// one\n  // two', 'x  \n\t '])
+def test_comments_and_whitespace_at_the_end(text:str):
+    assert scan(text) == [('identifier', 'x'), ('EOF', None)]
+    assert scan(text.encode()) == [('identifier', 'x'), ('EOF', None)]
+
+def test_empty_input_is_only_eof():
+    assert scan('') == [('EOF', None)]
+    assert scan('// nothing') == [('EOF', None)]
+
+def test_tokens_carry_spans():
+    tokens = list(Lexer('var  x\n  = 10;').tokens())
+    assert [str(token.span) for token in tokens] == ['1:1', '1:6', '2:3', '2:5', '2:7', '2:8']
+    assert repr(tokens[3].span) == 'Span(2:5-2:7)'
+
+def test_generated_program_lexes_like_the_legacy_lexer():
+    # Generated names never start with a keyword, where the legacy lexer split them
+    text = generate_program(3, functions=5)
+    legacy, lexer = LegacyLexer(text), Lexer(text)
+    while True:
+        expected, token = legacy.get_next_token(), lexer.get_next_token()
+        assert (token.type, token.value) == (expected.type, expected.value)
+        if token == 'EOF':
+            break
+
+def long_text(count:int) -> str:
+    # count tokens: names and numbers alternating with semicolons
+    return ' '.join(f'x{i} ;' if i % 2 == 0 else f'{i} ;' for i in range(count // 2))
+
+def test_peek_ahead_across_the_window():
+    count = 3 * TOKEN_WINDOW + 10
+    text = long_text(count)
+    expected = list(Lexer(text).tokens())
+    stream = TokenStream(Lexer(text))
+    for i in range(count):
+        assert stream.peek(1) == expected[i + 1]
+        assert stream.peek() == expected[i]
+        assert stream.next() == expected[i]
+        assert stream.peek(2) == expected[min(i + 3, count)]
+        assert stream.token(stream.index - 1) == expected[i]
+    assert stream.next() == 'EOF' and stream.peek(5) == 'EOF'
+
+def test_spans_survive_the_window_moving():
+    text = long_text(2 * TOKEN_WINDOW + 4)
+    stream = TokenStream(Lexer(text))
+    for _ in range(TOKEN_WINDOW + 7):
+        stream.next()
+    token = stream.peek(1)
+    start = stream.start(1)
+    assert text[start:start + len(token.value)] == token.value
+    assert str(token.span) == f'1:{start + 1}'
+
+def test_fill_all_counts_every_token():
+    text = long_text(2 * TOKEN_WINDOW)
+    expected = list(Lexer(text).tokens())
+    stream = TokenStream(Lexer(text))
+    stream.fill_all()
+    assert len(stream) == len(expected)
+    assert [stream.token(i) for i in range(len(expected))] == expected
+    stream = TokenStream(Lexer(text))
+    for _ in range(TOKEN_WINDOW + 100):
+        stream.next()
+    # Dropped tokens still count towards the length
+    stream.fill_all()
+    assert stream.base > 0 and len(stream) == len(expected)
+
+def test_window_stays_bounded():
+    stream = TokenStream(Lexer(long_text(8 * TOKEN_WINDOW)))
+    while stream.peek() != 'EOF':
+        stream.next()
+        assert len(stream.types) <= TOKEN_WINDOW + 2
+        assert len(stream.types) == len(stream.starts) == len(stream.ends)
+    assert stream.base > 6 * TOKEN_WINDOW
+
+def test_bytes_give_the_same_tokens():
+    text = long_text(TOKEN_WINDOW + 50) + ' // done'
+    expected = list(Lexer(text).tokens())
+    stream = TokenStream(Lexer(text.encode()))
+    assert [stream.next() for _ in expected] == expected
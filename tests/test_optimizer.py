@@ -0,0 +1,241 @@
+import io
+import os
+import pytest
+from AST import *
+from Parser import Parser
+from Optimizer import ConstantFolder, Inliner, INLINE_SIZE, INLINE_BUDGET, optimize, reachable_functions
+from Simulator import simulate
+from Instrumentation import Instrumentation
+from main import compile_source, run
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample.txt')
+
+def parse_body(body:str) -> list[AST]:
+    return Parser(f'function f(x) {{ {body} }}').parse_program().statements[0].body.statements
+
+def fold(expression:str) -> AST:
+    statement, = parse_body(f'return {expression};')
+    return ConstantFolder().visit(statement).term
+
+def fold_condition(condition:str) -> AST:
+    statement, = parse_body(f'if ({condition}) {{ return 1; }}')
+    return ConstantFolder().visit(statement).conditional
+
+def instruction_count(assembly:str) -> int:
+    lines = [line.strip() for line in assembly.splitlines()]
+    return sum(1 for line in lines if line and not line.endswith(':') and not line.startswith('.'))
+
+@pytest.mark.parametrize('expression, value', [
+    ('2 + 3', 5),
+    ('2 - 3', -1),
+    ('6 * 7', 42),
+    ('7 / 2', 3),
+    ('3 == 3', 1),
+    ('3 == 4', 0),
+    ('3 != 4', 1),
+    ('3 != 3', 0),
+    ('2 < 3', 1),
+    ('3 < 2', 0),
+    ('3 > 2', 1),
+    ('2 > 3', 0),
+    ('!0', 1),
+    ('!5', 0),
+    ('(1 + 2) * (10 - 4) / 3', 6),
+])
+def test_folds_every_operator(expression:str, value:int):
+    assert fold(expression) == Number(value)
+
+@pytest.mark.parametrize('expression, value', [
+    # Arithmetic wraps at 32 bits like the registers
+    ('4294967295 + 1', 0),
+    ('2147483647 + 1', -2147483648),
+    ('65536 * 65536', 0),
+    ('0 - 2147483647 - 2', 2147483647),
+    # Division is unsigned like udiv, comparisons are signed
+    ('(0 - 2) / 2', 2147483647),
+    ('(0 - 1) < 0', 1),
+    ('4294967295 == 0 - 1', 1),
+])
+def test_folds_wrap_around(expression:str, value:int):
+    assert fold(expression) == Number(value)
+
+def test_division_by_zero_is_left_unfolded():
+    assert fold('7 / 0') == Divide(Number(7), Number(0))
+    assert fold('x / 0') == Divide(Id('x'), Number(0))
+    assert fold('x / (2 - 2)') == Divide(Id('x'), Number(0))
+
+@pytest.mark.parametrize('expression', ['x + 0', '0 + x', 'x - 0', 'x * 1', '1 * x', 'x / 1', '(x + 0) * (3 - 2)'])
+def test_identities_return_the_operand(expression:str):
+    assert fold(expression) == Id('x')
+
+def test_multiplication_by_zero():
+    assert fold('0 * x') == Number(0)
+    assert fold('(x + 1) * 0') == Number(0)
+    # The call still has to run
+    assert fold('0 * f(x)') == Multiply(Number(0), Call('f', [Id('x')]))
+    assert fold('f(x) * 0') == Multiply(Call('f', [Id('x')]), Number(0))
+
+def test_not_of_comparisons_is_inverted():
+    assert fold('!(x == 1)') == NotEqual(Id('x'), Number(1))
+    assert fold('!(x != 1)') == Equal(Id('x'), Number(1))
+    assert fold('!!!x') == Not(Id('x'))
+    # As a value !!x is x normalised to 0 or 1
+    assert fold('!!x') == Not(Not(Id('x')))
+
+def test_double_not_is_dropped_in_conditions():
+    assert fold_condition('!!x') == Id('x')
+    assert fold_condition('!!!!x') == Id('x')
+    assert fold_condition('!!!x') == Not(Id('x'))
+    statement, = parse_body('while (!!x) { x = x - 1; }')
+    assert ConstantFolder().visit(statement).conditional == Id('x')
+
+CONSTANT_HEAVY = '''
+function main() {
+    var width = 16 * 4 + 0;
+    var height = (100 - 36) * 1;
+    var area = width * height / (2 * 2);
+    if (!(area == 1024)) {
+        putchar(70);
+    } else {
+        putchar(84);
+    }
+    putchar(48 + 24 / 3 + 0 * width);
+    return area - 1000 * 1;
+}
+'''
+
+@pytest.mark.parametrize('backend', ['stack', 'registers'])
+def test_optimized_output_is_smaller(backend:str):
+    with open(SAMPLE) as file:
+        sample = file.read()
+    for source in (CONSTANT_HEAVY, sample):
+        unoptimized = instruction_count(compile_source(source, optimization_level=0, backend=backend))
+        optimized = instruction_count(compile_source(source, optimization_level=1, backend=backend))
+        assert optimized < unoptimized
+
+def test_folding_keeps_behaviour():
+    results = []
+    for optimization_level in (0, 1):
+        output = io.BytesIO()
+        results.append((run(CONSTANT_HEAVY, optimization_level, output), output.getvalue()))
+    assert results[0] == results[1] == (24, b'T8')
+
+def optimized_body(source:str) -> Block:
+    function, = optimize(Parser(source).parse_program(), 1).statements
+    return function.body
+
+def hoisted(body:Block) -> list[Var]:
+    return [node for node in walk(body) if isinstance(node, Var) and node.name.startswith('loop.')]
+
+def test_invariant_expressions_are_hoisted():
+    body = optimized_body('function f(n, a, b) { var i = 0; var t = 0; while (i < n) { t = t + (a * b + n / 3) * i; i = i + 1; } return t; }')
+    assert [var.value for var in hoisted(body)] == [Add(Multiply(Id('a'), Id('b')), DivideByConstant(Id('n'), 3))]
+    loop, = [node for node in walk(body) if isinstance(node, RotatedWhile)]
+    assert not any(node == Multiply(Id('a'), Id('b')) for node in walk(loop))
+
+def test_variant_and_side_effecting_expressions_stay():
+    body = optimized_body('function f(n, a) { var i = 0; var t = 0; while (i < n) { t = t + (a * i) + g(a) * 2; i = i + 1; } return t; }')
+    assert hoisted(body) == []
+
+def test_divisions_by_values_that_may_be_zero_stay():
+    # The loop may not run at all, and divided through the library a zero divisor could trap
+    for source in ['function f(d) { var i = 0; var x = 0; while (i < d) { x = 10 / d; i = i + 1; } return x; }',
+                   'function f(d) { var i = 0; var x = 0; while (i < d) { x = 10 / (d - 1) + 1; i = i + 1; } return x; }']:
+        assert not any(isinstance(node, Divide) for var in hoisted(optimized_body(source)) for node in walk(var))
+    program = 'function f(d) { var i = 0; var x = 0; while (i < d) { x = 10 / d; i = i + 1; } return x; } function main() { return f(0); }'
+    value, _, simulator = simulate(compile_source(program, optimization_level=1, divide='library'))
+    assert value == 0 and simulator.calls == 0
+
+def test_loops_are_rotated():
+    source = 'function f(n) { var i = 0; while (i < n) { i = i + 1; } return i; }'
+    body = optimized_body(source)
+    loop, = [node for node in walk(body) if isinstance(node, While)]
+    assert isinstance(loop, RotatedWhile) and loop.conditional == Less(Id('i'), Id('n'))
+    # The condition is tested at the bottom, so an iteration takes a single branch
+    for backend in ('stack', 'registers'):
+        assembly = compile_source(source, optimization_level=1, backend=backend)
+        branches = [simulate(assembly, 'f', [n])[2].branches for n in (0, 10)]
+        assert branches[1] - branches[0] == 10
+
+def inline(source:str) -> dict[str, Function]:
+    tree = Parser(source).parse_program()
+    return {function.name: function for function in Inliner(tree).visit(tree).statements}
+
+def calls(function:Function) -> list[str]:
+    return [node.callee for node in walk(function.body) if isinstance(node, Call)]
+
+def test_inlined_parameters_are_substituted_or_renamed():
+    functions = inline('function f(a, b) { var t = a * b; return t + b; } '
+                       'function main() { var y = 5; var z = f(y, y + 1); return f(z, 2); }')
+    assert calls(functions['main']) == []
+    # a takes the variable, b is read twice so y + 1 is bound, and every inlined copy has its own names
+    assert functions['main'].body.statements == [
+        Var('y', Number(5)),
+        Var('f.b.1', Add(Id('y'), Number(1))),
+        Var('f.t.1', Multiply(Id('y'), Id('f.b.1'))),
+        Var('z', Add(Id('f.t.1'), Id('f.b.1'))),
+        Var('f.t.2', Multiply(Id('z'), Number(2))),
+        Return(Add(Id('f.t.2'), Number(2))),
+    ]
+
+def test_return_before_the_end_is_not_inlined():
+    functions = inline('function f(a) { if (a) { return 1; } return 2; } function main() { return f(3) + f(4); }')
+    assert calls(functions['main']) == ['f', 'f']
+
+def test_functions_calling_functions_are_not_inlined():
+    functions = inline('function f(n) { return f(n - 1) + 1; } function g(n) { return h(n) * 2; } function h(n) { return n + 1; } '
+                       'function main() { return f(1) + g(2); }')
+    # Recursive f and g, which calls h, stay; the leaf h goes inline into g
+    assert calls(functions['main']) == ['f', 'g']
+    assert calls(functions['g']) == []
+
+def sum_of(terms:int) -> str:
+    # A body of Block, Return, terms Ids and terms - 1 Adds
+    return 'function f(a) { return ' + ' + '.join(['a'] * terms) + '; }'
+
+def test_size_and_budget_limit_inlining():
+    small = (INLINE_SIZE - 1) // 2
+    assert 2 * small + 1 <= INLINE_SIZE
+    functions = inline(sum_of(small) + ' function main() { return ' + ' + '.join(['f(1)'] * 10) + '; }')
+    assert calls(functions['main']) == []
+
+    # Bigger than INLINE_SIZE, inlined only while all copies fit in INLINE_BUDGET
+    big = INLINE_SIZE // 2 + 1
+    size = 2 * big + 1
+    fits = INLINE_BUDGET // size
+    assert size > INLINE_SIZE and fits >= 1
+    for count, inlined in [(fits, True), (fits + 1, False)]:
+        functions = inline(sum_of(big) + ' function main() { return ' + ' + '.join(['f(1)'] * count) + '; }')
+        assert (calls(functions['main']) == []) == inlined
+
+def test_stats_report_inlined_and_static_calls():
+    source = 'function square(x) { return x * x; } function main() { var y = square(3); return square(y) + square(y + 1); }'
+    with Instrumentation() as instrumentation:
+        compile_source(source, optimization_level=1, instrumentation=instrumentation)
+    stats = instrumentation.to_dict()
+    # square(y + 1) reads x twice and is in an expression, there is no statement to bind it
+    assert stats['inlined_calls'] == 2
+    assert stats['static_calls'] == {'parsed': 3, 'optimized': 1}
+
+def function_names(tree:Block) -> list[str]:
+    return [statement.name for statement in tree.statements if isinstance(statement, Function)]
+
+def test_unreachable_functions_are_dropped():
+    tree = Parser('function a() { return b(); } function b() { return 1; } function c() { return d(); } function d() { return c(); } '
+                  'function main() { return a(); }').parse_program()
+    # c and d only call each other
+    assert function_names(reachable_functions(tree)) == ['a', 'b', 'main']
+
+def test_functions_called_outside_functions_are_kept():
+    tree = Parser('function a() { return 1; } function b() { return 2; } putchar(a()); function main() { return 0; }').parse_program()
+    assert function_names(reachable_functions(tree)) == ['a', 'main']
+
+def test_program_without_main_keeps_every_function():
+    tree = Parser('function a() { return 1; } function b() { return 2; }').parse_program()
+    assert reachable_functions(tree) is tree
+
+def test_functions_only_dead_statements_call_are_dropped():
+    tree = optimize(Parser('function g(x) { putchar(x); return x; } function h(x) { putchar(x); return g(x); } '
+                           'function main() { if (0) { h(1); } return 2; g(3); }').parse_program(), 1)
+    assert function_names(tree) == ['main']
+    assert not any(isinstance(node, (Call, TailCall)) for node in walk(tree))
@@ -0,0 +1,28 @@
+import os
+from AST import Output, FileOutput
+from main import compile_file, compile_source
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample.txt')
+
+def test_lines_are_buffered_until_close(tmp_path):
+    path = tmp_path / 'out.s'
+    path.write_text('previous\n')
+    output = FileOutput(str(path))
+    output.emit('mov r0, #1')
+    output.emit('bx lr')
+    # Nothing reaches the file before close, which replaces it whole
+    assert path.read_text() == 'previous\n'
+    output.close()
+    assert path.read_text() == 'mov r0, #1\nbx lr\n' == output.getvalue()
+
+def test_empty_output_writes_an_empty_file(tmp_path):
+    path = tmp_path / 'out.s'
+    FileOutput(str(path)).close()
+    assert path.read_text() == ''
+    assert Output().getvalue() == ''
+
+def test_compile_file_writes_what_compile_source_returns(tmp_path):
+    path = tmp_path / 'sample.s'
+    assembly = compile_file(SAMPLE, str(path), optimization_level=1)
+    with open(SAMPLE) as file:
+        assert path.read_text() == assembly == compile_source(file.read(), optimization_level=1)
@@ -0,0 +1,55 @@
+import pytest
+from AST import *
+from Parser import Parser
+
+DEPTH = 100000
+
+def expression(source:str) -> AST:
+    function, = Parser(f'function f(a, b, c) {{ return {source}; }}').parse_program().statements
+    return function.body.statements[0].term
+
+@pytest.mark.parametrize('source, tree', [
+    ('a + b * c', Add(Id('a'), Multiply(Id('b'), Id('c')))),
+    ('a * b + c', Add(Multiply(Id('a'), Id('b')), Id('c'))),
+    ('a - b - c', Subtract(Subtract(Id('a'), Id('b')), Id('c'))),
+    ('a / b / c', Divide(Divide(Id('a'), Id('b')), Id('c'))),
+    ('a - (b - c)', Subtract(Id('a'), Subtract(Id('b'), Id('c')))),
+    ('a < b + 1', Less(Id('a'), Add(Id('b'), Number(1)))),
+    ('a == b < c', Equal(Id('a'), Less(Id('b'), Id('c')))),
+    ('a != b > c', NotEqual(Id('a'), Greater(Id('b'), Id('c')))),
+    ('!a * b', Multiply(Not(Id('a')), Id('b'))),
+    ('!(a == b)', Not(Equal(Id('a'), Id('b')))),
+    ('f(a + 1, g(b), c) * 2', Multiply(Call('f', [Add(Id('a'), Number(1)), Call('g', [Id('b')]), Id('c')]), Number(2))),
+    ('f()', Call('f', [])),
+])
+def test_precedence_and_associativity(source:str, tree:AST):
+    assert expression(source) == tree
+
+def depth(node:AST) -> int:
+    deepest = 0
+    stack = [(node, 1)]
+    while stack:
+        node, level = stack.pop()
+        deepest = max(deepest, level)
+        stack.extend((child, level + 1) for child in node.children())
+    return deepest
+
+DEEP = {
+    'parentheses': lambda: '(' * DEPTH + 'a' + ')' * DEPTH,
+    'nots': lambda: '!' * DEPTH + 'a',
+    'calls': lambda: 'f(' * DEPTH + 'a' + ')' * DEPTH,
+    'right nested': lambda: '(a + ' * DEPTH + 'b' + ')' * DEPTH,
+    'chain': lambda: ' - '.join(['a'] * DEPTH),
+}
+
+@pytest.mark.parametrize('name', DEEP)
+def test_deep_expressions_parse_and_emit(name:str):
+    program = f'function f(a, b) {{ return {DEEP[name]()}; }}'
+    tree = Parser(program).parse_program()
+    if name != 'parentheses':
+        assert depth(tree) >= DEPTH
+    output = Output()
+    tree.emit(Environment(output=output))
+    if name in ('right nested', 'chain'):
+        # Every a is loaded from its slot
+        assert output.lines.count('ldr r0, [fp, #-8]') >= DEPTH
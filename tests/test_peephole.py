@@ -0,0 +1,22 @@
+from collections import Counter
+from AST import Output
+from Peephole import optimize_output
+
+def optimized(lines:list[str], stats:Counter = None) -> list[str]:
+    output = Output()
+    output.lines = list(lines)
+    return optimize_output(output, stats).lines
+
+def test_rewrites_see_their_new_neighbours():
+    # Removing the pop of the first pair brings the second push next to it
+    assert optimized(['push {r0, ip}', 'pop {r0, ip}', 'push {r1, ip}', 'pop {r2, ip}', 'bx lr']) == ['mov r2, r1', 'bx lr']
+
+def test_label_unreferenced_after_it_was_passed_is_removed():
+    stats = Counter()
+    lines = ['f:', '.L1:', 'b .L2', 'b .L1', '.L2:', 'push {r0, ip}', 'mov r0, #1', 'pop {r1, ip}', 'bx lr']
+    assert optimized(lines, stats) == ['f:', 'mov r1, r0', 'mov r0, #1', 'bx lr']
+    assert stats['unreachable'] == 1 and stats['branch_to_next'] == 1 and stats['unused_label.applied'] == 2
+
+def test_long_straight_line_code():
+    lines = ['f:'] + ['push {r0, ip}', 'ldr r0, =7', 'pop {r1, ip}', 'add r0, r1, r0'] * 20000 + ['bx lr']
+    assert optimized(lines) == ['f:'] + ['mov r1, r0', 'mov r0, #7', 'add r0, r1, r0'] * 20000 + ['bx lr']
@@ -0,0 +1,77 @@
+import io
+import pytest
+from Registers import SCRATCH_REGISTERS, SAVED_REGISTERS, parallel_move
+from Simulator import simulate
+from main import compile_source, run
+
+def apply_moves(lines:list[str], registers:dict[str, str]) -> dict[str, str]:
+    registers = dict(registers)
+    for line in lines:
+        target, source = line.removeprefix('mov ').split(', ')
+        registers[target] = registers[source]
+    return registers
+
+START = {register: register for register in SCRATCH_REGISTERS + SAVED_REGISTERS + ['ip']}
+
+@pytest.mark.parametrize('moves', [
+    [('r0', 'r1'), ('r1', 'r0')],
+    [('r0', 'r1'), ('r1', 'r2'), ('r2', 'r0')],
+    [('r4', 'r0'), ('r0', 'r1'), ('r1', 'r4'), ('r5', 'r2'), ('r2', 'r3')],
+    [('r0', 'r1'), ('r1', 'r0'), ('r2', 'r3'), ('r3', 'r2')],
+    [('r0', 'r0'), ('r5', 'r1'), ('r5', 'r2')],
+])
+def test_parallel_move_acts_at_once(moves:list[tuple[str, str]]):
+    lines = parallel_move(moves)
+    registers = apply_moves(lines, START)
+    for source, target in moves:
+        assert registers[target] == source
+    # A move is one mov, and each cycle one more through ip
+    moved = [move for move in moves if move[0] != move[1]]
+    through_ip = sum(1 for line in lines if line.startswith('mov ip'))
+    assert len(lines) == len(moved) + through_ip
+
+def test_parallel_move_swap_goes_through_ip():
+    assert parallel_move([('r0', 'r1'), ('r1', 'r0')]) == ['mov ip, r0', 'mov r0, r1', 'mov r1, ip']
+    assert parallel_move([('r0', 'r1'), ('r1', 'r2')]) == ['mov r2, r1', 'mov r1, r0']
+
+def balanced(depth:int, leaf:int = 0) -> str:
+    # Needs depth + 1 registers: both halves of every node need as many
+    if depth == 0:
+        return f'v{leaf % 4}' if leaf % 3 else str(leaf + 1)
+    operator = '+' if depth % 2 else '-'
+    return f'({balanced(depth - 1, 2 * leaf)} {operator} {balanced(depth - 1, 2 * leaf + 1)})'
+
+def check(source:str, **options) -> str:
+    output = io.BytesIO()
+    expected = run(source, output=output), output.getvalue()
+    assembly = compile_source(source, backend='registers', **options)
+    assert simulate(assembly)[:2] == expected
+    return assembly
+
+def test_more_live_values_than_registers_spill():
+    # At -O 0, so common subexpressions do not shrink the tree
+    depth = len(SCRATCH_REGISTERS) + len(SAVED_REGISTERS)
+    source = (f'function f(v0, v1, v2, v3) {{ return {balanced(depth)}; }}'
+              ' function main() { var x = f(3, 5, 7, 11); putchar(48 + x - x / 10 * 10); return x; }')
+    assembly = check(source, optimization_level=0)
+    assert 'pop {ip, lr}' in assembly
+    assert 'r10' in assembly
+
+def test_calls_with_more_than_four_arguments():
+    source = '''
+function six(a, b, c, d, e, f) {
+    return a - b * 2 + c * 3 - d * 5 + e * 7 - f * 11;
+}
+function g(x) {
+    putchar(65 + x);
+    return x * 3;
+}
+function main() {
+    var a = 4;
+    var x = six(a, g(1), a + 1, g(2), 5, g(a));
+    return x + six(g(3), 1, 2, 3, g(4), six(1, 2, 3, 4, 5, g(5)));
+}
+'''
+    for optimization_level in (0, 1):
+        assembly = check(source, optimization_level=optimization_level)
+        assert 'bl six' in assembly and 'pop {r0, r1, r2, r3}' in assembly
@@ -0,0 +1,42 @@
+import io
+import mmap
+import os
+from Generator import generate_program
+from main import compile_file, compile_source, open_source, run_file
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample.txt')
+
+def test_files_are_mapped_not_read(tmp_path):
+    with open_source(SAMPLE) as source:
+        assert isinstance(source, mmap.mmap)
+        with open(SAMPLE, 'rb') as file:
+            assert source[:] == file.read()
+    assert source.closed
+
+def test_empty_file_is_an_empty_program(tmp_path):
+    path = tmp_path / 'empty.txt'
+    path.write_bytes(b'')
+    with open_source(str(path)) as source:
+        assert source == b''
+    assert compile_file(str(path), str(tmp_path / 'empty.s')) == compile_source('')
+    assert (tmp_path / 'empty.s').read_text() == compile_source('')
+
+def test_mapped_file_compiles_like_its_text(tmp_path):
+    source = generate_program(2, functions=8)
+    path = tmp_path / 'program.txt'
+    path.write_text(source)
+    for options in [{}, {'optimization_level': 1}, {'optimization_level': 1, 'backend': 'ir'}]:
+        output = str(tmp_path / 'program.s')
+        assert compile_file(str(path), output, **options) == compile_source(source, **options)
+
+def test_comment_and_whitespace_only_files(tmp_path):
+    for text in [b'\n\n', b'// only a comment', b'// comment\n   \n']:
+        path = tmp_path / 'blank.txt'
+        path.write_bytes(text)
+        assert compile_file(str(path), str(tmp_path / 'blank.s')) == compile_source('')
+
+def test_non_ascii_bytes_in_comments(tmp_path):
+    path = tmp_path / 'utf8.txt'
+    path.write_bytes('// héllo wörld\nfunction main() { putchar(65); return 0; }\n'.encode())
+    output = io.BytesIO()
+    assert run_file(str(path), output=output) == 0 and output.getvalue() == b'A'
@@ -0,0 +1,88 @@
+import os
+import pytest
+from AST import *
+from Parser import Parser
+from Optimizer import optimize
+from Generator import generate_program
+from Simulator import simulate
+from benchmark import INTERPRETER_PROGRAMS, LOOP_PROGRAMS
+
+MASK = 0xffffffff
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample.txt')
+
+def divisors_used() -> set[int]:
+    # Every divisor -O 1 turns into a reciprocal in the sample programs and generated ones
+    with open(SAMPLE) as file:
+        sources = [file.read()]
+    sources += list(INTERPRETER_PROGRAMS.values()) + list(LOOP_PROGRAMS.values()) + [generate_program(seed, 20) for seed in range(4)]
+    divisors = set()
+    for source in sources:
+        tree = optimize(Parser(source).parse_program(), 1)
+        divisors.update(node.divisor for node in walk(tree) if isinstance(node, DivideByConstant))
+    return divisors
+
+DIVISORS = sorted(divisors_used() | set(range(2, 300)) | {641, 1000, 10000, 65535, 65537, 2 ** 31 - 1, 2 ** 31 + 1, 2 ** 32 - 3, MASK})
+
+def boundaries(divisor:int) -> set[int]:
+    top = MASK // divisor * divisor
+    candidates = {0, 1, divisor - 1, divisor, divisor + 1, 2 ** 31 - 1, 2 ** 31, MASK, top - 1, top, top + divisor - 1}
+    return {x for x in candidates if 0 <= x <= MASK}
+
+def divide(x:int, divisor:int) -> int:
+    multiplier, shift, fixup = reciprocal(divisor)
+    if not fixup:
+        return (x * multiplier) >> (32 + shift)
+    high = (x * multiplier) >> 32
+    return (high + ((x - high) >> 1)) >> shift
+
+@pytest.mark.parametrize('divisor', DIVISORS)
+def test_reciprocal_divides_at_the_boundaries(divisor:int):
+    multiplier, shift, fixup = reciprocal(divisor)
+    assert 0 < multiplier <= MASK
+    for x in boundaries(divisor):
+        assert divide(x, divisor) == x // divisor
+
+@pytest.mark.parametrize('divisor', [3, 7, 10, 641, 2 ** 31 - 1, 2 ** 31 + 1, MASK, 64])
+def test_reciprocal_lines_divide_on_the_simulator(divisor:int):
+    assembly = '\n'.join(['f:', *reciprocal_lines('r0', 'r1', 'r2', divisor), 'bx lr'])
+    for x in boundaries(divisor):
+        value, _, _ = simulate(assembly, 'f', [x])
+        assert value & MASK == x // divisor
+
+def multiply(x:int, sequence:list[tuple[str, int]]) -> int:
+    for operation, amount in sequence:
+        if operation == 'add':
+            x = x + (x << amount)
+        elif operation == 'rsb':
+            x = (x << amount) - x
+        elif operation == 'lsl':
+            x = x << amount
+        else:
+            x = -x
+        x &= MASK
+    return x
+
+CONSTANTS = list(range(-1100, 1100)) + [2 ** k + d for k in range(2, 32) for d in (-1, 0, 1)] + [-(2 ** 31), MASK]
+
+def test_shift_add_sequence_reproduces_its_constant():
+    for constant in CONSTANTS:
+        sequence = shift_add_sequence(constant)
+        if sequence is None:
+            continue
+        assert len(sequence) <= 3
+        for x in (1, 3, 12345, 2 ** 31 - 1, MASK):
+            assert multiply(x, sequence) == x * constant & MASK
+
+def test_shift_add_sequence_covers_shifts_and_neighbours_of_powers_of_two():
+    for k in range(1, 31):
+        for constant in (2 ** k, 2 ** k + 1, 2 ** k - 1, -(2 ** k), 3 << k, 7 << k):
+            assert shift_add_sequence(constant) is not None
+    for constant in (0, 11, 13, 100, 1000):
+        assert shift_add_sequence(constant) is None
+
+@pytest.mark.parametrize('constant', [3, 5, 7, 9, 24, -1, -6, 2 ** 31 - 1])
+def test_shift_add_lines_multiply_on_the_simulator(constant:int):
+    assembly = '\n'.join(['f:', *shift_add_lines('r0', constant), 'bx lr'])
+    for x in (0, 1, 7, 65535, 2 ** 31 - 1, MASK):
+        value, _, _ = simulate(assembly, 'f', [x])
+        assert value & MASK == x * constant & MASK
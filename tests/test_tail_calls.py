@@ -0,0 +1,63 @@
+import io
+import pytest
+from AST import *
+from Parser import Parser
+from Optimizer import TailCalls
+from Simulator import simulate
+from main import compile_source, run
+
+COUNT = 'function count(n, total) { if (n == 0) { return total; } return count(n - 1, total + n); }'
+
+BACKENDS = ['stack', 'registers', 'ir']
+
+def function_lines(assembly:str, name:str) -> list[str]:
+    lines = [line.strip() for line in assembly.splitlines()]
+    start = lines.index(f'{name}:') + 1
+    end = next((i for i in range(start, len(lines)) if lines[i].startswith('.global')), len(lines))
+    return [line for line in lines[start:end] if line]
+
+def tail_calls(source:str) -> list[str]:
+    tree = TailCalls().visit(Parser(source).parse_program())
+    return [node.callee for node in walk(tree) if isinstance(node, TailCall)]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_self_tail_call_branches_to_the_entry(backend:str):
+    assembly = compile_source(COUNT + ' function main() { return count(10000, 0); }', optimization_level=1, backend=backend)
+    lines = function_lines(assembly, 'count')
+    assert not any(line.startswith('bl ') for line in lines)
+    assert 'b .Lcount_entry' in lines and '.Lcount_entry:' in lines
+    # 10000 calls deep in constant stack
+    value, _, simulator = simulate(assembly)
+    assert value == 50005000 and len(simulator.memory) < 32
+
+def test_only_returned_calls_with_at_most_four_arguments_are_tail_calls():
+    assert tail_calls('function f(a) { return g(a, 1, 2, 3); }') == ['g']
+    assert tail_calls('function f(a) { return g(a, 1, 2, 3, 4); }') == []
+    assert tail_calls('function f(a) { g(a); return g(a) + 1; }') == []
+    assert tail_calls('function f(a) { var x = g(a); return x; }') == []
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_calls_that_are_not_tail_calls_stay_calls(backend:str):
+    source = (COUNT + ' function five(a, b, c, d, e) { return count(a, e); }'
+              ' function f(a) { return five(a, 1, 2, 3, a); }'
+              ' function g(a) { count(a, 1); return count(a, 2) + 1; }'
+              ' function main() { return f(10) + g(20); }')
+    assembly = compile_source(source, optimization_level=1, backend=backend)
+    # The fifth argument lives in the caller's frame
+    assert 'bl five' in function_lines(assembly, 'f') and 'b five' not in function_lines(assembly, 'f')
+    assert function_lines(assembly, 'g').count('bl count') == 2
+    assert 'b count' in function_lines(assembly, 'five')
+    assert simulate(assembly)[0] == run(source, output=io.BytesIO())
+
+def test_register_frame_is_torn_down_before_the_jump():
+    source = (COUNT + ' function g(a) { putchar(a); return a * 2; }'
+              ' function h(a) { return count(a, g(a) + g(a + 1)); }'
+              ' function main() { var x = g(65); return x + h(66) + x; }')
+    assembly = compile_source(source, optimization_level=1, backend='registers')
+    lines = function_lines(assembly, 'h')
+    # h holds a value in r4 across the calls to g, it is restored and lr reloaded before branching
+    assert lines[0] == 'push {r4, lr}'
+    assert lines[-4:] == ['mov sp, fp', 'pop {fp, ip}', 'pop {r4, lr}', 'b count']
+    output = io.BytesIO()
+    expected = run(source, output=output), output.getvalue()
+    assert simulate(assembly)[:2] == expected